@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+"""
+Measure the delay between a line being written by the "Arduino" and the line
+being read by voltageMonitor.py for the 'sleep' and 'select' acquisition modes.
+The Arduino is replaced by a pseudo-terminal that is written to at random
+times.
+"""
+
+import os
+import sys
+import time
+import numpy
+import random
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from lvmb import LVMB, wait_any
+
+
+def _writer(fd, count, period, stamps):
+    """
+    Write `count` lines to the master side of the pseudo-terminal with a
+    random spacing between `period`/10 and 2*`period` and record when each
+    was written.  The spread means that lines arrive at all phases of the
+    0.2 s sleep used by the 'sleep' mode.
+    """
+    
+    for i in range(count):
+        time.sleep(random.uniform(0.1, 2.0)*period)
+        stamps.append(time.time())
+        os.write(fd, b"240.000  120.000\n")
+
+
+def measure(mode, count=50, period=0.32):
+    """
+    Return an array of read latencies in seconds for the given acquisition
+    mode.  The reads are done the same way as the voltageMonitor.py main
+    loop, i.e., with read_block() after either a 0.2 s sleep or wait_any().
+    """
+    
+    master, slave = os.openpty()
+    meter = LVMB(os.ttyname(slave))
+    
+    stamps = []
+    writer = threading.Thread(target=_writer, args=(master, count, period, stamps))
+    writer.start()
+    
+    latency = []
+    while len(latency) < count:
+        if mode == 'select':
+            wait_any([meter,], 1.0)
+        else:
+            time.sleep(0.2)
+        block = meter.read_block()
+        tRead = time.time()
+        for i in range(block.shape[0]):
+            latency.append(tRead - stamps[len(latency)])
+            
+    writer.join()
+    meter.close()
+    os.close(master)
+    os.close(slave)
+    
+    return numpy.array(latency)
+
+
+def main(args):
+    print("%6s  |  %9s  |  %9s  |  %9s" % ('Mode', 'Mean [ms]', 'p50 [ms]', 'p99 [ms]'))
+    print("-"*(6 + 9*3 + 5*3))
+    results = {}
+    for mode in ('sleep', 'select'):
+        latency = measure(mode, count=args.count) * 1000
+        results[mode] = latency
+        print("%6s  |  %9.2f  |  %9.2f  |  %9.2f" % (mode, latency.mean(), numpy.percentile(latency, 50),
+                                                    numpy.percentile(latency, 99)))
+    print("'select' mode fires events %.1f ms sooner on average (%.1f ms at p99)" % (results['sleep'].mean() - results['select'].mean(),
+                                                                                  numpy.percentile(results['sleep'], 99) - numpy.percentile(results['select'], 99)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='measure the serial read latency of the voltageMonitor.py acquisition modes',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+            )
+    parser.add_argument('-n', '--count', type=int, default=50,
+                        help='number of lines to time for each mode')
+    args = parser.parse_args()
+    
+    main(args)
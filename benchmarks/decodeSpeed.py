@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+"""
+Compare the speed of the lvmpacket decoders against the regular expression
+and datetime.strptime() approach that the multicast consumers used to use.
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from lvmpacket import encode_packet, decode_datagram
+
+dataRE = re.compile(r'^\[(?P<date>.*)\] (?P<type>[A-Z0-9]*): (?P<data>.*)$')
+
+
+def legacy_decode(data):
+    """
+    The original per-consumer decoding path.
+    """
+    
+    data = data.decode('ascii')
+    mtch = dataRE.match(data)
+    t = datetime.strptime(mtch.group('date'), "%Y-%m-%d %H:%M:%S.%f")
+    if mtch.group('type')[-3:] == 'VAC':
+        value = float(mtch.group('data'))
+    return t, mtch.group('type'), mtch.group('data')
+
+
+def _time(func, messages, repeat):
+    """
+    Return the best time per message in microseconds for decoding `messages`
+    with `func`.
+    """
+    
+    best = 1e99
+    for r in range(repeat):
+        t0 = time.perf_counter()
+        for m in messages:
+            func(m)
+        best = min(best, time.perf_counter() - t0)
+    return best / len(messages) * 1e6
+
+
+def main(args):
+    t = time.time()
+    ascii = []
+    for i in range(args.count):
+        tUTC = datetime.utcfromtimestamp(t + i*0.1).strftime("%Y-%m-%d %H:%M:%S.%f")
+        ascii.append(("[%s] 120VAC: %.2f" % (tUTC, 120.0 + (i % 50)*0.1)).encode('ascii'))
+        ascii.append(("[%s] 240VAC: %.2f" % (tUTC, 240.0 + (i % 50)*0.1)).encode('ascii'))
+    binary = [encode_packet(i, t + i*0.1, [('VAC', '120V', 120.0), ('VAC', '240V', 240.0)]) for i in range(args.count)]
+    
+    tLegacy = _time(legacy_decode, ascii, args.repeat)
+    tASCII = _time(decode_datagram, ascii, args.repeat)
+    tBinary = _time(decode_datagram, binary, args.repeat) / 2
+    
+    print("%-24s  |  %12s  |  %7s" % ('Decoder', 'us/value', 'Speedup'))
+    print("-"*(24 + 12 + 7 + 5*2))
+    print("%-24s  |  %12.3f  |  %7.1f" % ('regex + strptime', tLegacy, 1.0))
+    print("%-24s  |  %12.3f  |  %7.1f" % ('lvmpacket ASCII', tASCII, tLegacy/tASCII))
+    print("%-24s  |  %12.3f  |  %7.1f" % ('lvmpacket binary', tBinary, tLegacy/tBinary))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='benchmark the decoding of the voltage monitor multicast packets',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+            )
+    parser.add_argument('-n', '--count', type=int, default=20000,
+                        help='number of packets to decode')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='number of times to repeat each timing')
+    args = parser.parse_args()
+    
+    main(args)
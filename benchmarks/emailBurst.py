@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+"""
+Send a burst of alerts to a local SMTP stand-in, first with the old
+thread-and-connection-per-alert approach and then through lvmmail.MailSender,
+and report the peak thread count, the number of SMTP sessions and messages,
+and the time from an alert being raised to it being delivered.
+"""
+
+import os
+import re
+import sys
+import time
+import numpy
+import socket
+import smtplib
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from lvmmail import MailSender
+
+
+# Alert number in a message body
+_ALERT_RE = re.compile(rb'Alert (\d+)')
+
+
+class SMTPStandIn(object):
+    """
+    Minimal SMTP server that accepts everything sent to it and records when
+    each message arrived and which alerts were in it.  `delay` is added to every session to stand in for
+    the TLS handshake and login of a real server.
+    """
+    
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.sessions = 0
+        self.received = []
+        self._lock = threading.Lock()
+        
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+        
+        self._thread = threading.Thread(target=self._accept)
+        self._thread.daemon = True
+        self._thread.start()
+        
+    def _accept(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                break
+            session = threading.Thread(target=self._session, args=(conn,))
+            session.daemon = True
+            session.start()
+            
+    def _session(self, conn):
+        with self._lock:
+            self.sessions += 1
+        time.sleep(self.delay)
+        
+        fh = conn.makefile('rb')
+        conn.sendall(b"220 localhost stand-in\r\n")
+        in_data = False
+        alerts = []
+        for line in fh:
+            if in_data:
+                if line == b".\r\n":
+                    in_data = False
+                    with self._lock:
+                        self.received.append((time.time(), alerts))
+                    alerts = []
+                    conn.sendall(b"250 OK\r\n")
+                else:
+                    alerts.extend([int(a) for a in _ALERT_RE.findall(line)])
+                continue
+                
+            cmd = line[:4].upper()
+            if cmd == b'EHLO' or cmd == b'HELO':
+                conn.sendall(b"250 localhost\r\n")
+            elif cmd == b'DATA':
+                in_data = True
+                conn.sendall(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+            elif cmd == b'QUIT':
+                conn.sendall(b"221 Bye\r\n")
+                break
+            else:
+                conn.sendall(b"250 OK\r\n")
+        fh.close()
+        conn.close()
+        
+    def close(self):
+        self.sock.close()
+
+
+def _legacy_send(port, subject, message):
+    """
+    Send one e-mail over a fresh SMTP session like the old sendPowerEmail.py.
+    """
+    
+    server = smtplib.SMTP('127.0.0.1', port)
+    server.sendmail('monitor@localhost', ['ops@localhost',], "Subject: %s\r\n\r\n%s" % (subject, message))
+    server.close()
+
+
+def _sender_threads():
+    """
+    Return the number of threads currently sending e-mail.
+    """
+    
+    return len([t for t in threading.enumerate() if t.name.startswith('Alert') or t.name == 'MailSender'])
+
+
+def measure(mode, count=200, spacing=0.005, coalesce=0.5, delay=0.05):
+    """
+    Raise `count` alerts `spacing` seconds apart and return a dictionary of
+    results for the given mode, 'legacy' or 'queued'.
+    """
+    
+    standin = SMTPStandIn(delay=delay)
+    peak = 0
+    
+    sender = None
+    if mode == 'queued':
+        sender = MailSender('127.0.0.1', ['ops@localhost',], 'monitor@localhost', port=standin.port,
+                            starttls=False, coalesce=coalesce)
+        sender.start()
+        
+    raised = []
+    for i in range(count):
+        raised.append(time.time())
+        if mode == 'legacy':
+            op = threading.Thread(target=_legacy_send, args=(standin.port, 'Power Flicker', 'Alert %i' % i),
+                                  name='Alert%i' % i)
+            op.start()
+        else:
+            sender.submit('Power Flicker', 'Alert %i' % i)
+        peak = max(peak, _sender_threads())
+        time.sleep(spacing)
+        
+    if sender is not None:
+        sender.stop()
+    else:
+        while len(standin.received) < count:
+            peak = max(peak, _sender_threads())
+            time.sleep(0.01)
+            
+    # The latency of an alert is the time until the message it was sent in,
+    # or coalesced into, was delivered
+    delivered = numpy.zeros(count)
+    for t,alerts in standin.received:
+        delivered[alerts] = t
+    latency = delivered - numpy.array(raised)
+    
+    results = {'peak': peak,
+               'sessions': standin.sessions,
+               'messages': len(standin.received),
+               'latency': latency}
+
+    standin.close()
+    return results
+
+
+def main(args):
+    print("%6s  |  %7s  |  %8s  |  %8s  |  %9s  |  %9s" % ('Mode', 'Threads', 'Sessions', 'Messages', 'p50 [ms]', 'p99 [ms]'))
+    print("-"*(6 + 7 + 8*2 + 9*2 + 5*5))
+    for mode in ('legacy', 'queued'):
+        results = measure(mode, count=args.count, spacing=args.spacing, coalesce=args.coalesce, delay=args.delay)
+        latency = results['latency']*1000
+        print("%6s  |  %7i  |  %8i  |  %8i  |  %9.2f  |  %9.2f" % (mode, results['peak'], results['sessions'], results['messages'],
+                                                                  numpy.percentile(latency, 50), numpy.percentile(latency, 99)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='compare per-alert e-mail threads with the queued, coalescing sender in lvmmail',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+            )
+    parser.add_argument('-n', '--count', type=int, default=200,
+                        help='number of alerts in the burst')
+    parser.add_argument('-s', '--spacing', type=float, default=0.005,
+                        help='time between alerts in seconds')
+    parser.add_argument('-w', '--coalesce', type=float, default=0.5,
+                        help='coalescing window of the queued sender in seconds')
+    parser.add_argument('-d', '--delay', type=float, default=0.05,
+                        help='simulated SMTP handshake time in seconds')
+    args = parser.parse_args()
+    
+    main(args)
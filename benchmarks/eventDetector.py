@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+"""
+Check that lvmevents.EventEngine produces the same events no matter how the
+samples are split into blocks and time it in bulk over a synthetic day of
+data with flickers, sags, a long outage, and a voltage hovering around a
+limit.
+"""
+
+import os
+import sys
+import time
+import numpy
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from lvmevents import EventEngine, EVENT_RANGE
+
+
+# Channels and limits to test with
+NAMES = ('120V', '240V')
+LOW = (108.0, 216.0)
+HIGH = (132.0, 264.0)
+
+
+def synthetic_day(rate=100.0, duration=86400.0, seed=None):
+    """
+    Return the sample times and an N by 2 array of 120 VAC and 240 VAC
+    voltages for `duration` seconds of data at `rate` samples per second.
+    """
+    
+    rng = numpy.random.default_rng(seed)
+    n = int(rate*duration)
+    t = 1.7e9 + numpy.arange(n)/rate
+    values = numpy.empty((n, 2), dtype=numpy.float64)
+    values[:,0] = 120.0 + rng.normal(0, 2.0, n)
+    values[:,1] = 240.0 + rng.normal(0, 3.0, n)
+    
+    # Flickers and sags on random channels
+    for start in rng.integers(0, n, 200):
+        length = int(rng.integers(1, int(2*rate)))
+        values[start:start+length, rng.integers(0, 2)] *= rng.choice([0.0, 0.5, 0.85, 1.12])
+    # A one hour outage on both channels
+    values[n//4:n//4+int(3600*rate),:] = 0.0
+    # Ten minutes hovering around the 120 VAC low limit
+    values[n//2:n//2+int(600*rate),0] = LOW[0] + rng.normal(0, 0.5, int(600*rate))
+    
+    return t, values
+
+
+def run(t, values, block, **kwds):
+    """
+    Feed the samples to a new EventEngine in blocks of `block` samples and
+    return the events as a list of tuples.
+    """
+    
+    engine = EventEngine(NAMES, LOW, HIGH, flicker=0.0, outage=0.5, clear=300.0, **kwds)
+    events = []
+    for i in range(0, t.size, block):
+        events.extend(engine.process(t[i:i+block], values[i:i+block]))
+    return [(e.t, e.channel, e.kind, e.value, e.age) for e in events]
+
+
+def main(args):
+    t, values = synthetic_day(rate=args.rate, duration=args.duration, seed=args.seed)
+    settings = (('no hysteresis', {}),
+                ('hysteresis', {'hysteresis': args.hysteresis, 'debounce': args.debounce}))
+                
+    # Block size invariance, on the first part of the day so that one
+    # sample at a time finishes in a reasonable amount of time
+    n = min(t.size, args.check)
+    for label,kwds in settings:
+        reference = run(t[:n], values[:n], n, **kwds)
+        for block in (1, 13, 1000):
+            if run(t[:n], values[:n], block, **kwds) != reference:
+                print("ERROR: %s events differ for blocks of %i samples" % (label, block))
+                sys.exit(1)
+        print("%s: %i events identical for blocks of 1, 13, 1000, and %i samples" % (label, len(reference), n))
+        
+    # Bulk throughput over the whole day
+    print("%15s  |  %12s  |  %8s  |  %12s" % ('Settings', 'Range events', 'Events', 'Samples/s'))
+    print("-"*(15 + 12 + 8 + 12 + 3*5))
+    for label,kwds in settings:
+        for ranges in (True, False):
+            t0 = time.perf_counter()
+            events = run(t, values, t.size, range_events=ranges, **kwds)
+            elapsed = time.perf_counter() - t0
+            events = [e for e in events if e[2] != EVENT_RANGE]
+            print("%15s  |  %12s  |  %8i  |  %12.3e" % (label, 'yes' if ranges else 'no', len(events), t.size/elapsed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='check and time the flicker/outage/clear event detector',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+            )
+    parser.add_argument('-r', '--rate', type=float, default=100.0,
+                        help='sample rate in samples per second')
+    parser.add_argument('-d', '--duration', type=float, default=86400.0,
+                        help='amount of data in seconds')
+    parser.add_argument('-c', '--check', type=int, default=200000,
+                        help='number of samples to check the block size invariance on')
+    parser.add_argument('-y', '--hysteresis', type=float, default=2.0,
+                        help='hysteresis in VAC')
+    parser.add_argument('-b', '--debounce', type=int, default=1,
+                        help='debounce count in samples')
+    parser.add_argument('-e', '--seed', type=int, default=1,
+                        help='random seed')
+    args = parser.parse_args()
+    
+    main(args)
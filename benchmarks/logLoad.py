@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"""
+Compare loading a whole voltage log with lvmload against numpy.genfromtxt(), a
+plain Python line loop, and numpy.fromstring() for both a plain and a gzipped
+log, and check that every loader agrees on the values.
+"""
+
+import os
+import sys
+import time
+import numpy
+import shutil
+import argparse
+import tempfile
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from lvmlogs import open_log
+from lvmload import load_log, cache_filename
+
+
+def write_log(filename, nline, seed=None):
+    """
+    Write `nline` lines of a synthetic 120 VAC log with the occasional
+    malformed line mixed in.
+    """
+    
+    rng = numpy.random.default_rng(seed)
+    t = 1.7e9 + numpy.arange(nline)*0.1
+    v = 120.0 + rng.normal(0, 2.0, nline)
+    v[rng.integers(0, nline, nline//1000)] = 0.0
+    lines = ["%.2f  %.1f\n" % (a, b) for a,b in zip(t, v)]
+    for i in rng.integers(0, nline, 5):
+        lines[i] = lines[i][:8] + '\n'
+    with open_log(filename, 'wt') as fh:
+        fh.write(''.join(lines))
+
+
+def python_loop(filename):
+    t, v = [], []
+    with open_log(filename, 'rt') as fh:
+        for line in fh:
+            try:
+                a, b = line.split()
+                t.append(float(a))
+                v.append(float(b))
+            except ValueError:
+                pass
+    return numpy.array(t), numpy.array(v)
+
+
+def genfromtxt(filename):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        data = numpy.genfromtxt(filename, invalid_raise=False)
+    return data[:,0], data[:,1]
+
+
+def fromstring(filename):
+    with open_log(filename, 'rb') as fh:
+        data = fh.read()
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', DeprecationWarning)
+            values = numpy.fromstring(data, dtype=numpy.float64, sep=' ')
+        if values.size != 2*data.count(b'\n'):
+            raise ValueError("malformed line")
+    except (ValueError, DeprecationWarning):
+        ## Fall back to going line-by-line
+        values = []
+        for line in data.splitlines():
+            try:
+                t, v = line.split(None, 1)
+                values.extend((float(t), float(v)))
+            except ValueError:
+                pass
+    values = numpy.array(values).reshape(-1, 2)
+    return values[:,0], values[:,1]
+
+
+def _time(func, filename, repeat):
+    best = 1e99
+    for r in range(repeat):
+        t0 = time.perf_counter()
+        result = func(filename)
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+def main(args):
+    tempdir = tempfile.mkdtemp()
+    try:
+        for name in ('voltage_120.log', 'voltage_120.log.1.gz'):
+            filename = os.path.join(tempdir, name)
+            write_log(filename, args.lines, seed=args.seed)
+            
+            def cold(filename):
+                cachename = cache_filename(filename)
+                if os.path.exists(cachename):
+                    os.unlink(cachename)
+                return load_log(filename)
+            def cached(filename):
+                return load_log(filename)
+                
+            print("%s, %i lines:" % (name, args.lines))
+            print("%20s  |  %10s  |  %12s" % ('Loader', 'Time [s]', 'Lines/s'))
+            print("-"*(20 + 10 + 12 + 2*5))
+            reference = None
+            for label,func in (('genfromtxt', genfromtxt), ('Python loop', python_loop),
+                               ('fromstring', fromstring), ('lvmload, no cache', lambda f: load_log(f, cache=False)),
+                               ('lvmload, cold', cold), ('lvmload, cached', cached)):
+                repeat = 1 if label in ('genfromtxt', 'Python loop') else args.repeat
+                elapsed, result = _time(func, filename, repeat)
+                if isinstance(result, numpy.ndarray):
+                    result = result['t'], result['v']
+                    
+                if reference is None:
+                    reference = result
+                elif not (numpy.array_equal(result[0], reference[0]) and numpy.array_equal(result[1], reference[1])):
+                    print("ERROR: %s does not agree with genfromtxt" % label)
+                    sys.exit(1)
+                print("%20s  |  %10.4f  |  %12.3e" % (label, elapsed, args.lines/elapsed))
+            print()
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='time loading whole voltage logs',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+            )
+    parser.add_argument('-n', '--lines', type=int, default=1000000,
+                        help='number of lines in the test logs')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='number of times to repeat each of the faster loaders')
+    parser.add_argument('-e', '--seed', type=int, default=1,
+                        help='random seed')
+    args = parser.parse_args()
+    
+    main(args)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""
+Time uploading a directory of rotated logs to a local stand-in for the
+archive, comparing the old one process per file approach against the
+batched uploader, and check that every file arrives intact, that failed
+requests are retried, and that a second run uploads nothing.
+"""
+
+import os
+import sys
+import gzip
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from lvmupload import Manifest, Uploader
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts', 'uploadLogfileLVM.py')
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """
+    Stand-in for the archive upload endpoint that records the checksum of
+    each file it receives, counts the connections, and fails every
+    `fail_every`-th request with a 503.
+    """
+    
+    protocol_version = 'HTTP/1.1'
+    
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+            
+    def log_message(self, format, *args):
+        pass
+        
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with self.server.lock:
+            self.server.requests += 1
+            fail = self.server.fail_every and self.server.requests % self.server.fail_every == 0
+        if fail:
+            self._reply(503, b'try again later')
+            return
+            
+        message = BytesParser(policy=HTTP).parsebytes(b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+        for part in message.iter_parts():
+            if part.get_param('name', header='content-disposition') == 'file':
+                with self.server.lock:
+                    self.server.received.append(hashlib.sha256(part.get_payload(decode=True)).hexdigest())
+        self._reply(200, b'OK')
+        
+    def _reply(self, status, text):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+
+def reset(server, fail_every=0):
+    server.connections, server.requests, server.received = 0, 0, []
+    server.fail_every = fail_every
+
+
+def start_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    reset(server)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def write_files(directory, count, size):
+    """
+    Write `count` gzipped files of `size` random bytes and return their names
+    and checksums.
+    """
+    
+    filenames, checksums = [], []
+    for i in range(count):
+        filename = os.path.join(directory, 'voltage_120.log.%i.gz' % (i+1))
+        data = gzip.compress(os.urandom(size))
+        with open(filename, 'wb') as fh:
+            fh.write(data)
+        filenames.append(filename)
+        checksums.append(hashlib.sha256(data).hexdigest())
+    return filenames, checksums
+
+
+def main(args):
+    server = start_server()
+    url = 'http://127.0.0.1:%i/upload' % server.server_address[1]
+    tempdir = tempfile.mkdtemp()
+    try:
+        filenames, checksums = write_files(tempdir, args.files, args.size)
+        
+        print("%28s  |  %8s  |  %8s  |  %11s  |  %8s" % ('Approach', 'Time [s]', 'Files/s', 'Connections', 'Requests'))
+        print("-"*(28 + 8 + 8 + 11 + 8 + 4*5))
+        
+        # One process, and session, per file like the original shell script,
+        # which never retried so there are no failures here
+        reset(server)
+        manifest = os.path.join(tempdir, 'legacy.json')
+        t0 = time.perf_counter()
+        for filename in filenames:
+            subprocess.call([sys.executable, SCRIPT, '--unsigned', '--url', url, '--manifest', manifest,
+                             '--jobs', '1', filename], stdout=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - t0
+        print("%28s  |  %8.3f  |  %8.1f  |  %11i  |  %8i" % ('one process per file', elapsed, args.files/elapsed,
+                                                              server.connections, server.requests))
+        if sorted(server.received) != sorted(checksums):
+            print("ERROR: one process per file did not deliver every file intact")
+            sys.exit(1)
+            
+        for jobs in (1, args.jobs):
+            reset(server, args.fail_every)
+            manifest = Manifest(os.path.join(tempdir, 'batched-%i.json' % jobs))
+            uploader = Uploader(url, {'site': 'test', 'type': 'SSLOG', 'subsystem': 'LVM'}, manifest=manifest,
+                                concurrency=jobs, retries=args.retries, backoff=0.01)
+            t0 = time.perf_counter()
+            counts = uploader.upload(filenames)
+            elapsed = time.perf_counter() - t0
+            print("%28s  |  %8.3f  |  %8.1f  |  %11i  |  %8i" % ('batched, %i job(s)' % jobs, elapsed, args.files/elapsed,
+                                                                  server.connections, server.requests))
+            if counts['uploaded'] != args.files or sorted(server.received) != sorted(checksums):
+                print("ERROR: batched upload did not deliver every file intact - %s" % counts)
+                sys.exit(1)
+                
+            # Resume - nothing should be sent the second time around
+            reset(server)
+            counts = uploader.upload(filenames)
+            if counts['skipped'] != args.files or server.requests:
+                print("ERROR: second batched upload sent files again - %s" % counts)
+                sys.exit(1)
+        print("Second batched runs skipped all %i files without any requests" % args.files)
+    finally:
+        shutil.rmtree(tempdir)
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='time uploading rotated logs to a local stand-in for the archive',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+            )
+    parser.add_argument('-f', '--files', type=int, default=60,
+                        help='number of files to upload')
+    parser.add_argument('-s', '--size', type=int, default=256*1024,
+                        help='size of each file in bytes')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='number of concurrent uploads for the batched uploader')
+    parser.add_argument('-r', '--retries', type=int, default=3,
+                        help='number of attempts for each file')
+    parser.add_argument('-x', '--fail-every', type=int, default=7,
+                        help='fail every Nth request with a 503, 0 to disable')
+    args = parser.parse_args()
+    
+    main(args)
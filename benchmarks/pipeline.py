@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+
+"""
+End-to-end benchmarks for the voltage monitoring pipeline that run without
+any hardware.  voltageMonitor.py is run against the lvmbsim pseudo-terminal
+simulator and publishes to a multicast group on the local host.  This
+measures:
+  * the delay between a voltage drop and the OUTAGE multicast message,
+  * the highest sample rate that voltageMonitor.py keeps up with and the CPU
+    time that it uses per sample, and
+  * the CPU time per packet for each of the multicast consumers.
+The results are appended to a JSON lines file so that they can be compared
+across versions.
+"""
+
+import os
+import sys
+import json
+import time
+import numpy
+import random
+import signal
+import socket
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, BASE_DIR)
+from lvmbsim import Injection, LVMBSimulator, synthetic_samples
+from lvmpacket import LVMPacketError, decode_datagram, encode_packet
+
+
+# Multicast group to use for the tests
+MCAST_ADDR = '224.168.2.10'
+
+# Small script used to run voltageMonitor.main with its state kept out of the
+# way of any real installation
+_MONITOR = """
+import sys, json
+sys.path.insert(0, %r)
+import voltageMonitor
+voltageMonitor.STATE_DIR = sys.argv[2]
+class Args(object):
+    pid_file = None
+    log_file = None
+    debug = False
+    config_file = json.load(open(sys.argv[1]))
+voltageMonitor.main(Args)
+"""
+
+
+def _get_port():
+    """
+    Pick a random even port number for the multicast group.  The port above it
+    is used by the sender.
+    """
+    
+    return random.randrange(20000, 40000, 2)
+
+
+def _listener(port, timeout=0.1):
+    """
+    Return a socket that is listening to the multicast group on `port`.
+    """
+    
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", port))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                    socket.inet_aton(MCAST_ADDR) + socket.inet_aton("0.0.0.0"))
+    sock.settimeout(timeout)
+    return sock
+
+
+class _Monitor(object):
+    """
+    voltageMonitor.py running in a subprocess against a simulated board.
+    """
+    
+    def __init__(self, workdir, serial_port, mcast_port, acquisition='thread', events=None):
+        self.workdir = workdir
+        self.log_directory = os.path.join(workdir, 'logs')
+        self.state_directory = os.path.join(workdir, 'state')
+        for path in (self.log_directory, self.state_directory):
+            if not os.path.exists(path):
+                os.mkdir(path)
+                
+        config = {'serial_port': serial_port,
+                  'acquisition': acquisition,
+                  'multicast': {'ip': MCAST_ADDR, 'port': mcast_port},
+                  'log_directory': self.log_directory,
+                  'limits': {'120V': {'low': 108.0, 'high': 132.0},
+                             '240V': {'low': 216.0, 'high': 264.0}},
+                  'events': events or {'flicker': 0.0, 'outage': 0.5, 'clear': 1.0}}
+        self.config = os.path.join(workdir, 'config.json')
+        with open(self.config, 'w') as fh:
+            json.dump(config, fh)
+            
+        self.process = None
+        
+    def start(self):
+        self.process = subprocess.Popen([sys.executable, '-c', _MONITOR % BASE_DIR, self.config, self.state_directory],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                                        
+    def cpu_time(self):
+        """
+        Return the CPU time in seconds used so far by the monitor.
+        """
+        
+        with open('/proc/%i/stat' % self.process.pid, 'r') as fh:
+            fields = fh.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        
+    def stop(self):
+        """
+        Stop the monitor.
+        """
+        
+        self.process.send_signal(signal.SIGINT)
+        self.process.wait()
+        
+    def logged(self):
+        """
+        Return the number of samples written to the 120 VAC log.
+        """
+        
+        with open(os.path.join(self.log_directory, 'voltage_120.log'), 'rb') as fh:
+            return sum(1 for line in fh)
+
+
+def measure_latency(count=10, period=0.02, acquisition='thread'):
+    """
+    Inject `count` outages and return an array of delays in seconds between
+    when the outage became reportable (the start of the outage plus the
+    configured 'outage' time) and when the OUTAGE message was received.
+    """
+    
+    tOutage, duration, gap = 0.5, 1.0, 2.5
+    injections = [Injection(2.0 + i*(duration+gap), duration, 0.0, channels=('120V',)) for i in range(count)]
+    total = 2.0 + count*(duration+gap) + 1.0
+    
+    mcast_port = _get_port()
+    sock = _listener(mcast_port)
+    with tempfile.TemporaryDirectory() as workdir:
+        with LVMBSimulator(synthetic_samples(duration=total, period=period), injections=injections) as sim:
+            monitor = _Monitor(workdir, sim.port, mcast_port, acquisition=acquisition,
+                               events={'flicker': 0.0, 'outage': tOutage, 'clear': 1.0})
+            monitor.start()
+            
+            received = []
+            while sim.is_running():
+                try:
+                    data, addr = sock.recvfrom(1024)
+                except socket.timeout:
+                    continue
+                tRecv = time.time()
+                try:
+                    seq, records = decode_datagram(data)
+                except LVMPacketError:
+                    continue
+                for rec in records:
+                    if rec.kind == 'OUTAGE' and rec.name == '120V':
+                        received.append(tRecv)
+                        
+            monitor.stop()
+            
+    sock.close()
+    
+    latency = []
+    for injection in injections:
+        tReady = sim.wall_start + (injection.start + tOutage)/sim.speedup
+        after = [t for t in received if t >= sim.wall_start + injection.start/sim.speedup]
+        if after:
+            latency.append(after[0] - tReady)
+    return numpy.array(latency)
+
+
+def measure_throughput(rates=(50, 500, 2000, 10000), duration=3.0, acquisition='thread'):
+    """
+    Run the monitor against the simulator at each of the sample rates and
+    return a list of dictionaries of the offered and achieved rates, the
+    fraction of samples logged, and the monitor's CPU time per sample.
+    """
+    
+    results = []
+    for rate in rates:
+        mcast_port = _get_port()
+        with tempfile.TemporaryDirectory() as workdir:
+            sim = LVMBSimulator(synthetic_samples(duration=duration, period=1.0/rate))
+            monitor = _Monitor(workdir, sim.port, mcast_port, acquisition=acquisition)
+            monitor.start()
+            time.sleep(1.0)
+            
+            cpu = monitor.cpu_time()
+            tStart = time.time()
+            sim.run()
+            elapsed = time.time() - tStart
+            time.sleep(1.0)
+            cpu = monitor.cpu_time() - cpu
+            
+            monitor.stop()
+            logged = monitor.logged()
+            sim.close()
+            
+        results.append({'offered': rate,
+                        'achieved': sim.sent / elapsed,
+                        'logged': logged / max(sim.sent, 1),
+                        'dropped': sim.dropped,
+                        'cpu_per_sample_us': cpu / max(logged, 1) * 1e6})
+    return results
+
+
+def measure_consumer(script, count=5000, rate=1000.0, binary=False):
+    """
+    Send `count` voltage packets to a multicast consumer script and return its
+    CPU time per packet in microseconds, or None if the script could not be
+    run.  The CPU time used by an idle copy of the consumer is subtracted.
+    """
+    
+    env = dict(os.environ)
+    env['MPLBACKEND'] = 'Agg'
+    
+    cpu = []
+    for n in (0, count):
+        mcast_port = _get_port()
+        process = subprocess.Popen([sys.executable, script, '-a', MCAST_ADDR, '-p', str(mcast_port)],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=env, cwd=os.path.dirname(script))
+        time.sleep(2.0)
+        if process.poll() is not None:
+            return None
+            
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        tStart = time.time()
+        for i in range(n):
+            t = time.time()
+            if binary:
+                data = encode_packet(i, t, [('VAC', '120V', 120.0), ('VAC', '240V', 240.0)])
+            else:
+                data = ("[%s] 120VAC: 120.00" % datetime.utcfromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S.%f")).encode('ascii')
+            sock.sendto(data, (MCAST_ADDR, mcast_port))
+            delay = tStart + (i+1)/rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        sock.close()
+        time.sleep(0.5)
+        
+        process.send_signal(signal.SIGINT)
+        pid, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = status
+        process.stderr.close()
+        cpu.append(rusage.ru_utime + rusage.ru_stime)
+        
+    return max(cpu[1] - cpu[0], 0.0) / count * 1e6
+
+
+def _revision():
+    """
+    Return the git revision of the code being benchmarked.
+    """
+    
+    try:
+        rev = subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=BASE_DIR,
+                                      stderr=subprocess.DEVNULL)
+        return rev.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main(args):
+    results = {'date': datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+               'revision': _revision(),
+               'python': sys.version.split()[0],
+               'acquisition': args.acquisition}
+               
+    # Detection latency
+    latency = measure_latency(count=args.outages, acquisition=args.acquisition) * 1000
+    results['latency_ms'] = {'p50': float(numpy.percentile(latency, 50)),
+                             'p99': float(numpy.percentile(latency, 99)),
+                             'count': int(latency.size)}
+    print("OUTAGE detection latency: p50 %.1f ms, p99 %.1f ms (%i of %i outages seen)" % (results['latency_ms']['p50'],
+                                                                                         results['latency_ms']['p99'],
+                                                                                         latency.size, args.outages))
+                                                                                         
+    # Throughput
+    throughput = measure_throughput(acquisition=args.acquisition)
+    results['throughput'] = throughput
+    print("%9s  |  %9s  |  %7s  |  %13s" % ('Offered', 'Achieved', 'Logged', 'CPU/sample'))
+    print("-"*(9*2 + 7 + 13 + 5*3))
+    sustained = 0.0
+    for entry in throughput:
+        print("%7i/s  |  %7.0f/s  |  %6.1f%%  |  %10.1f us" % (entry['offered'], entry['achieved'], entry['logged']*100,
+                                                           entry['cpu_per_sample_us']))
+        if entry['logged'] >= 0.99 and entry['dropped'] == 0:
+            sustained = max(sustained, entry['achieved'])
+    results['max_sample_rate'] = sustained
+    print("Maximum sustained sample rate: %.0f samples/s" % sustained)
+    
+    # Consumers
+    results['consumers_us_per_packet'] = {}
+    for script in ('voltageMonitorCLI.py', 'voltageMonitorGUI.py', os.path.join('scripts', 'sendPowerEmail.py')):
+        for binary in (False, True):
+            label = '%s (%s)' % (os.path.basename(script), 'binary' if binary else 'ascii')
+            cpu = measure_consumer(os.path.join(BASE_DIR, script), count=args.packets, binary=binary)
+            results['consumers_us_per_packet'][label] = cpu
+            if cpu is None:
+                print("%s: could not be run" % label)
+            else:
+                print("%s: %.1f us/packet" % (label, cpu))
+                
+    # Compare with the last run and save
+    previous = None
+    if os.path.exists(args.results):
+        with open(args.results, 'r') as fh:
+            for line in fh:
+                if line.strip():
+                    previous = json.loads(line)
+    if previous is not None:
+        print("Compared to %s (%s):" % (previous['revision'], previous['date']))
+        print("  p99 latency: %+.1f ms" % (results['latency_ms']['p99'] - previous['latency_ms']['p99']))
+        print("  max sample rate: %+.0f samples/s" % (results['max_sample_rate'] - previous['max_sample_rate']))
+    with open(args.results, 'a') as fh:
+        fh.write(json.dumps(results) + '\n')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='run end-to-end benchmarks of the voltage monitoring pipeline against a simulated board',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+            )
+    parser.add_argument('-m', '--acquisition', type=str, default='thread',
+                        help='acquisition mode to use for voltageMonitor.py')
+    parser.add_argument('-o', '--outages', type=int, default=10,
+                        help='number of outages to inject for the latency test')
+    parser.add_argument('-n', '--packets', type=int, default=5000,
+                        help='number of packets to send to each consumer')
+    parser.add_argument('-r', '--results', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results.jsonl'),
+                        help='JSON lines file to append the results to')
+    args = parser.parse_args()
+    
+    main(args)
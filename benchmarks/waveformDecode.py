@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+"""
+Check lvmb.FrameDecoder against synthetic waveform mode frames and compare
+its speed with decoding and calibrating the frames one sample at a time.
+Also compare the lvmcal lookup table calibration with evaluating the
+calibration directly.
+"""
+
+import os
+import sys
+import math
+import time
+import numpy
+import struct
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from lvmb import FrameDecoder, encode_frame, ADC_REFERENCE
+from lvmcal import Calibration
+
+_HEADER = struct.Struct('<2sBBIH')
+_SAMPLE = struct.Struct('<3H')
+
+
+def scalar_decode(data):
+    """
+    Decode a buffer of back-to-back frames one sample at a time and return a
+    list of (240 VAC, 120 VAC) pairs.
+    """
+    
+    values = []
+    offset = 0
+    while offset < len(data):
+        sync, seq, count, micros, period = _HEADER.unpack_from(data, offset)
+        offset += _HEADER.size
+        for i in range(count):
+            v240, v120, ref = _SAMPLE.unpack_from(data, offset)
+            offset += _SAMPLE.size
+            pair = []
+            for counts in (v240, v120):
+                v = counts / ref * ADC_REFERENCE
+                pair.append(82.7226*v + 1.5002379*math.log(233.034652422*v + 1) + 1.2749)
+            values.append(tuple(pair))
+        offset += 1
+    return values
+
+
+def synthetic_frames(count, size=32, seed=None):
+    """
+    Return `count` frames of `size` samples of random 240 VAC and 120 VAC
+    counts along with the counts themselves.
+    """
+    
+    rng = numpy.random.default_rng(seed)
+    counts = numpy.empty((count*size, 3), dtype=numpy.uint16)
+    counts[:,0] = rng.integers(0, 1024, counts.shape[0])
+    counts[:,1] = rng.integers(0, 1024, counts.shape[0])
+    counts[:,2] = rng.integers(600, 800, counts.shape[0])
+    frames = b''.join([encode_frame(i, i*size*1000, counts[i*size:(i+1)*size]) for i in range(count)])
+    return frames, counts
+
+
+def main(args):
+    data, counts = synthetic_frames(args.frames, size=args.size, seed=args.seed)
+    nSamples = counts.shape[0]
+    
+    # Check the vectorized decoder against the scalar one, feeding the bytes
+    # in uneven chunks to exercise the partial frame handling
+    decoder = FrameDecoder()
+    blocks = []
+    for i in range(0, len(data), 1000):
+        block, nBad = decoder.feed(data[i:i+1000], 0.0)
+        blocks.append(block)
+    block = numpy.concatenate(blocks)
+    reference = numpy.array(scalar_decode(data))
+    error = numpy.abs(block[:,1:] - reference).max()
+    print("Decoded %i samples in %i frames, max. difference from scalar %.2e VAC" % (block.shape[0], decoder.frames, error))
+    if block.shape[0] != nSamples or error > 0.05:
+        print("ERROR: vectorized decoder does not match")
+        sys.exit(1)
+        
+    # Time them
+    best = {'scalar': 1e99, 'vectorized': 1e99}
+    for r in range(args.repeat):
+        t0 = time.perf_counter()
+        scalar_decode(data)
+        best['scalar'] = min(best['scalar'], time.perf_counter() - t0)
+        
+        t0 = time.perf_counter()
+        FrameDecoder().feed(data, 0.0)
+        best['vectorized'] = min(best['vectorized'], time.perf_counter() - t0)
+        
+    for mode in ('scalar', 'vectorized'):
+        print("%10s: %8.3f us/sample, %10.0f samples/s" % (mode, best[mode]/nSamples*1e6, nSamples/best[mode]))
+        
+    # Lookup table vs. direct evaluation of the calibration
+    cal = Calibration()
+    x, ref = counts[:,0].astype(numpy.float64), counts[:,2].astype(numpy.float64)
+    nominal = numpy.full_like(ref, cal.reference_counts)
+    print("Lookup table max. difference: %.2e VAC at the nominal reference, %.2e VAC otherwise" % \
+          (numpy.abs(cal.convert(x, nominal) - cal.evaluate(x, nominal)).max(),
+           numpy.abs(cal.convert(x, ref) - cal.evaluate(x, ref)).max()))
+    best = {'direct': 1e99, 'table': 1e99}
+    for r in range(args.repeat):
+        t0 = time.perf_counter()
+        cal.evaluate(x, ref)
+        best['direct'] = min(best['direct'], time.perf_counter() - t0)
+        
+        t0 = time.perf_counter()
+        cal.convert(x, ref)
+        best['table'] = min(best['table'], time.perf_counter() - t0)
+        
+    for mode in ('direct', 'table'):
+        print("%10s: %8.3f ns/sample" % (mode, best[mode]/nSamples*1e9))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='check and time the waveform mode frame decoder',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+            )
+    parser.add_argument('-n', '--frames', type=int, default=1000,
+                        help='number of frames to decode')
+    parser.add_argument('-s', '--size', type=int, default=32,
+                        help='samples per frame')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='number of timing repeats')
+    parser.add_argument('-e', '--seed', type=int, default=1,
+                        help='random seed')
+    args = parser.parse_args()
+    
+    main(args)
@@ -10,13 +10,76 @@ float reader=0.0; // variable to store number of samples
 float storageV1=0.0; // variable to store sum of samples 
 float storageV2=0.0; // variable to store sum of samples 
 float storageR=0.0;
+
+// Set WAVEFORM_MODE to 1 to stream the raw ADC counts every
+// WAVEFORM_PERIOD_US microseconds in binary frames of WAVEFORM_FRAME samples
+// at WAVEFORM_BAUD instead of printing averaged voltages at 9600 baud.  The
+// frame format is described in lvmb.py and the calibration is done there.
+#define WAVEFORM_MODE 0
+#define WAVEFORM_BAUD 115200
+#define WAVEFORM_PERIOD_US 1000
+#define WAVEFORM_FRAME 32
+
 void setup() {
   
   // put your setup code here, to run once:
+#if WAVEFORM_MODE
+  Serial.begin(WAVEFORM_BAUD);  //  setup serial
+#else
   Serial.begin(9600);           //  setup serial
+#endif
   analogReference(DEFAULT);
 }
 
+#if WAVEFORM_MODE
+byte frameSeq=0;              // frame sequence number
+byte frameSum=0;              // running checksum of the frame
+unsigned long nextSample=0;   // micros() time of the next sample
+
+void writeByte(byte b) {
+  Serial.write(b);
+  frameSum += b;
+}
+
+void writeWord(unsigned int w) {
+  writeByte(w & 0xFF);
+  writeByte(w >> 8);
+}
+
+void loop() {
+  if(nextSample == 0) {
+    nextSample = micros();
+  }
+  
+  // Header - the samples are sent as they are taken so that the 64 byte
+  // transmit buffer never fills up and stalls the sampling
+  frameSum = 0;
+  Serial.write(0xA5);
+  Serial.write(0x5A);
+  writeByte(frameSeq++);
+  writeByte(WAVEFORM_FRAME);
+  writeWord(nextSample & 0xFFFF);
+  writeWord(nextSample >> 16);
+  writeWord(WAVEFORM_PERIOD_US);
+  
+  for(int i=0; i<WAVEFORM_FRAME; i++) {
+    while((long) (micros() - nextSample) < 0);
+    nextSample += WAVEFORM_PERIOD_US;
+    
+    val1 = analogRead(analogPin1);  // read the input pin
+    val1 = analogRead(analogPin1);  // read the input pin
+    val2 = analogRead(analogPin2);  // read the input pin
+    val2 = analogRead(analogPin2);  // read the input pin
+    ref = analogRead(analogRef);
+    ref = analogRead(analogRef);
+    writeWord(val1);
+    writeWord(val2);
+    writeWord(ref);
+  }
+  Serial.write(frameSum);
+}
+
+#else
 void loop() {
   // put your main code here, to run repeatedly:
   while(reader<190){
@@ -51,3 +114,4 @@ void loop() {
   storageR=0.0;
   reader=0.0;
 }
+#endif
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+"""
+Windowed statistics of the voltages for publication over multicast.  The
+window is either a number of samples or a length of time and the statistics
+are published every so many samples or seconds.  The samples are kept in a
+preallocated ring buffer and the running sums, taken about a reference
+voltage so that the standard deviation does not lose precision, and the
+monotonic queues for the minimum and maximum are updated as samples enter
+and leave the window.
+"""
+
+import numpy
+from collections import deque
+
+
+# Supported statistics and the multicast item kind that each is sent as
+STATISTICS = {'mean': 'VAC', 'min': 'VMIN', 'max': 'VMAX', 'rms': 'VRMS', 'std': 'VSTD'}
+
+# Window units
+UNITS = ('samples', 'seconds')
+
+
+class WindowAggregator(object):
+    """
+    Streaming aggregator for `nchan` channels over a window of `window`
+    `units` ('samples' or 'seconds') that produces `statistics` every
+    `every` `units`.  The ring buffer starts out holding `capacity` samples;
+    by default it is sized for the window when `units` is 'samples' and holds
+    4096 samples otherwise.  For time-based windows the buffer doubles in
+    size whenever it fills with samples that are all still in the window, up
+    to `max_capacity` samples.  Samples dropped from a full buffer at that
+    limit while still inside the window are counted in `truncated`.
+    """
+    
+    def __init__(self, nchan, window=4, units='samples', every=None, statistics=('mean',), capacity=None,
+                       max_capacity=1048576):
+        if units not in UNITS:
+            raise ValueError("Unknown window units '%s'" % units)
+        for stat in statistics:
+            if stat not in STATISTICS:
+                raise ValueError("Unknown statistic '%s'" % stat)
+        if window <= 0:
+            raise ValueError("Window must be positive")
+            
+        self.units = units
+        self.window = int(window) if units == 'samples' else float(window)
+        self.every = self.window if every is None else (int(every) if units == 'samples' else float(every))
+        self.statistics = tuple(statistics)
+        
+        if capacity is None:
+            capacity = self.window if units == 'samples' else 4096
+        self.capacity = int(capacity)
+        self.max_capacity = max(int(max_capacity), self.capacity)
+        self.truncated = 0
+        self._t = numpy.zeros(self.capacity)
+        self._v = numpy.zeros((self.capacity, nchan))
+        self._head = 0
+        self._size = 0
+        self._ref = None
+        self._sum = numpy.zeros(nchan)
+        self._sumsq = numpy.zeros(nchan)
+        self._pushes = 0
+        self._count = 0
+        
+        ## (sample number, value) queues with increasing values for the
+        ## minimum and decreasing values for the maximum of each channel
+        self._min = [deque() for c in range(nchan)] if 'min' in self.statistics else None
+        self._max = [deque() for c in range(nchan)] if 'max' in self.statistics else None
+        
+        self._since = 0
+        self._tLast = None
+        
+    @classmethod
+    def from_config(cls, config, nchan):
+        """
+        Build an aggregator using the 'publish' section of a voltageMonitor
+        configuration dictionary.  The defaults reproduce the original mean
+        over four samples sent every four samples.
+        """
+        
+        publish = config.get('publish', {})
+        return cls(nchan, window=publish.get('window', 4), units=publish.get('units', 'samples'),
+                   every=publish.get('every', None), statistics=publish.get('statistics', ('mean',)),
+                   capacity=publish.get('capacity', None), max_capacity=publish.get('max_capacity', 1048576))
+                   
+    @property
+    def nchan(self):
+        return self._v.shape[1]
+        
+    def __len__(self):
+        return self._size
+        
+    def _pop(self):
+        """
+        Remove the oldest sample from the window.
+        """
+        
+        i = (self._head - self._size) % self.capacity
+        d = self._v[i] - self._ref
+        self._sum -= d
+        self._sumsq -= d**2
+        
+        first = self._count - self._size
+        for queues in (self._min, self._max):
+            if queues is not None:
+                for queue in queues:
+                    if queue[0][0] == first:
+                        queue.popleft()
+        self._size -= 1
+        
+    def _push(self, t, v):
+        """
+        Add a sample to the window, growing the buffer or dropping the oldest
+        sample if the buffer is full.
+        """
+        
+        if self._size == self.capacity:
+            if self.units == 'seconds' and t - self._t[(self._head - self._size) % self.capacity] < self.window:
+                ## The oldest sample is still in the window
+                if self.capacity < self.max_capacity:
+                    self._grow()
+                else:
+                    self.truncated += 1
+                    self._pop()
+            else:
+                self._pop()
+        if self._ref is None:
+            self._ref = numpy.array(v, dtype=numpy.float64)
+        self._t[self._head] = t
+        self._v[self._head] = v
+        self._head = (self._head + 1) % self.capacity
+        self._size += 1
+        d = v - self._ref
+        self._sum += d
+        self._sumsq += d**2
+        
+        if self._min is not None:
+            for c,queue in enumerate(self._min):
+                while queue and queue[-1][1] >= v[c]:
+                    queue.pop()
+                queue.append((self._count, v[c]))
+        if self._max is not None:
+            for c,queue in enumerate(self._max):
+                while queue and queue[-1][1] <= v[c]:
+                    queue.pop()
+                queue.append((self._count, v[c]))
+        self._count += 1
+        
+        ## Recompute the running sums every so often, about the current mean,
+        ## so that rounding errors do not build up
+        self._pushes += 1
+        if self._pushes >= 16*self.capacity:
+            values = self._v[self._indices()]
+            self._ref = values.mean(axis=0)
+            self._sum = (values - self._ref).sum(axis=0)
+            self._sumsq = ((values - self._ref)**2).sum(axis=0)
+            self._pushes = 0
+            
+    def _grow(self):
+        """
+        Double the size of the ring buffer, keeping the samples in the window.
+        """
+        
+        valid = self._indices()
+        capacity = min(2*self.capacity, self.max_capacity)
+        t = numpy.zeros(capacity)
+        v = numpy.zeros((capacity, self.nchan))
+        t[:self._size] = self._t[valid]
+        v[:self._size] = self._v[valid]
+        self._t, self._v = t, v
+        self._head = self._size % capacity
+        self.capacity = capacity
+        
+    def _indices(self):
+        """
+        Return the buffer indices of the samples in the window.
+        """
+        
+        return (self._head - self._size + numpy.arange(self._size)) % self.capacity
+        
+    def _expire(self, t):
+        """
+        Remove samples that have fallen out of the window as of time `t`.
+        """
+        
+        if self.units == 'samples':
+            while self._size > self.window:
+                self._pop()
+        else:
+            while self._size > 0 and t - self._t[(self._head - self._size) % self.capacity] >= self.window:
+                self._pop()
+                
+    def _due(self, t):
+        """
+        Return whether or not it is time to publish.
+        """
+        
+        if self.units == 'samples':
+            return self._since >= self.every
+        if self._tLast is None:
+            self._tLast = t
+        return t - self._tLast >= self.every
+        
+    def result(self):
+        """
+        Return a dictionary of the statistics for the current window, each an
+        array with one value per channel.
+        """
+        
+        n = max(self._size, 1)
+        ref = self._ref if self._ref is not None else numpy.zeros(self.nchan)
+        offset = self._sum / n
+        mean = ref + offset
+        var = numpy.maximum(self._sumsq / n - offset**2, 0.0)
+        
+        results = {}
+        for stat in self.statistics:
+            if stat == 'mean':
+                results[stat] = mean
+            elif stat == 'rms':
+                results[stat] = numpy.sqrt(mean**2 + var)
+            elif stat == 'std':
+                results[stat] = numpy.sqrt(var)
+            else:
+                queues = self._min if stat == 'min' else self._max
+                results[stat] = numpy.array([queue[0][1] if queue else 0.0 for queue in queues])
+        return results
+        
+    def process(self, t, values):
+        """
+        Add a block of samples with times `t` (length N) and voltages `values`
+        (N by `nchan`) and return a list of (time, statistics dictionary)
+        tuples, one for each time the statistics were due.
+        """
+        
+        published = []
+        for ti,vi in zip(t, values):
+            self._push(ti, vi)
+            self._expire(ti)
+            self._since += 1
+            if self._due(ti):
+                published.append((ti, self.result()))
+                self._since = 0
+                self._tLast = ti
+        return published
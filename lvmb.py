@@ -2,9 +2,47 @@
 
 """
 Simple interface to the Arduino Nano on the LWA voltage monitoring board
+
+The board either prints averaged, calibrated 240 VAC and 120 VAC voltages as
+text at 9600 baud or, with the firmware built with WAVEFORM_MODE, streams the
+raw ADC counts at WAVEFORM_BAUDRATE in binary frames of:
+  * 2-byte sync word (b'\\xa5\\x5a')
+  * 1-byte frame sequence number
+  * 1-byte number of samples in the frame
+  * 4-byte unsigned micros() time of the first sample
+  * 2-byte unsigned sample period in microseconds
+  * for each sample, 2-byte unsigned 240 VAC, 120 VAC, and reference counts
+  * 1-byte sum of all of the bytes after the sync word
+All values are little endian.  The counts are calibrated on the host.
 """
 
+import time
+import numpy
+import select
 import serial
+import struct
+import threading
+
+from lvmcal import BoardCalibration, DEFAULT_PROFILE
+
+
+# Serial baud rates for the two firmware modes
+BAUDRATE = 9600
+WAVEFORM_BAUDRATE = 115200
+
+# Time in seconds to back off when a port wakes up with nothing to read
+HANGUP_BACKOFF = 0.2
+
+# Waveform mode framing
+_FRAME_SYNC = b'\xa5\x5a'
+_FRAME_HEADER = struct.Struct('<2sBBIH')
+_FRAME_SAMPLE = struct.Struct('<3H')
+
+# Voltage across the reference divider in volts
+ADC_REFERENCE = DEFAULT_PROFILE['reference']
+
+# Calibration used when none is given
+_DEFAULT_CALIBRATION = BoardCalibration()
 
 
 class LVMBError(Exception):
@@ -18,50 +56,558 @@ class LVMBReadError(LVMBError):
     """
 
 
+def _parse_line(line):
+    """
+    Parse a line from the Arduino into a two-element tuple of 240 VAC and 120 VAC
+    voltages.
+    """
+    
+    try:
+        line = line.decode('ascii')
+    except AttributeError:
+        pass
+    line = line.replace('\x00', '')
+    v240, v120 = [round(float(v), 1) for v in line.split(None, 1)]
+    return v240, v120
+
+
+def _parse_block(data):
+    """
+    Parse a block of bytes from the Arduino that contains complete lines into
+    an N by 2 array of 240 VAC and 120 VAC voltages.  Returns the array and the
+    number of lines that could not be parsed.
+    """
+    
+    try:
+        data = data.decode('ascii', errors='replace')
+    except AttributeError:
+        pass
+    data = data.replace('\x00', '')
+    fields = [line.split() for line in data.splitlines()]
+    nLines = sum(1 for f in fields if f)
+    fields = [f for f in fields if len(f) == 2]
+    
+    try:
+        values = numpy.array(fields, dtype=numpy.float64)
+    except ValueError:
+        ## Something in there is not a number, fall back to doing it line by line
+        values = []
+        for f in fields:
+            try:
+                values.append((float(f[0]), float(f[1])))
+            except ValueError:
+                pass
+        values = numpy.array(values, dtype=numpy.float64)
+    values = numpy.round(values.reshape(-1, 2), 1)
+    
+    return values, nLines - values.shape[0]
+
+
+def calibrate(counts, reference):
+    """
+    Convert ADC counts and the matching reference counts into volts AC using
+    the firmware's calibration.  Works on scalars and arrays.
+    """
+    
+    return _DEFAULT_CALIBRATION.cal240.evaluate(counts, reference)
+
+
+def encode_frame(seq, micros, counts, period=1000):
+    """
+    Build a waveform mode frame the same way as the firmware from a sequence
+    number, the micros() time of the first sample, and an N by 3 array of
+    (240 VAC, 120 VAC, reference) ADC counts.
+    """
+    
+    counts = numpy.asarray(counts, dtype='<u2').reshape(-1, 3)
+    body = _FRAME_HEADER.pack(_FRAME_SYNC, seq & 0xFF, counts.shape[0], micros & 0xFFFFFFFF, period)[2:]
+    body += counts.tobytes()
+    return _FRAME_SYNC + body + bytes([sum(body) & 0xFF,])
+
+
+class FrameDecoder(object):
+    """
+    Incremental decoder for the waveform mode byte stream.  Bytes are passed
+    to feed() as they arrive and complete frames are turned into calibrated
+    (time, 240 VAC, 120 VAC) samples using the lvmcal.BoardCalibration
+    `calibration`, which can be replaced at any time.  Every `decimate`
+    consecutive samples are averaged in ADC counts before calibration, the
+    same way the text mode firmware averages its reads.
+    
+    The board's micros() clock is mapped onto UNIX time using the arrival
+    times of the frames.  Frames that fail the checksum are counted in
+    `bad_frames` and frames missing from the sequence in `dropped_frames`.
+    """
+    
+    def __init__(self, decimate=1, calibration=None):
+        self.decimate = max(1, int(decimate))
+        self.calibration = calibration if calibration is not None else _DEFAULT_CALIBRATION
+        
+        self.frames = 0
+        self.bad_frames = 0
+        self.dropped_frames = 0
+        self.skipped_bytes = 0
+        
+        self._buffer = b''
+        self._seq = None
+        self._micros = None
+        self._ticks = 0
+        self._offset = None
+        self._pending = numpy.zeros((0, 4), dtype=numpy.float64)
+        
+    def _frames(self):
+        """
+        Split the buffer into complete, valid frames and return a list of
+        (sequence number, micros, period, sample bytes) tuples.
+        """
+        
+        data = self._buffer
+        frames = []
+        start = 0
+        while True:
+            i = data.find(_FRAME_SYNC, start)
+            if i < 0:
+                ## Keep a possible partial sync word
+                keep = len(data) - 1 if data.endswith(_FRAME_SYNC[:1]) else len(data)
+                self.skipped_bytes += keep - start
+                start = keep
+                break
+            self.skipped_bytes += i - start
+            if i + _FRAME_HEADER.size > len(data):
+                start = i
+                break
+            sync, seq, count, micros, period = _FRAME_HEADER.unpack_from(data, i)
+            end = i + _FRAME_HEADER.size + count*_FRAME_SAMPLE.size + 1
+            if end > len(data):
+                start = i
+                break
+            if sum(data[i+2:end-1]) & 0xFF != data[end-1] or count == 0:
+                self.bad_frames += 1
+                start = i + 1
+                continue
+            frames.append((seq, micros, period, data[i+_FRAME_HEADER.size:end-1]))
+            start = end
+        self._buffer = data[start:]
+        return frames
+        
+    def feed(self, data, tArrive=None):
+        """
+        Add bytes read from the board at UNIX time `tArrive` (default: now)
+        and return an N by 3 array of the (time, 240 VAC, 120 VAC) samples that
+        they complete along with the number of samples that could not be
+        calibrated.
+        """
+        
+        if tArrive is None:
+            tArrive = time.time()
+        self._buffer += data
+        
+        payloads, starts, periods, sizes = [], [], [], []
+        for seq, micros, period, payload in self._frames():
+            self.frames += 1
+            if self._seq is not None:
+                self.dropped_frames += (seq - self._seq - 1) & 0xFF
+            self._seq = seq
+            
+            ## Unwrap the 32-bit microsecond clock
+            if self._micros is not None:
+                self._ticks += (micros - self._micros) & 0xFFFFFFFF
+            self._micros = micros
+            
+            payloads.append(payload)
+            starts.append(self._ticks)
+            periods.append(period)
+            sizes.append(len(payload) // _FRAME_SAMPLE.size)
+            
+        if not payloads:
+            return numpy.zeros((0, 3), dtype=numpy.float64), 0
+            
+        ## Unpack all of the frames at once and give each sample its time on
+        ## the board's clock
+        counts = numpy.frombuffer(b''.join(payloads), dtype='<u2').reshape(-1, 3)
+        sizes = numpy.array(sizes)
+        first = numpy.repeat(numpy.cumsum(sizes) - sizes, sizes)
+        block = numpy.empty((counts.shape[0], 4), dtype=numpy.float64)
+        block[:,0] = numpy.repeat(starts, sizes) + numpy.repeat(periods, sizes)*(numpy.arange(counts.shape[0]) - first)
+        block[:,0] *= 1e-6
+        block[:,1:] = counts
+        
+        ## Follow the board's clock.  A frame can arrive late but never before
+        ## its last sample was taken.
+        candidate = tArrive - block[-1,0]
+        if self._offset is None or candidate < self._offset:
+            self._offset = candidate
+        else:
+            self._offset += 0.01*(candidate - self._offset)
+            
+        ## Average in groups of `decimate` samples, holding back any leftovers
+        samples = numpy.concatenate([self._pending, block])
+        n = (samples.shape[0] // self.decimate) * self.decimate
+        samples, self._pending = samples[:n], samples[n:]
+        if self.decimate > 1:
+            samples = samples.reshape(-1, self.decimate, 4).mean(axis=1)
+            
+        ## Calibrate, dropping anything without a reference
+        good = samples[:,3] > 0
+        samples = samples[good]
+        output = numpy.empty((samples.shape[0], 3), dtype=numpy.float64)
+        output[:,0] = samples[:,0] + self._offset
+        output[:,1:] = self.calibration.convert(samples[:,1:])
+        
+        return output, good.size - samples.shape[0]
+
+
 class LVMB(object):
     """
     Simple tp4000zc.Dmm-like interface to the Arduino Nano running on the LWA 
     voltage monitoring board.
+    
+    If `threaded` is True a background thread reads the serial port as data
+    arrive and stores (time, 240 VAC, 120 VAC) samples in a ring buffer of
+    `buffer_size` entries.  The samples are then retrieved with the
+    non-blocking latest(), since(), and drain() methods instead of read().
+    Several boards can share a threading.Condition through `condition` so
+    that wait_any() can wake up as soon as any one of them has samples.
+    
+    If `waveform` is True the board is expected to run the waveform mode
+    firmware and the raw ADC frames are decoded and calibrated on the host
+    with the lvmcal.BoardCalibration `calibration`, averaging every
+    `decimate` samples.  read() is not available in this mode.
     """
-
-    def __init__(self, port='/dev/ttyUSB0', retries=3, timeout=1.0):
-        self.port = serial.Serial(port, baudrate=9600, timeout=timeout)
+    
+    def __init__(self, port='/dev/ttyUSB0', retries=3, timeout=1.0, threaded=False, buffer_size=4096, condition=None,
+                       waveform=False, decimate=1, calibration=None):
+        self.port = serial.Serial(port, baudrate=WAVEFORM_BAUDRATE if waveform else BAUDRATE, timeout=timeout)
         self.retries = retries # the number of times it's allowed to retry to get valid line
         
+        # Waveform mode
+        self.waveform = waveform
+        self._decoder = FrameDecoder(decimate=decimate, calibration=calibration) if waveform else None
+        
+        # Threaded mode
+        self.threaded = threaded
+        self.read_errors = 0
+        self.parse_errors = 0
+        self.overruns = 0
+        self._thread = None
+        
+        # Bulk reads
+        self._partial = b''
+        self._last_block = None
+        if self.threaded:
+            ## Sample ring buffer and counters
+            self._ring = numpy.zeros((buffer_size, 3), dtype=numpy.float64)
+            self._written = 0
+            self._drained = 0
+            self._cond = condition if condition is not None else threading.Condition()
+            
+            ## Offset that turns time.monotonic() into a UNIX timestamp
+            self._epoch = time.time() - time.monotonic()
+            
+            self._running = True
+            self._thread = threading.Thread(target=self._reader, name='LVMB-reader')
+            self._thread.daemon = True
+            self._thread.start()
+            
     def close(self):
         """
         Close out the serial connection to the Arduino.
         """
         
+        if self._thread is not None:
+            self._running = False
+            self._thread.join()
+            self._thread = None
+            
         self.port.close()
         
+    def set_calibration(self, calibration):
+        """
+        Switch to a new lvmcal.BoardCalibration for the waveform mode samples
+        that have not been decoded yet.
+        """
+        
+        if not self.waveform:
+            raise LVMBError("The calibration can only be set in waveform mode")
+        self._decoder.calibration = calibration
+        
+    def fileno(self):
+        """
+        Return the file descriptor of the serial connection so that the
+        device can be used with select/poll.
+        """
+        
+        return self.port.fileno()
+        
+    def wait(self, timeout=None):
+        """
+        Block until there is data waiting to be read from the Arduino or until
+        `timeout` seconds have elapsed.  Returns True if data are available.
+        In threaded mode this waits for samples that have not been drained.
+        """
+        
+        if self.threaded:
+            with self._cond:
+                return self._cond.wait_for(lambda: self._written > self._drained, timeout)
+                
+        if self.ready():
+            return True
+            
+        return len(_select([self,], timeout)) > 0
+        
+    def ready(self):
+        """
+        Return True if there is data that can be read without blocking.  In
+        threaded mode this checks for samples that have not been drained.
+        """
+        
+        if self.threaded:
+            return self._written > self._drained
+        try:
+            return self.port.in_waiting > 0
+        except (OSError, serial.serialutil.SerialException) as e:
+            self.read_errors += 1
+            raise LVMBReadError("Failed to check for voltages: %s" % str(e))
+            
+    def _reader(self):
+        """
+        Background thread that reads lines from the Arduino, stamps them with
+        their arrival time, and adds them to the ring buffer.
+        """
+        
+        if self.waveform:
+            self._frame_reader()
+            return
+            
+        size = self._ring.shape[0]
+        while self._running:
+            try:
+                line = self.port.readline()
+            except serial.serialutil.SerialException:
+                if not self._running:
+                    break
+                self.read_errors += 1
+                time.sleep(self.port.timeout or 1.0)
+                continue
+            tArrive = time.monotonic() + self._epoch
+            if not line:
+                continue
+                
+            try:
+                v240, v120 = _parse_line(line)
+            except (ValueError, IndexError):
+                self.parse_errors += 1
+                continue
+                
+            with self._cond:
+                self._ring[self._written % size] = (tArrive, v240, v120)
+                self._written += 1
+                self._cond.notify_all()
+                
+    def _frame_reader(self):
+        """
+        Background thread that reads waveform mode frames from the Arduino and
+        adds the samples to the ring buffer.
+        """
+        
+        size = self._ring.shape[0]
+        while self._running:
+            try:
+                data = self.port.read(max(1, self.port.in_waiting))
+            except (OSError, serial.serialutil.SerialException):
+                if not self._running:
+                    break
+                self.read_errors += 1
+                time.sleep(self.port.timeout or 1.0)
+                continue
+            if not data:
+                continue
+                
+            samples, nBad = self._decoder.feed(data, time.monotonic() + self._epoch)
+            self.parse_errors += nBad
+            if samples.shape[0] == 0:
+                continue
+                
+            with self._cond:
+                ## Anything that does not fit in the ring is lost before it
+                ## could ever be drained
+                if samples.shape[0] > size:
+                    self.overruns += samples.shape[0] - size
+                for sample in samples[-size:]:
+                    self._ring[self._written % size] = sample
+                    self._written += 1
+                self._cond.notify_all()
+                
+    def _copy(self, first):
+        """
+        Return a copy of the samples in the ring buffer from sample number
+        `first` up to the most recent one.  Must be called with the lock held.
+        """
+        
+        size = self._ring.shape[0]
+        first = max(first, self._written - size)
+        i, j = first % size, self._written % size
+        if self._written - first == 0:
+            return self._ring[:0].copy()
+        elif i < j:
+            return self._ring[i:j].copy()
+        else:
+            return numpy.concatenate([self._ring[i:], self._ring[:j]])
+            
+    def latest(self):
+        """
+        Return the most recent (time, 240 VAC, 120 VAC) sample as a tuple or
+        None if nothing has been read yet.  Only available in threaded mode.
+        """
+        
+        with self._cond:
+            if self._written == 0:
+                return None
+            return tuple(self._ring[(self._written - 1) % self._ring.shape[0]].tolist())
+            
+    def since(self, t):
+        """
+        Return an N by 3 array of the (time, 240 VAC, 120 VAC) samples still in
+        the ring buffer that arrived after time `t`.  Only available in threaded
+        mode.
+        """
+        
+        with self._cond:
+            samples = self._copy(0)
+        return samples[numpy.searchsorted(samples[:,0], t, side='right'):]
+        
+    def drain(self):
+        """
+        Return an N by 3 array of the (time, 240 VAC, 120 VAC) samples that have
+        arrived since the last call to drain().  Samples that were overwritten
+        before they could be drained are counted in the `overruns` attribute.
+        Only available in threaded mode.
+        """
+        
+        with self._cond:
+            lost = self._written - self._ring.shape[0] - self._drained
+            if lost > 0:
+                self.overruns += lost
+            samples = self._copy(self._drained)
+            self._drained = self._written
+        return samples
+        
     def read(self):
         """
         Read in the current 240 VAC and 120 VAC voltages and return as a two-
         element tuple.
         """
         
+        if self.threaded:
+            raise LVMBError("read() is not available in threaded mode, use latest(), since(), or drain()")
+        if self.waveform:
+            raise LVMBError("read() is not available in waveform mode, use read_block()")
+            
         success = False
-        e = None
+        error = None
         for attempt in range(self.retries):
             try:
                 line = self.port.readline()
-                try:
-                    line = line.decode('ascii')
-                except AttributeError:
-                    pass
-                line = line.replace('\x00', '')
-                v240, v120 = [round(float(v), 1) for v in line.split(None, 1)]
+                v240, v120 = _parse_line(line)
                 success = True
                 break
             except (serial.serialutil.SerialException, ValueError, IndexError) as e:
-                pass
+                error = e
                 
         if not success:
             msg = "Failed to read voltages"
-            if e is not None:
-                msg = "%s: %s" % (msg, str(e))
+            if error is not None:
+                msg = "%s: %s" % (msg, str(error))
             raise LVMBReadError(msg)
             
         return v240, v120
         
+    def read_block(self):
+        """
+        Read everything that is currently waiting on the serial port and return
+        an N by 3 array of (time, 240 VAC, 120 VAC) samples, one for each
+        complete line.  A partial line at the end is held until the next call.
+        The lines are assumed to have arrived evenly spaced in time since the
+        previous call.  In waveform mode there is one sample for each decoded
+        (and decimated) ADC sample, timed by the board's clock.  This never
+        waits for new data to arrive.
+        """
+        
+        if self.threaded:
+            raise LVMBError("read_block() is not available in threaded mode, use latest(), since(), or drain()")
+            
+        try:
+            data = self.port.read(self.port.in_waiting)
+        except (OSError, serial.serialutil.SerialException) as e:
+            self.read_errors += 1
+            raise LVMBReadError("Failed to read voltages: %s" % str(e))
+        tNow = time.time()
+        
+        if self.waveform:
+            block, nBad = self._decoder.feed(data, tNow)
+            self.parse_errors += nBad
+            return block
+            
+        data = self._partial + data
+        end = data.rfind(b'\n') + 1
+        data, self._partial = data[:end], data[end:]
+        
+        values, nBad = _parse_block(data)
+        self.parse_errors += nBad
+        
+        n = values.shape[0]
+        block = numpy.empty((n, 3), dtype=numpy.float64)
+        if self._last_block is None:
+            block[:,0] = tNow
+        else:
+            block[:,0] = self._last_block + (tNow - self._last_block) * numpy.arange(1, n+1) / n
+        block[:,1:] = values
+        if n > 0:
+            self._last_block = tNow
+            
+        return block
+
+
+def _select(meters, timeout=None):
+    """
+    Wait on the serial ports of a collection of unthreaded LVMB instances with
+    select() and return a list of the ones that have data waiting.  A port
+    that is readable but has nothing to read, i.e., a board that has hung
+    up, is not returned and causes a short back off so that callers do not
+    spin on it.
+    """
+    
+    try:
+        ready, _, _ = select.select([meter.port for meter in meters], [], [], timeout)
+    except (OSError, ValueError, serial.serialutil.SerialException) as e:
+        raise LVMBReadError("Failed to wait for voltages: %s" % str(e))
+        
+    woken = [meter for meter in meters if meter.port in ready]
+    ready = [meter for meter in woken if meter.ready()]
+    if woken and not ready:
+        time.sleep(HANGUP_BACKOFF if timeout is None else min(HANGUP_BACKOFF, timeout))
+    return ready
+
+
+def wait_any(meters, timeout=None):
+    """
+    Block until at least one of a collection of LVMB instances has data
+    waiting or until `timeout` seconds have elapsed and return a list of the
+    ones that are ready.  Threaded instances need to share a condition.  An
+    LVMBReadError is raised if one of the ports cannot be checked, i.e., if
+    the board has been unplugged.
+    """
+    
+    ready = [meter for meter in meters if meter.ready()]
+    if ready:
+        return ready
+        
+    threaded = [meter for meter in meters if meter.threaded]
+    if threaded:
+        if len(threaded) != len(meters) or len(set([id(meter._cond) for meter in threaded])) != 1:
+            raise LVMBError("wait_any() needs all threaded meters to share a condition")
+        with threaded[0]._cond:
+            threaded[0]._cond.wait_for(lambda: any([meter.ready() for meter in meters]), timeout)
+        return [meter for meter in meters if meter.ready()]
+        
+    return _select(meters, timeout)
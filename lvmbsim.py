@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Simulator for the Arduino Nano on the LWA voltage monitoring board.  This
+creates a pseudo-terminal that speaks the firmware's line protocol, or the
+framed raw ADC protocol of the waveform mode firmware, so that LVMB and
+voltageMonitor.py can be run without hardware.  The voltages can either be
+synthetic or be replayed from existing voltage_120.log and voltage_240.log
+files (including rotated .gz files).
+"""
+
+import os
+import tty
+import time
+import random
+import select
+import argparse
+import threading
+
+import numpy
+
+from lvmb import calibrate, encode_frame
+from lvmlogs import find_logs, open_log
+
+
+# Firmware output cadence in seconds
+LINE_PERIOD = 0.32
+
+# Waveform mode firmware sample period in seconds, samples per frame, and
+# reference counts
+WAVEFORM_PERIOD = 0.001
+WAVEFORM_FRAME = 32
+WAVEFORM_REFERENCE = 690
+
+# Voltage of each possible ADC count for turning voltages back into counts
+_COUNT_VOLTAGES = calibrate(numpy.arange(1024), WAVEFORM_REFERENCE)
+
+
+def to_counts(voltages, reference=WAVEFORM_REFERENCE):
+    """
+    Convert volts AC into the nearest ADC counts for a given reference count.
+    """
+    
+    table = _COUNT_VOLTAGES if reference == WAVEFORM_REFERENCE else calibrate(numpy.arange(1024), reference)
+    counts = numpy.interp(voltages, table, numpy.arange(1024))
+    return numpy.round(counts).astype(numpy.uint16)
+
+
+class Injection(object):
+    """
+    Voltage disturbance that starts `start` seconds into the replay and lasts
+    for `duration` seconds.  During the disturbance the voltages are scaled by
+    `factor`, i.e., 0.0 for an outage and 0.8 for a 20% sag.  `channels` is a
+    collection of '120V' and/or '240V'.
+    """
+    
+    __slots__ = ('start', 'duration', 'factor', 'channels')
+    
+    def __init__(self, start, duration, factor=0.0, channels=('120V', '240V')):
+        self.start = float(start)
+        self.duration = float(duration)
+        self.factor = float(factor)
+        self.channels = tuple(channels)
+        
+    def apply(self, offset, v240, v120):
+        """
+        Apply the disturbance to a pair of voltages `offset` seconds into the
+        replay.
+        """
+        
+        if self.start <= offset < self.start + self.duration:
+            if '240V' in self.channels:
+                v240 *= self.factor
+            if '120V' in self.channels:
+                v120 *= self.factor
+        return v240, v120
+
+
+def _read_log(filenames):
+    """
+    Generator of (time, voltage) pairs from a collection of voltage logs that
+    are given in chronological order.  Malformed lines are skipped.
+    """
+    
+    for filename in filenames:
+        with open_log(filename) as fh:
+            for line in fh:
+                try:
+                    t, v = line.split(None, 1)
+                    yield float(t), float(v)
+                except ValueError:
+                    pass
+
+
+def replay_samples(logs120, logs240):
+    """
+    Generator of (time, 240 VAC, 120 VAC) samples built by matching up the
+    timestamps in a set of 120 VAC and 240 VAC logs.
+    """
+    
+    r120 = _read_log(logs120)
+    r240 = _read_log(logs240)
+    try:
+        t120, v120 = next(r120)
+        t240, v240 = next(r240)
+        while True:
+            if t120 == t240:
+                yield t120, v240, v120
+                t120, v120 = next(r120)
+                t240, v240 = next(r240)
+            elif t120 < t240:
+                t120, v120 = next(r120)
+            else:
+                t240, v240 = next(r240)
+    except StopIteration:
+        pass
+
+
+def synthetic_samples(duration=None, v240=240.0, v120=120.0, noise=0.5, period=LINE_PERIOD):
+    """
+    Generator of (time, 240 VAC, 120 VAC) samples every `period` seconds with
+    a little bit of noise.  If `duration` is None the samples never end.
+    """
+    
+    t = time.time()
+    tEnd = None if duration is None else t + duration
+    while tEnd is None or t < tEnd:
+        yield t, v240 + random.gauss(0, noise), v120 + random.gauss(0, noise/2)
+        t += period
+
+
+class LVMBSimulator(object):
+    """
+    Pseudo-terminal based stand-in for the voltage monitoring board.  The
+    device to open with LVMB is available as the `port` attribute, or at
+    `link` if a symbolic link was requested.
+    
+    Lines are written with the original timing between samples divided by
+    `speedup`.  `injections` is a list of Injection instances and `garbage`
+    is the probability that any given line is corrupted with random bytes,
+    NULs, or truncation.  Lines that cannot be written because nobody is
+    reading the port are dropped and counted in `dropped`.  The wall clock
+    time at which the first sample was written is stored in `wall_start`.
+    
+    If `waveform` is True the samples are sent as ADC counts in waveform mode
+    frames of WAVEFORM_FRAME samples instead of as lines.  `sent`, `dropped`,
+    and `corrupted` then count frames.
+    """
+    
+    def __init__(self, samples, speedup=1.0, injections=None, garbage=0.0, link=None, seed=None, waveform=False):
+        self.samples = samples
+        self.speedup = float(speedup)
+        self.waveform = waveform
+        self.injections = list(injections or [])
+        self.garbage = float(garbage)
+        self.random = random.Random(seed)
+        
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.link = link
+        if self.link is not None:
+            if os.path.islink(self.link):
+                os.unlink(self.link)
+            os.symlink(self.port, self.link)
+            
+        self.wall_start = None
+        self.sent = 0
+        self.dropped = 0
+        self.corrupted = 0
+        self._running = False
+        self._thread = None
+        
+    def __enter__(self):
+        self.start()
+        return self
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        
+    def format_line(self, v240, v120):
+        """
+        Format a pair of voltages the same way as the firmware.
+        """
+        
+        return ("%.3f  %.3f\r\n" % (v240, v120)).encode('ascii')
+        
+    def format_frame(self, seq, t, v240, v120):
+        """
+        Encode the samples taken at times `t` (seconds since the start) with
+        voltages `v240` and `v120` as a waveform mode frame.
+        """
+        
+        counts = numpy.empty((len(t), 3), dtype=numpy.uint16)
+        counts[:,0] = to_counts(v240)
+        counts[:,1] = to_counts(v120)
+        counts[:,2] = WAVEFORM_REFERENCE
+        return encode_frame(seq, int(round(t[0]*1e6)), counts, period=int(round(WAVEFORM_PERIOD*1e6)))
+        
+    def _corrupt(self, line):
+        """
+        Corrupt a line with random bytes, NULs, or truncation.
+        """
+        
+        choice = self.random.randint(0, 2)
+        if choice == 0:
+            junk = bytes(self.random.randint(0, 255) for i in range(self.random.randint(1, 8)))
+            return junk + line
+        elif choice == 1:
+            return b'\x00'*self.random.randint(1, 4) + line
+        else:
+            return line[:self.random.randint(1, len(line)-2)] + b'\r\n'
+            
+    def _write(self, data, timeout=1.0):
+        """
+        Write data to the pseudo-terminal, giving up after `timeout` seconds if
+        nobody is reading it.
+        """
+        
+        while data:
+            _, ready, _ = select.select([], [self.master], [], timeout)
+            if not ready:
+                return False
+            n = os.write(self.master, data)
+            data = data[n:]
+        return True
+        
+    def run(self):
+        """
+        Replay all of the samples, returning when they are exhausted or when
+        stop() is called.
+        """
+        
+        self._running = True
+        tStart = wStart = None
+        frame = []
+        for t, v240, v120 in self.samples:
+            if not self._running:
+                break
+            if tStart is None:
+                tStart, wStart = t, time.time()
+                self.wall_start = wStart
+                
+            ## Wait until it is time for this sample, or for the last sample of
+            ## a frame in waveform mode
+            offset = t - tStart
+            delay = wStart + offset/self.speedup - time.time()
+            if delay > 0 and (not self.waveform or len(frame) == WAVEFORM_FRAME - 1):
+                time.sleep(delay)
+                
+            for injection in self.injections:
+                v240, v120 = injection.apply(offset, v240, v120)
+                
+            if self.waveform:
+                frame.append((offset, v240, v120))
+                if len(frame) < WAVEFORM_FRAME:
+                    continue
+                line = self.format_frame(self.sent + self.dropped, *zip(*frame))
+                frame = []
+            else:
+                line = self.format_line(v240, v120)
+            if self.garbage > 0 and self.random.random() < self.garbage:
+                line = self._corrupt(line)
+                self.corrupted += 1
+            if self._write(line):
+                self.sent += 1
+            else:
+                self.dropped += 1
+        self._running = False
+        
+    def start(self):
+        """
+        Start replaying the samples in a background thread.
+        """
+        
+        self._running = True
+        self._thread = threading.Thread(target=self.run, name='LVMBSimulator')
+        self._thread.daemon = True
+        self._thread.start()
+        
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+        
+    def stop(self):
+        """
+        Stop a background replay.
+        """
+        
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            
+    def close(self):
+        """
+        Stop the replay and tear down the pseudo-terminal.
+        """
+        
+        self.stop()
+        if self.link is not None and os.path.islink(self.link):
+            os.unlink(self.link)
+        os.close(self.master)
+        os.close(self.slave)
+
+
+def _parse_injection(value, factor=None):
+    """
+    Parse a 'START:DURATION[:FACTOR]' injection specification.
+    """
+    
+    fields = value.split(':')
+    if factor is None:
+        if len(fields) != 3:
+            raise argparse.ArgumentTypeError("expected START:DURATION:FACTOR")
+        factor = fields[2]
+    elif len(fields) != 2:
+        raise argparse.ArgumentTypeError("expected START:DURATION")
+    try:
+        return Injection(fields[0], fields[1], factor)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def main(args):
+    if args.log_directory is not None:
+        samples = replay_samples(find_logs(args.log_directory, 'voltage_120.log'),
+                                 find_logs(args.log_directory, 'voltage_240.log'))
+    else:
+        samples = synthetic_samples(duration=args.duration,
+                                    period=WAVEFORM_PERIOD if args.waveform else LINE_PERIOD)
+        
+    injections = list(args.outage) + list(args.sag)
+    sim = LVMBSimulator(samples, speedup=args.speedup, injections=injections,
+                        garbage=args.garbage, link=args.link, seed=args.seed,
+                        waveform=args.waveform)
+    print("Simulated voltage monitoring board on %s" % (args.link or sim.port))
+    try:
+        sim.run()
+    except KeyboardInterrupt:
+        print('')
+    sim.close()
+    unit = 'frames' if args.waveform else 'lines'
+    print("Sent %i %s, %i corrupted, %i dropped" % (sim.sent, unit, sim.corrupted, sim.dropped))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='simulate a LWA voltage monitoring board on a pseudo-terminal',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+            )
+    parser.add_argument('-l', '--log-directory', type=str,
+                        help='directory of voltage_120.log/voltage_240.log files to replay instead of synthetic data')
+    parser.add_argument('-d', '--duration', type=float,
+                        help='duration in seconds of the synthetic data; default is forever')
+    parser.add_argument('-s', '--speedup', type=float, default=1.0,
+                        help='replay speed-up factor')
+    parser.add_argument('-o', '--outage', type=lambda x: _parse_injection(x, factor=0.0), action='append', default=[],
+                        help='inject an outage at START:DURATION seconds into the replay; can be repeated')
+    parser.add_argument('-a', '--sag', type=_parse_injection, action='append', default=[],
+                        help='inject a sag at START:DURATION:FACTOR seconds into the replay; can be repeated')
+    parser.add_argument('-g', '--garbage', type=float, default=0.0,
+                        help='probability of corrupting any given line')
+    parser.add_argument('-k', '--link', type=str,
+                        help='create a symbolic link to the pseudo-terminal at this path')
+    parser.add_argument('-r', '--seed', type=int,
+                        help='random seed for line corruption')
+    parser.add_argument('-w', '--waveform', action='store_true',
+                        help='speak the framed raw ADC protocol of the waveform mode firmware')
+    args = parser.parse_args()
+    
+    main(args)
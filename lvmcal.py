@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+"""
+Host-side calibration of the raw ADC counts sent by the waveform mode
+firmware.  The board measures each line through a rectifier whose response is
+    VAC = slope*v + log_scale*ln(log_gain*v + 1) + offset
+where v is the ADC count ratioed to the count of the A7 reference input and
+scaled by the reference voltage.  Each set of constants is compiled into a
+lookup table indexed by ADC count so that converting a block of samples is a
+gather rather than a log() per sample.
+
+Calibration profiles live in the 'calibration' section of the configuration
+file and are picked for a board by its USB serial number, then by its serial
+port, and then by 'default'.  A profile can give one set of constants for both
+channels or separate '240V' and '120V' sets.
+"""
+
+import os
+import numpy
+
+try:
+    from serial.tools import list_ports
+except ImportError:
+    list_ports = None
+
+
+# Constants used by the original firmware
+DEFAULT_PROFILE = {'slope': 82.7226,
+                   'log_scale': 1.5002379,
+                   'log_gain': 233.034652422,
+                   'offset': 1.2749,
+                   'reference': 3.372,
+                   'reference_counts': 690}
+
+# Number of entries in the lookup tables, one per 10-bit ADC count
+TABLE_SIZE = 1024
+
+
+class Calibration(object):
+    """
+    Compiled calibration for one channel.  The lookup table holds the voltage
+    for each ADC count when the reference reads `reference_counts`.  Samples
+    taken at any other reference count are scaled onto the table and
+    interpolated between the neighboring entries.
+    """
+    
+    def __init__(self, slope=DEFAULT_PROFILE['slope'], log_scale=DEFAULT_PROFILE['log_scale'],
+                       log_gain=DEFAULT_PROFILE['log_gain'], offset=DEFAULT_PROFILE['offset'],
+                       reference=DEFAULT_PROFILE['reference'], reference_counts=DEFAULT_PROFILE['reference_counts']):
+        self.slope = float(slope)
+        self.log_scale = float(log_scale)
+        self.log_gain = float(log_gain)
+        self.offset = float(offset)
+        self.reference = float(reference)
+        self.reference_counts = float(reference_counts)
+        
+        self.table = self.evaluate(numpy.arange(TABLE_SIZE), self.reference_counts)
+        
+        ## Slope to the next entry, extrapolating past the end of the table
+        self._step = numpy.diff(self.table)
+        self._step = numpy.append(self._step, self._step[-1])
+        
+    @classmethod
+    def from_config(cls, profile):
+        """
+        Build a Calibration from a dictionary of constants, filling in any
+        that are missing from DEFAULT_PROFILE.
+        """
+        
+        unknown = set(profile.keys()) - set(DEFAULT_PROFILE.keys())
+        if unknown:
+            raise ValueError("Unknown calibration constant(s): %s" % ', '.join(sorted(unknown)))
+        constants = dict(DEFAULT_PROFILE)
+        constants.update(profile)
+        return cls(**constants)
+        
+    def evaluate(self, counts, reference):
+        """
+        Evaluate the calibration directly for ADC counts and the matching
+        reference counts.  Works on scalars and arrays.
+        """
+        
+        v = numpy.asarray(counts, dtype=numpy.float64) / reference * self.reference
+        return self.slope*v + self.log_scale*numpy.log1p(self.log_gain*v) + self.offset
+        
+    def convert(self, counts, reference):
+        """
+        Convert an array of (possibly averaged) ADC counts and the matching
+        reference counts into volts AC using the lookup table.
+        """
+        
+        x = numpy.asarray(counts, dtype=numpy.float64) * (self.reference_counts / reference)
+        i = x.astype(numpy.intp)
+        numpy.minimum(i, TABLE_SIZE-1, out=i)
+        return self.table.take(i) + (x - i)*self._step.take(i)
+
+
+class BoardCalibration(object):
+    """
+    Calibrations for the 240 VAC and 120 VAC channels of a board.  `name` is
+    the configuration key that the profile came from.
+    """
+    
+    def __init__(self, cal240=None, cal120=None, name='default'):
+        self.cal240 = cal240 if cal240 is not None else Calibration()
+        self.cal120 = cal120 if cal120 is not None else Calibration()
+        self.name = name
+        
+    @classmethod
+    def from_config(cls, profile, name='default'):
+        """
+        Build a BoardCalibration from a profile that either holds one set of
+        constants or '240V' and/or '120V' sets that override the shared ones.
+        """
+        
+        shared = dict([(k,v) for k,v in profile.items() if k not in ('240V', '120V')])
+        channels = []
+        for channel in ('240V', '120V'):
+            constants = dict(shared)
+            constants.update(profile.get(channel, {}))
+            channels.append(Calibration.from_config(constants))
+        return cls(*channels, name=name)
+        
+    def convert(self, samples):
+        """
+        Convert an N by 3 array of (240 VAC, 120 VAC, reference) ADC counts
+        into an N by 2 array of 240 VAC and 120 VAC voltages.
+        """
+        
+        output = numpy.empty((samples.shape[0], 2), dtype=numpy.float64)
+        output[:,0] = self.cal240.convert(samples[:,0], samples[:,2])
+        output[:,1] = self.cal120.convert(samples[:,1], samples[:,2])
+        return output
+
+
+def serial_number(port):
+    """
+    Return the USB serial number of the device behind a serial port, following
+    any symbolic links such as the udev /dev/arduino link, or None if it
+    cannot be found.
+    """
+    
+    if list_ports is None:
+        return None
+    device = os.path.realpath(port)
+    for info in list_ports.comports():
+        if info.device == device:
+            return info.serial_number
+    return None
+
+
+def load_calibration(config, port):
+    """
+    Return the BoardCalibration for the board on `port` from the
+    'calibration' section of a configuration dictionary.
+    """
+    
+    profiles = config.get('calibration', {})
+    for key in (serial_number(port), port, 'default'):
+        if key is not None and key in profiles:
+            return BoardCalibration.from_config(profiles[key], name=key)
+    return BoardCalibration()
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+"""
+Flicker/outage/clear event detection for an arbitrary number of monitored
+voltage channels.
+
+A channel goes out of tolerances after `debounce` consecutive samples fall
+outside of its limits and only comes back after `debounce` consecutive
+samples are inside of its limits narrowed by `hysteresis` volts so that a
+voltage hovering around a limit does not chatter.  The engine is a streaming
+state machine that produces the same events no matter how the samples are
+split into blocks, which makes it usable both live and in bulk over
+historical logs.
+"""
+
+import numpy
+
+
+# Event types
+EVENT_RANGE = 'RANGE'
+EVENT_FLICKER = 'FLICKER'
+EVENT_FLICKER_CLEAR = 'FLICKER_CLEAR'
+EVENT_OUTAGE = 'OUTAGE'
+EVENT_CLEAR = 'CLEAR'
+
+
+class LineEvent(object):
+    """
+    A single event on a monitored channel.  `age` is the time in seconds that
+    the channel had been out of tolerances when the event fired and `value` is
+    the voltage that triggered it.
+    """
+    
+    __slots__ = ('t', 'channel', 'name', 'kind', 'value', 'age')
+    
+    def __init__(self, t, channel, name, kind, value, age=0.0):
+        self.t = t
+        self.channel = channel
+        self.name = name
+        self.kind = kind
+        self.value = value
+        self.age = age
+        
+    def __repr__(self):
+        return "<%s %s %s at %.3f>" % (type(self).__name__, self.kind, self.name, self.t)
+
+
+class EventEngine(object):
+    """
+    Per-channel flicker/outage/clear state machine.  The limits and event time
+    scales are fixed when the engine is created and the state of all channels
+    is held in NumPy arrays so that each sample is processed across every
+    channel at once.  A channel that is not in an event is marked with NaN in
+    the `start`, `flicker`, and `outage` arrays.  `out` holds the debounced
+    out of tolerances state of each channel and `run` and `runStart` the
+    length and start time of the current run of samples that argue for
+    changing it.
+    
+    Stretches of samples in which nothing can change are skipped over
+    without stepping the state machine.  If `range_events` is False no
+    EVENT_RANGE events are generated which speeds up bulk processing of long
+    outages.
+    """
+    
+    __slots__ = ('names', 'low', 'high', 'hysteresis', 'debounce', 'tFlicker', 'tOutage', 'tClear',
+                 'range_events', 'start', 'flicker', 'outage', 'out', 'run', 'runStart')
+                 
+    def __init__(self, names, low, high, flicker=0.0, outage=0.5, clear=300.0, hysteresis=0.0, debounce=1,
+                       range_events=True):
+        self.names = tuple(names)
+        nchan = len(self.names)
+        
+        self.low = numpy.array(low, dtype=numpy.float64).reshape(nchan)
+        self.high = numpy.array(high, dtype=numpy.float64).reshape(nchan)
+        self.hysteresis = numpy.broadcast_to(numpy.array(hysteresis, dtype=numpy.float64), (nchan,)).copy()
+        self.debounce = max(1, int(debounce))
+        self.tFlicker = float(flicker)
+        self.tOutage = float(outage)
+        self.tClear = float(clear)
+        self.range_events = range_events
+        
+        self.start = numpy.full(nchan, numpy.nan)
+        self.flicker = numpy.full(nchan, numpy.nan)
+        self.outage = numpy.full(nchan, numpy.nan)
+        self.out = numpy.zeros(nchan, dtype=bool)
+        self.run = numpy.zeros(nchan, dtype=numpy.int64)
+        self.runStart = numpy.full(nchan, numpy.nan)
+        
+    @classmethod
+    def from_config(cls, config, names, **kwds):
+        """
+        Build an engine for the named channels using the 'limits' and 'events'
+        sections of a voltageMonitor configuration dictionary.  A channel
+        from a board with a channel prefix, i.e., 'B2-120V', that does not
+        have limits of its own uses those of the channel it ends with.  The
+        hysteresis can be set for all channels in 'events' or for a single
+        channel in its limits.  Any keywords are passed on to the engine.
+        """
+        
+        limits = []
+        for name in names:
+            try:
+                limits.append(config['limits'][name])
+            except KeyError:
+                base = [key for key in config['limits'] if name.endswith(key)]
+                if not base:
+                    raise
+                limits.append(config['limits'][max(base, key=len)])
+        low = [limit['low'] for limit in limits]
+        high = [limit['high'] for limit in limits]
+        hysteresis = [limit.get('hysteresis', config['events'].get('hysteresis', 0.0)) for limit in limits]
+        return cls(names, low, high, flicker=config['events']['flicker'],
+                   outage=config['events']['outage'], clear=config['events']['clear'],
+                   hysteresis=hysteresis, debounce=config['events'].get('debounce', 1), **kwds)
+                   
+    @property
+    def nchan(self):
+        return len(self.names)
+        
+    def index(self, name):
+        """
+        Return the channel index for the given channel name.
+        """
+        
+        return self.names.index(name)
+        
+    def restore(self, channel, tStart, tRestart):
+        """
+        Put a channel back into an outage that started at `tStart` and that
+        was restored from disk at `tRestart`.
+        """
+        
+        self.start[channel] = tStart
+        self.flicker[channel] = tRestart
+        self.outage[channel] = tRestart
+        
+    def in_outage(self, channel):
+        """
+        Return whether or not the specified channel is currently in an outage.
+        """
+        
+        return not numpy.isnan(self.outage[channel])
+        
+    def is_idle(self):
+        """
+        Return True if none of the channels are currently in an event or
+        counting towards one.
+        """
+        
+        return numpy.isnan(self.start).all() \
+               and numpy.isnan(self.flicker).all() \
+               and numpy.isnan(self.outage).all() \
+               and not self.out.any() \
+               and not self.run.any()
+               
+    def _step(self, t, v, bad, inside, events):
+        """
+        Advance the state of all channels by a single sample at time `t`.
+        `bad` marks the channels outside of their limits and `inside` those
+        inside of their limits less the hysteresis.
+        """
+        
+        start, flicker, outage = self.start, self.flicker, self.outage
+        out, run, runStart = self.out, self.run, self.runStart
+        
+        if self.range_events:
+            for c in numpy.flatnonzero(bad):
+                events.append(LineEvent(t, c, self.names[c], EVENT_RANGE, v[c]))
+                
+        # Debounce - a channel changes state after `debounce` samples in a
+        # row that argue for it
+        toward = numpy.where(out, inside, bad)
+        runStart[toward & (run == 0)] = t
+        run[toward] += 1
+        run[~toward] = 0
+        changed = run >= self.debounce
+        out[changed] = ~out[changed]
+        run[changed] = 0
+        
+        begun = out & numpy.isnan(start)
+        start[begun] = runStart[begun]
+        good = ~out
+        
+        # Clear flickers and outages on channels that are back within limits
+        cleared = good & (t - flicker >= self.tOutage)
+        for c in numpy.flatnonzero(cleared):
+            events.append(LineEvent(t, c, self.names[c], EVENT_FLICKER_CLEAR, v[c]))
+        flicker[cleared] = numpy.nan
+        
+        cleared = good & (t - outage >= self.tClear)
+        for c in numpy.flatnonzero(cleared):
+            events.append(LineEvent(t, c, self.names[c], EVENT_CLEAR, v[c]))
+        outage[cleared] = numpy.nan
+        
+        start[good & numpy.isnan(flicker) & numpy.isnan(outage)] = numpy.nan
+        
+        # Look for new flickers and outages
+        age = t - start
+        fired = numpy.isnan(flicker) & (age >= self.tFlicker) & (age < self.tOutage)
+        for c in numpy.flatnonzero(fired):
+            events.append(LineEvent(t, c, self.names[c], EVENT_FLICKER, v[c], age[c]))
+        flicker[fired] = start[fired]
+        
+        fired = numpy.isnan(outage) & (age >= self.tOutage)
+        for c in numpy.flatnonzero(fired):
+            events.append(LineEvent(t, c, self.names[c], EVENT_OUTAGE, v[c], age[c]))
+        outage[fired] = start[fired]
+        
+    def _next_step(self, i, t, badAt, insideAt):
+        """
+        Return the index of the first sample at or after `i` that can change
+        the state of any channel.  `badAt` and `insideAt` are the sorted
+        sample indices that are outside of the limits and inside of the
+        limits less the hysteresis for each channel.  Times are looked up one
+        sample early so that rounding can only cause an extra step.
+        """
+        
+        n = t.size
+        nxt = n
+        for c in range(self.nchan):
+            if self.run[c] > 0:
+                return i
+                
+            times = []
+            if self.out[c]:
+                ## Waiting to come back or to age into a flicker or outage
+                at = insideAt[c]
+                if numpy.isnan(self.flicker[c]):
+                    k = max(numpy.searchsorted(t, self.start[c] + self.tFlicker), i)
+                    if k < n and t[k] - self.start[c] < self.tOutage:
+                        times.append(self.start[c] + self.tFlicker)
+                if numpy.isnan(self.outage[c]):
+                    times.append(self.start[c] + self.tOutage)
+            else:
+                ## Waiting to go out or for a flicker or outage to clear
+                at = badAt[c]
+                if not numpy.isnan(self.flicker[c]):
+                    times.append(self.flicker[c] + self.tOutage)
+                if not numpy.isnan(self.outage[c]):
+                    times.append(self.outage[c] + self.tClear)
+                    
+            k = numpy.searchsorted(at, i)
+            if k < at.size:
+                nxt = min(nxt, at[k])
+            for tNext in times:
+                nxt = min(nxt, max(numpy.searchsorted(t, tNext) - 1, i))
+        return nxt
+        
+    def _range_events(self, t, values, bad, events):
+        """
+        Generate the EVENT_RANGE events for a stretch of samples that cannot
+        change the state of any channel.
+        """
+        
+        for r,c in zip(*numpy.nonzero(bad)):
+            events.append(LineEvent(t[r], c, self.names[c], EVENT_RANGE, values[r,c]))
+            
+    def process(self, t, values):
+        """
+        Process a block of samples and return a list of LineEvent instances in
+        the order in which they occurred.  `t` is either a scalar or a 1-D
+        array of sample times and `values` is an array of voltages with shape
+        (nsample, nchan) or (nchan,) for a single sample.
+        """
+        
+        t = numpy.atleast_1d(numpy.asarray(t, dtype=numpy.float64))
+        values = numpy.asarray(values, dtype=numpy.float64).reshape(t.size, self.nchan)
+        
+        bad = (values < self.low) | (values > self.high)
+        inside = (values >= self.low + self.hysteresis) & (values <= self.high - self.hysteresis)
+        badAt = [numpy.flatnonzero(bad[:,c]) for c in range(self.nchan)]
+        insideAt = [numpy.flatnonzero(inside[:,c]) for c in range(self.nchan)]
+        
+        events = []
+        i, n = 0, t.size
+        while i < n:
+            j = self._next_step(i, t, badAt, insideAt)
+            if self.range_events and j > i:
+                self._range_events(t[i:j], values[i:j], bad[i:j], events)
+            if j >= n:
+                break
+                
+            self._step(t[j], values[j], bad[j], inside[j], events)
+            i = j + 1
+            
+        return events
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Bulk loader for whole voltage_120.log and voltage_240.log files, including the
+gzipped copies rotated by logrotate.  The logs are streamed through the
+decompressor in large blocks and each block is handed to lvmlogs.parse_block(),
+which writes the times and voltages straight into a preallocated structured
+array.  Lines that cannot be parsed are skipped and, optionally, reported.
+
+The result of loading a log is cached as a binary file in the '.index'
+directory kept by lvmlogs so that a second load is just a memory map.  The
+caches are named like the indexes, after the log and the time of its first
+line, so they follow the log through logrotate's renames, and the cache for a
+log that is still being appended to is extended rather than rebuilt.
+"""
+
+import os
+import glob
+import time
+import zlib
+import numpy
+import struct
+import argparse
+import tempfile
+
+from lvmlogs import INDEX_DIR, KIND_TEXT, KIND_GZIP, LOG_DTYPE, find_logs, first_time, cache_filename, \
+                    parse_block, _log_kind
+
+
+# Size of the blocks that are decompressed and parsed at once
+BLOCK_SIZE = 1024*1024
+
+# Cache layout
+_CACHE_MAGIC = b'LVMC'
+_CACHE_VERSION = 1
+_CACHE_HEADER = struct.Struct('<4sBBxxqqqq32x')
+
+
+def _blocks(filename, offset=0, size=BLOCK_SIZE, partial_line=True):
+    """
+    Generator of blocks of about `size` bytes of complete lines from a plain or
+    gzipped log, starting at byte `offset` of a plain log.  The last block
+    includes any trailing partial line unless `partial_line` is False.
+    Yields (block, end offset in the uncompressed data) tuples.
+    """
+    
+    gzipped = _log_kind(filename) == KIND_GZIP
+    with open(filename, 'rb') as fh:
+        fh.seek(offset)
+        decomp = zlib.decompressobj(31)
+        partial = b''
+        while True:
+            data = fh.read(size // 4 if gzipped else size)
+            if not data:
+                break
+            if gzipped:
+                ## Handle logs made up of several gzip members
+                out = []
+                while data:
+                    out.append(decomp.decompress(data))
+                    if decomp.eof:
+                        data = decomp.unused_data
+                        decomp = zlib.decompressobj(31)
+                    else:
+                        data = b''
+                data = b''.join(out)
+                
+            data = partial + data
+            end = data.rfind(b'\n') + 1
+            data, partial = data[:end], data[end:]
+            offset += len(data)
+            if data:
+                yield data, offset
+        if partial and partial_line:
+            offset += len(partial)
+            yield partial + b'\n', offset
+
+
+def _grow(out, needed):
+    """
+    Return `out` resized so that it can hold at least `needed` samples.
+    """
+    
+    if needed <= out.size:
+        return out
+    grown = numpy.empty(max(needed, int(out.size*1.5)), dtype=LOG_DTYPE)
+    grown[:out.size] = out
+    return grown
+
+
+def _estimate(filename):
+    """
+    Estimate the number of lines in a log from its size.
+    """
+    
+    size = os.path.getsize(filename)
+    if _log_kind(filename) == KIND_GZIP:
+        size *= 6
+    return size // 20 + 1024
+
+
+def parse_log(filename, offset=0, lineno=1, errors=None, partial_line=True):
+    """
+    Parse a whole plain or gzipped log, or a plain log from byte `offset` and
+    line number `lineno` on, and return a LOG_DTYPE array of the samples
+    along with the number of uncompressed bytes and lines read.  See
+    parse_block() for `errors` and _blocks() for `partial_line`.
+    """
+    
+    out = numpy.empty(_estimate(filename), dtype=LOG_DTYPE)
+    n, nline, consumed = 0, 0, offset
+    for data, consumed in _blocks(filename, offset=offset, partial_line=partial_line):
+        lines = data.count(b'\n')
+        out = _grow(out, n + lines)
+        n += parse_block(data, out[n:], errors=errors, lineno=lineno+nline)[0]
+        nline += lines
+    return out[:n], consumed - offset, nline
+
+
+def _read_cache(cachename):
+    """
+    Return the header fields and a read-only memory map of the samples in a
+    cache file, or None if it is missing or invalid.
+    """
+    
+    try:
+        with open(cachename, 'rb') as fh:
+            header = fh.read(_CACHE_HEADER.size)
+        magic, version, kind, size, consumed, nline, nsamp = _CACHE_HEADER.unpack(header)
+    except (OSError, IOError, struct.error):
+        return None
+    if magic != _CACHE_MAGIC or version != _CACHE_VERSION:
+        return None
+    if os.path.getsize(cachename) != _CACHE_HEADER.size + nsamp*LOG_DTYPE.itemsize:
+        return None
+    if nsamp == 0:
+        samples = numpy.zeros(0, dtype=LOG_DTYPE)
+    else:
+        samples = numpy.memmap(cachename, dtype=LOG_DTYPE, mode='r', offset=_CACHE_HEADER.size, shape=(nsamp,))
+    return (kind, size, consumed, nline), samples
+
+
+def _write_cache(cachename, kind, size, consumed, nline, blocks):
+    """
+    Atomically write a cache file from a list of LOG_DTYPE arrays.
+    """
+    
+    dirname = os.path.dirname(cachename)
+    if not os.path.exists(dirname):
+        os.mkdir(dirname)
+    nsamp = sum([block.size for block in blocks])
+    fd, tempname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(_CACHE_HEADER.pack(_CACHE_MAGIC, _CACHE_VERSION, kind, size, consumed, nline, nsamp))
+            for block in blocks:
+                fh.write(memoryview(numpy.ascontiguousarray(block)).cast('B'))
+        os.chmod(tempname, 0o644)
+        os.rename(tempname, cachename)
+    except Exception:
+        os.unlink(tempname)
+        raise
+
+
+def load_log(filename, cache=True, errors=None):
+    """
+    Load a whole plain or gzipped log and return a LOG_DTYPE array of its
+    samples.  If `cache` is True the samples come from, or are saved to, the
+    log's cache file, in which case the array is a read-only memory map, a
+    partial last line of a plain log is left for the next load, and lines
+    that could not be parsed are only reported (see parse_block() for
+    `errors`) when they are first read.
+    """
+    
+    if not cache:
+        return parse_log(filename, errors=errors)[0]
+        
+    tFirst = first_time(filename)
+    if tFirst is None:
+        return numpy.zeros(0, dtype=LOG_DTYPE)
+    cachename = cache_filename(filename, tFirst=tFirst)
+    kind, size = _log_kind(filename), os.path.getsize(filename)
+    partial_line = kind == KIND_GZIP
+    
+    cached = _read_cache(cachename)
+    if cached is not None:
+        (cKind, cSize, consumed, nline), samples = cached
+        if cKind == kind and cSize == size:
+            return samples
+        if cKind == kind == KIND_TEXT and consumed <= size:
+            ## The log has grown, parse only what was added
+            added, length, lines = parse_log(filename, offset=consumed, lineno=nline+1, errors=errors,
+                                             partial_line=partial_line)
+            blocks, consumed, nline = [samples, added], consumed + length, nline + lines
+        else:
+            cached = None
+    if cached is None:
+        samples, consumed, nline = parse_log(filename, errors=errors, partial_line=partial_line)
+        blocks = [samples,]
+        
+    try:
+        _write_cache(cachename, kind, size, consumed, nline, blocks)
+    except (OSError, IOError):
+        return numpy.concatenate(blocks)
+    return _read_cache(cachename)[1]
+
+
+def load_logs(log_directory, name, cache=True, errors=None):
+    """
+    Load the current and rotated copies of the log `name`, i.e.,
+    'voltage_240.log', and return a single LOG_DTYPE array in chronological
+    order.  Cache files for logs that no longer exist are removed.  See
+    load_log() for `cache` and `errors` except that the entries added to
+    `errors` are (filename, line number, line) tuples.
+    """
+    
+    filenames = find_logs(log_directory, name)
+    blocks, keep = [], set()
+    for filename in filenames:
+        bad = []
+        blocks.append(load_log(filename, cache=cache, errors=bad))
+        if errors is not None:
+            errors.extend([(filename,)+entry for entry in bad])
+        if cache:
+            cachename = cache_filename(filename)
+            if cachename is not None:
+                keep.add(os.path.basename(cachename))
+                
+    if cache:
+        prefix = name.split('.log', 1)[0]
+        for cachename in glob.glob(os.path.join(log_directory, INDEX_DIR, '%s-*.cache' % prefix)):
+            if os.path.basename(cachename) not in keep:
+                os.unlink(cachename)
+                
+    if not blocks:
+        return numpy.zeros(0, dtype=LOG_DTYPE)
+    return numpy.concatenate(blocks)
+
+
+def main(args):
+    for name in args.names:
+        errors = []
+        t0 = time.time()
+        samples = load_logs(args.log_directory, name, cache=not args.no_cache, errors=errors)
+        elapsed = time.time() - t0
+        print("%s: %i samples in %.3f s, %i malformed lines" % (name, samples.size, elapsed, len(errors)))
+        for filename,lineno,line in errors[:args.report]:
+            print("  %s, line %i: %r" % (os.path.basename(filename), lineno, line))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='load, and cache, whole voltage logs written by voltageMonitor.py',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+            )
+    parser.add_argument('-l', '--log-directory', type=str, default='/lwa/LineMonitoring/logs/',
+                        help='directory containing the voltage logs')
+    parser.add_argument('-n', '--no-cache', action='store_true',
+                        help='do not use or update the binary cache')
+    parser.add_argument('-r', '--report', type=int, default=10,
+                        help='maximum number of malformed lines to print for each log')
+    parser.add_argument('names', type=str, nargs='*', default=['voltage_120.log', 'voltage_240.log'],
+                        help='logs to load')
+    args = parser.parse_args()
+    
+    main(args)
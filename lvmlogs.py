@@ -0,0 +1,694 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Utilities for working with the voltage_120.log and voltage_240.log files
+written by voltageMonitor.py, including the copies rotated (and gzipped) by
+logrotate.
+
+Each log can have a sidecar index that maps times to byte offsets so that any
+time window can be read without scanning the whole file.  The indexes live in
+an '.index' directory next to the logs and are named after the log and the
+time of its first line, so they follow the log through logrotate's renames.
+For plain text logs the index points at line starts.  For gzipped logs a copy
+of the file is written to the index directory as a series of independent gzip
+members (still a valid .gz file) and the index points at the start of each
+member in that copy.  The rotated log itself is never modified.
+
+The lines are parsed in bulk by parse_block(), which is shared with the whole
+log loader in lvmload.
+"""
+
+import os
+import re
+import glob
+import gzip
+import zlib
+import numpy
+import shutil
+import struct
+import argparse
+import tempfile
+from datetime import datetime
+
+
+# Index location and layout
+INDEX_DIR = '.index'
+INDEX_STEP = 65536
+_INDEX_MAGIC = b'LVMI'
+_INDEX_VERSION = 2
+_INDEX_HEADER = struct.Struct('<4sBBxxq')
+_INDEX_ENTRY = struct.Struct('<dq')
+
+# Log kinds
+KIND_TEXT = 0
+KIND_GZIP = 1
+
+# Parsed sample layout
+LOG_DTYPE = numpy.dtype([('t', '<f8'), ('v', '<f8')])
+
+# Longest number of digits in a field that is parsed exactly and the longest
+# line that is parsed in bulk
+_MAX_DIGITS = 15
+_MAX_LINE = 64
+
+# A plain decimal number field
+_FIELD_RE = re.compile(br'[0-9.]+')
+
+
+def find_logs(log_directory, name):
+    """
+    Find the current and rotated copies of a voltage log, i.e., 'voltage_120.log',
+    in a directory and return them in chronological order.
+    """
+    
+    def _rotation(filename):
+        mtch = re.search(r'\.log\.(\d+)(\.gz)?$', filename)
+        if mtch is None:
+            return 0
+        return int(mtch.group(1), 10)
+        
+    filenames = glob.glob(os.path.join(log_directory, name+'*'))
+    filenames = [f for f in filenames if re.search(r'\.log(\.\d+)?(\.gz)?$', f)]
+    filenames.sort(key=_rotation, reverse=True)
+    return filenames
+
+
+def open_log(filename, mode='rt'):
+    """
+    Open a voltage log for reading, decompressing it if needed.
+    """
+    
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode)
+    return open(filename, mode)
+
+
+def _log_kind(filename):
+    return KIND_GZIP if filename.endswith('.gz') else KIND_TEXT
+
+
+def _template(line):
+    """
+    Work out how to parse every line laid out like `line`, i.e., with the
+    digits and the other characters in the same places.  Returns a list of
+    (digit columns, digit weights, decimal places) tuples, one for each of
+    the two numbers on the line, or None if the line is not two plain
+    decimal numbers separated by whitespace.
+    """
+    
+    fields = list(_FIELD_RE.finditer(line))
+    if len(fields) != 2 or _FIELD_RE.sub(b'', line).strip(b' \t\r'):
+        return None
+        
+    layout = []
+    for field in fields:
+        text = field.group()
+        digits = [field.start()+i for i,c in enumerate(text) if c != ord('.')]
+        if text.count(b'.') > 1 or not 1 <= len(digits) <= _MAX_DIGITS:
+            return None
+        weights = 10**numpy.arange(len(digits)-1, -1, -1, dtype=numpy.int64)
+        decimals = len(text) - text.index(b'.') - 1 if b'.' in text else 0
+        layout.append((numpy.array(digits), weights, decimals))
+    return layout
+
+
+def parse_block(data, out, errors=None, lineno=0):
+    """
+    Parse a block of complete '%.2f  %.1f' lines into the LOG_DTYPE array
+    `out`, which needs to have room for at least one sample per line.
+    Returns the number of samples written and the number of lines that could
+    not be parsed.  If `errors` is a list, (line number, line) tuples for the
+    lines that could not be parsed are appended to it using line numbers
+    that start at `lineno`.  Blank lines are ignored.
+    
+    Lines are parsed in bulk by length:  all lines of a given length that
+    have their digits in the same places as the first one are turned into
+    numbers with a single integer dot product over their digit columns.  The
+    result is exact, i.e., the same as float(), since both the digits and the
+    power of ten they are divided by are exactly representable.  Anything
+    else is handed to float() one line at a time.
+    """
+    
+    if not data:
+        return 0, 0
+    if not data.endswith(b'\n'):
+        data += b'\n'
+    b = numpy.frombuffer(data, dtype=numpy.uint8)
+    lineEnd = numpy.flatnonzero(b == ord('\n'))
+    lineStart = numpy.empty_like(lineEnd)
+    lineStart[0] = 0
+    lineStart[1:] = lineEnd[:-1] + 1
+    length = lineEnd - lineStart
+    nline = lineEnd.size
+    
+    keep = numpy.zeros(nline, dtype=bool)
+    slow = [numpy.flatnonzero(length > _MAX_LINE)]
+    for size in numpy.flatnonzero(numpy.bincount(length[length <= _MAX_LINE])):
+        idx = numpy.flatnonzero(length == size)
+        rows = b[lineStart[idx,None] + numpy.arange(size)]
+        while idx.size:
+            ## Split off the lines that look like the first one
+            first = rows[0]
+            isDigit = rows - numpy.uint8(ord('0')) < 10
+            tmplDigit = first - numpy.uint8(ord('0')) < 10
+            same = ((rows == first) | (isDigit & tmplDigit)).all(axis=1)
+            layout = _template(first.tobytes())
+            if layout is None:
+                slow.append(idx[same])
+            else:
+                for column,(digits, weights, decimals) in zip(('t', 'v'), layout):
+                    mantissa = (rows[same][:,digits] - numpy.uint8(ord('0'))) @ weights
+                    out[column][idx[same]] = mantissa / 10.0**decimals
+                keep[idx[same]] = True
+            idx, rows = idx[~same], rows[~same]
+            
+    # Anything left over goes through float()
+    nBad = 0
+    for i in numpy.sort(numpy.concatenate(slow)):
+        line = data[lineStart[i]:lineEnd[i]]
+        fields = line.split()
+        if not fields:
+            continue
+        try:
+            t, v = fields
+            out[i] = float(t), float(v)
+            keep[i] = True
+        except ValueError:
+            nBad += 1
+            if errors is not None:
+                errors.append((lineno + int(i), line.decode('ascii', errors='replace')))
+                
+    if keep.all():
+        return nline, nBad
+    n = int(keep.sum())
+    out[:n] = out[:nline][keep]
+    return n, nBad
+
+
+def _parse_lines(data):
+    """
+    Parse a block of complete log lines into an N by 2 array of (time, voltage)
+    values.  Malformed lines are skipped.
+    """
+    
+    out = numpy.empty(data.count(b'\n') + 1, dtype=LOG_DTYPE)
+    n = parse_block(data, out)[0]
+    return out[:n].view(numpy.float64).reshape(-1, 2)
+
+
+def _line_time(line):
+    """
+    Return the timestamp of a log line or None if it cannot be parsed.
+    """
+    
+    try:
+        return float(line.split(None, 1)[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def first_time(filename):
+    """
+    Return the timestamp of the first valid line in a log or None if there
+    are none.
+    """
+    
+    with open_log(filename, 'rb') as fh:
+        for line in fh:
+            t = _line_time(line)
+            if t is not None:
+                return t
+    return None
+
+
+def index_filename(filename, tFirst=None):
+    """
+    Return the name of the sidecar index for a log, or None if the log is
+    empty.
+    """
+    
+    if tFirst is None:
+        tFirst = first_time(filename)
+        if tFirst is None:
+            return None
+    prefix = os.path.basename(filename).split('.log', 1)[0]
+    return os.path.join(os.path.dirname(filename), INDEX_DIR, '%s-%.2f.idx' % (prefix, tFirst))
+
+
+def chunked_filename(filename, tFirst=None):
+    """
+    Return the name of the re-chunked copy of a gzipped log that its index
+    points into, or None if the log is empty.
+    """
+    
+    indexname = index_filename(filename, tFirst=tFirst)
+    if indexname is None:
+        return None
+    return indexname[:-4] + '.gz'
+
+
+def cache_filename(filename, tFirst=None):
+    """
+    Return the name of the binary copy of a whole log kept by lvmload, or
+    None if the log is empty.
+    """
+    
+    indexname = index_filename(filename, tFirst=tFirst)
+    if indexname is None:
+        return None
+    return indexname[:-4] + '.cache'
+
+
+def _write_index(indexname, kind, size, entries):
+    """
+    Atomically write a complete index file.
+    """
+    
+    dirname = os.path.dirname(indexname)
+    if not os.path.exists(dirname):
+        os.mkdir(dirname)
+    fd, tempname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as fh:
+        fh.write(_INDEX_HEADER.pack(_INDEX_MAGIC, _INDEX_VERSION, kind, size))
+        for t,offset in entries:
+            fh.write(_INDEX_ENTRY.pack(t, offset))
+    os.chmod(tempname, 0o644)
+    os.rename(tempname, indexname)
+
+
+def load_index(filename):
+    """
+    Load the index for a log and return it as a structured array with 't'
+    and 'offset' fields.  Returns None if there is no index or if the index
+    does not match the log.
+    """
+    
+    indexname = index_filename(filename)
+    if indexname is None or not os.path.exists(indexname):
+        return None
+        
+    with open(indexname, 'rb') as fh:
+        data = fh.read()
+    try:
+        magic, version, kind, size = _INDEX_HEADER.unpack_from(data, 0)
+    except struct.error:
+        return None
+    if magic != _INDEX_MAGIC or version != _INDEX_VERSION or kind != _log_kind(filename):
+        return None
+    if kind == KIND_GZIP and size != os.path.getsize(filename):
+        return None
+        
+    n = (len(data) - _INDEX_HEADER.size) // _INDEX_ENTRY.size
+    entries = numpy.frombuffer(data, dtype=[('t', '<f8'), ('offset', '<i8')], count=n, offset=_INDEX_HEADER.size)
+    entries = entries[entries['offset'] < os.path.getsize(filename)]
+    return entries
+
+
+def _write_member(fh, data, entries):
+    """
+    Write a block of log lines as a new gzip member and add an index entry
+    for it.
+    """
+    
+    for line in data[:4096].splitlines():
+        t = _line_time(line)
+        if t is not None:
+            entries.append((t, fh.tell()))
+            break
+    fh.write(gzip.compress(data))
+
+
+def build_index(filename, step=INDEX_STEP, rechunk=True):
+    """
+    Build the index for an existing log.  For gzipped logs a copy made up of
+    gzip members of about `step` uncompressed bytes each is written next to
+    the index unless `rechunk` is False, in which case the index only covers
+    the start of the file.  The log itself is left untouched.  Returns the
+    name of the index or None if the log is empty.
+    """
+    
+    tFirst = first_time(filename)
+    if tFirst is None:
+        return None
+    indexname = index_filename(filename, tFirst=tFirst)
+    
+    entries = []
+    if _log_kind(filename) == KIND_TEXT:
+        offset, last = 0, -step
+        with open(filename, 'rb') as fh:
+            for line in fh:
+                if offset - last >= step:
+                    t = _line_time(line)
+                    if t is not None:
+                        entries.append((t, offset))
+                        last = offset
+                offset += len(line)
+        _write_index(indexname, KIND_TEXT, -1, entries)
+        
+    elif not rechunk:
+        chunkname = chunked_filename(filename, tFirst=tFirst)
+        if os.path.exists(chunkname):
+            os.unlink(chunkname)
+        entries.append((tFirst, 0))
+        _write_index(indexname, KIND_GZIP, os.path.getsize(filename), entries)
+        
+    else:
+        chunkname = chunked_filename(filename, tFirst=tFirst)
+        dirname = os.path.dirname(chunkname)
+        if not os.path.exists(dirname):
+            os.mkdir(dirname)
+        fd, tempname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as oh:
+                with gzip.open(filename, 'rb') as ih:
+                    partial = b''
+                    while True:
+                        data = ih.read(step)
+                        if not data:
+                            if partial:
+                                _write_member(oh, partial, entries)
+                            break
+                            
+                        data = partial + data
+                        end = data.rfind(b'\n') + 1
+                        if end == 0:
+                            partial = data
+                            continue
+                        data, partial = data[:end], data[end:]
+                        _write_member(oh, data, entries)
+            shutil.copystat(filename, tempname)
+            os.rename(tempname, chunkname)
+        except Exception:
+            os.unlink(tempname)
+            raise
+        _write_index(indexname, KIND_GZIP, os.path.getsize(filename), entries)
+        
+    return indexname
+
+
+def find_names(log_directory):
+    """
+    Return the names of all of the voltage logs in a directory, i.e.,
+    'voltage_120.log' and 'voltage_B2-240.log' for an additional board,
+    based on the current and rotated copies that are present.
+    """
+    
+    names = set()
+    for filename in glob.glob(os.path.join(log_directory, 'voltage_*.log*')):
+        mtch = re.match(r'^(voltage_.+\.log)(\.\d+)?(\.gz)?$', os.path.basename(filename))
+        if mtch is not None:
+            names.add(mtch.group(1))
+    return sorted(names)
+
+
+def build_all(log_directory, names=None, rechunk=True, rebuild=False):
+    """
+    Build any missing or out of date indexes for the logs in a directory and
+    remove indexes for logs that no longer exist.  If `names` is None every
+    voltage log found by find_names() is indexed, including those of any
+    additional boards.  Returns a list of the indexes that were built.
+    """
+    
+    if names is None:
+        names = find_names(log_directory)
+    built, keep = [], set()
+    for name in names:
+        for filename in find_logs(log_directory, name):
+            if rebuild or load_index(filename) is None:
+                indexname = build_index(filename, rechunk=rechunk)
+                if indexname is not None:
+                    built.append(indexname)
+            indexname = index_filename(filename)
+            if indexname is not None:
+                keep.add(os.path.basename(indexname))
+                keep.add(os.path.basename(chunked_filename(filename)))
+                keep.add(os.path.basename(cache_filename(filename)))
+                
+    for indexname in glob.glob(os.path.join(log_directory, INDEX_DIR, '*.idx')) \
+                     + glob.glob(os.path.join(log_directory, INDEX_DIR, '*.gz')) \
+                     + glob.glob(os.path.join(log_directory, INDEX_DIR, '*.cache')):
+        if os.path.basename(indexname) not in keep:
+            os.unlink(indexname)
+    return built
+
+
+class LogIndexWriter(object):
+    """
+    Maintain the index of a log as it is being appended to.  Call record()
+    with the time of the first line and the data before each write, and call
+    check() after each flush to pick up truncation by logrotate's
+    copytruncate.
+    """
+    
+    def __init__(self, filename, step=INDEX_STEP):
+        self.filename = filename
+        self.step = step
+        self._fh = None
+        self._reset()
+        
+    def _reset(self):
+        """
+        Start tracking the log from its current end.
+        """
+        
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+            
+        self.offset = os.path.getsize(self.filename) if os.path.exists(self.filename) else 0
+        self.last = None
+        if self.offset > 0:
+            entries = load_index(self.filename)
+            if entries is not None and entries.size > 0:
+                self.last = int(entries['offset'][-1])
+            self._open(first_time(self.filename))
+            
+    def _open(self, tFirst):
+        """
+        Open the index for appending, creating it if needed.
+        """
+        
+        if tFirst is None:
+            return
+        indexname = index_filename(self.filename, tFirst=tFirst)
+        if not os.path.exists(indexname):
+            _write_index(indexname, KIND_TEXT, -1, [])
+        self._fh = open(indexname, 'ab')
+        
+    def record(self, t, data):
+        """
+        Note that `data`, the first line of which has time `t`, is about to be
+        appended to the log.
+        """
+        
+        if self._fh is None and self.offset == 0:
+            self._open(t)
+        if self._fh is not None and (self.last is None or self.offset - self.last >= self.step):
+            self._fh.write(_INDEX_ENTRY.pack(t, self.offset))
+            self._fh.flush()
+            self.last = self.offset
+        self.offset += len(data)
+        
+    def check(self):
+        """
+        Restart the index if the log has been truncated.
+        """
+        
+        try:
+            size = os.path.getsize(self.filename)
+        except OSError:
+            size = 0
+        if size < self.offset:
+            self._reset()
+            
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+def _read_text(filename, entries, t0, t1):
+    """
+    Read the lines between times `t0` and `t1` from a plain text log.
+    """
+    
+    offset = 0
+    if entries is not None and entries.size > 0:
+        i = numpy.searchsorted(entries['t'], t0, side='right') - 1
+        if i >= 0:
+            offset = int(entries['offset'][i])
+            
+    blocks = []
+    with open(filename, 'rb') as fh:
+        fh.seek(offset)
+        partial = b''
+        while True:
+            data = fh.read(INDEX_STEP)
+            if not data:
+                break
+            data = partial + data
+            end = data.rfind(b'\n') + 1
+            data, partial = data[:end], data[end:]
+            block = _parse_lines(data)
+            blocks.append(block)
+            if block.shape[0] and block[-1,0] > t1:
+                break
+        if partial:
+            blocks.append(_parse_lines(partial))
+    return blocks
+
+
+def _read_gzip(filename, entries, t0, t1):
+    """
+    Read the lines between times `t0` and `t1` from a gzipped log, starting
+    at the gzip member that the index says contains `t0`.
+    """
+    
+    offset = 0
+    if entries is not None and entries.size > 0:
+        i = numpy.searchsorted(entries['t'], t0, side='right') - 1
+        if i >= 0:
+            offset = int(entries['offset'][i])
+            
+    blocks = []
+    with open(filename, 'rb') as fh:
+        fh.seek(offset)
+        decomp = zlib.decompressobj(31)
+        partial = b''
+        while True:
+            data = fh.read(INDEX_STEP)
+            if not data:
+                break
+            out = b''
+            while data:
+                out += decomp.decompress(data)
+                if decomp.eof:
+                    data = decomp.unused_data
+                    decomp = zlib.decompressobj(31)
+                else:
+                    data = b''
+            data = partial + out
+            end = data.rfind(b'\n') + 1
+            data, partial = data[:end], data[end:]
+            block = _parse_lines(data)
+            blocks.append(block)
+            if block.shape[0] and block[-1,0] > t1:
+                break
+        if partial:
+            blocks.append(_parse_lines(partial))
+    return blocks
+
+
+def read_log(filename, t0, t1):
+    """
+    Return an N by 2 array of the (time, voltage) samples in a single log
+    with t0 <= time <= t1, using the log's index if it has one.
+    """
+    
+    entries = load_index(filename)
+    if _log_kind(filename) == KIND_GZIP:
+        ## The index points into the re-chunked copy, if there is one
+        chunkname = chunked_filename(filename)
+        if entries is not None and chunkname is not None and os.path.exists(chunkname):
+            filename = chunkname
+        else:
+            entries = None
+        blocks = _read_gzip(filename, entries, t0, t1)
+    else:
+        blocks = _read_text(filename, entries, t0, t1)
+        
+    if not blocks:
+        return numpy.zeros((0, 2), dtype=numpy.float64)
+    data = numpy.concatenate(blocks)
+    return data[(data[:,0] >= t0) & (data[:,0] <= t1)]
+
+
+def logs_in_range(log_directory, name, t0, t1):
+    """
+    Return the current and rotated copies of the log `name` that may contain
+    samples with t0 <= time <= t1, in chronological order.
+    """
+    
+    filenames = find_logs(log_directory, name)
+    starts = [first_time(filename) for filename in filenames]
+    
+    selected = []
+    for i,filename in enumerate(filenames):
+        if starts[i] is None or starts[i] > t1:
+            continue
+        later = [s for s in starts[i+1:] if s is not None]
+        if later and later[0] < t0:
+            continue
+        selected.append(filename)
+    return selected
+
+
+def query(log_directory, name, t0, t1):
+    """
+    Return an N by 2 array of the (time, voltage) samples in the log `name`,
+    i.e., 'voltage_240.log', with t0 <= time <= t1.  Both the current and the
+    rotated copies of the log are searched.
+    """
+    
+    blocks = [read_log(filename, t0, t1) for filename in logs_in_range(log_directory, name, t0, t1)]
+    if not blocks:
+        return numpy.zeros((0, 2), dtype=numpy.float64)
+    return numpy.concatenate(blocks)
+
+
+def _parse_time(value):
+    """
+    Parse a UTC time given as either a UNIX timestamp or 'YYYY-MM-DD HH:MM[:SS]'.
+    """
+    
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return (datetime.strptime(value, fmt) - datetime(1970, 1, 1)).total_seconds()
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("cannot parse time '%s'" % value)
+
+
+def main(args):
+    if args.command == 'index':
+        built = build_all(args.log_directory, rechunk=not args.no_rechunk, rebuild=args.rebuild)
+        for indexname in built:
+            print("Built %s" % indexname)
+            
+    else:
+        data = query(args.log_directory, 'voltage_%s%s.log' % (args.board, args.channel), args.start, args.stop)
+        for t,v in data:
+            print("%.2f  %.1f" % (t, v))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='index and query the voltage logs written by voltageMonitor.py',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+            )
+    parser.add_argument('-l', '--log-directory', type=str, default='/lwa/LineMonitoring/logs/',
+                        help='directory containing the voltage logs')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    iparser = subparsers.add_parser('index', help='build missing indexes for the current and rotated logs')
+    iparser.add_argument('-n', '--no-rechunk', action='store_true',
+                         help='do not make re-chunked copies of gzipped logs for random access')
+    iparser.add_argument('-r', '--rebuild', action='store_true',
+                         help='rebuild all indexes, not just the missing ones')
+    qparser = subparsers.add_parser('query', help='print the samples in a time window')
+    qparser.add_argument('-c', '--channel', type=str, default='240', choices=('120', '240'),
+                         help='voltage channel to query')
+    qparser.add_argument('-b', '--board', type=str, default='',
+                         help='channel prefix of the board to query, i.e., B2-, for additional boards')
+    qparser.add_argument('start', type=_parse_time,
+                         help='start of the window as a UNIX timestamp or UTC YYYY-MM-DD HH:MM[:SS]')
+    qparser.add_argument('stop', type=_parse_time,
+                         help='end of the window as a UNIX timestamp or UTC YYYY-MM-DD HH:MM[:SS]')
+    args = parser.parse_args()
+    
+    main(args)
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+"""
+Queued e-mail sender for the voltage monitoring alerts.  A single worker
+thread sends everything that is submitted over one SMTP session that is
+kept open between messages and re-opened if the server drops it.  An alert
+is sent as soon as it comes in but any that follow within a short window of
+the last e-mail, or while it is being sent, are coalesced into one message
+so that a flapping line does not turn into a flood of e-mails.
+"""
+
+import time
+import uuid
+import queue
+import smtplib
+import threading
+from email.mime.text import MIMEText
+
+from lvmmetrics import Registry
+
+
+class MailSender(object):
+    """
+    Send e-mails from a background thread through a bounded queue.  If the
+    queue is full the oldest pending alert is dropped in favor of the new
+    one since later alerts describe the current state of the lines.
+    """
+    
+    def __init__(self, host, recipients, sender, port=587, username=None, password=None, starttls=True,
+                       maxsize=32, coalesce=5.0, idle=120.0, retries=3, timeout=30.0, registry=None, debug=False):
+        self.host = host
+        self.port = port
+        self.recipients = list(recipients)
+        self.sender = sender
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.coalesce = coalesce
+        self.idle = idle
+        self.retries = retries
+        self.timeout = timeout
+        self.debug = debug
+        
+        self.queue = queue.Queue(maxsize=maxsize)
+        self._server = None
+        self._thread = None
+        self._last_send = -self.coalesce
+        
+        if registry is None:
+            registry = Registry(enabled=False)
+        self._send_time = registry.histogram('sendpoweremail_smtp_seconds', 'Time spent sending an e-mail')
+        self._sent = registry.counter('sendpoweremail_emails_total', 'E-mails sent', labels={'result': 'sent'})
+        self._failed = registry.counter('sendpoweremail_emails_total', 'E-mails sent', labels={'result': 'failed'})
+        self._connects = registry.counter('sendpoweremail_smtp_connections_total', 'SMTP sessions opened')
+        self._coalesced = registry.counter('sendpoweremail_alerts_coalesced_total', 'Alerts merged into another e-mail')
+        self._dropped = registry.counter('sendpoweremail_alerts_dropped_total', 'Alerts dropped because the send queue was full')
+        registry.gauge('sendpoweremail_queue_depth', 'Alerts waiting to be sent', callback=self.queue.qsize)
+        
+    def start(self):
+        """
+        Start the sender thread.
+        """
+        
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._worker, name='MailSender')
+        self._thread.daemon = True
+        self._thread.start()
+        
+    def stop(self, timeout=None):
+        """
+        Send anything that is still queued and stop the sender thread.  If the
+        queue is full the oldest pending alert is dropped to make room for the
+        stop request so that this never blocks for longer than `timeout`.
+        """
+        
+        if self._thread is None:
+            return
+        self._put(None)
+        self._thread.join(timeout)
+        self._thread = None
+        
+    def submit(self, subject, message):
+        """
+        Queue an e-mail for sending.  Returns False if an older alert had to
+        be dropped to make room for it.
+        """
+        
+        return not self._put((time.time(), subject, message))
+        
+    def _put(self, item):
+        """
+        Add an item to the queue without blocking, dropping the oldest pending
+        alert if the queue is full.  Returns True if an alert was dropped.
+        """
+        
+        dropped = False
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return dropped
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    dropped = True
+                    self._dropped.inc()
+                    print("WARNING: e-mail queue is full, dropping the oldest alert")
+                except queue.Empty:
+                    pass
+                    
+    def _worker(self):
+        running = True
+        while running:
+            try:
+                item = self.queue.get(timeout=self.idle)
+            except queue.Empty:
+                ## Nothing for a while - let the session go rather than have
+                ## the server time it out from under us
+                self._disconnect()
+                continue
+            if item is None:
+                break
+                
+            ## Send right away unless the last e-mail went out less than a
+            ## coalescing window ago, in which case gather up everything that
+            ## arrives before the window closes.  Either way anything that
+            ## queued up while the last e-mail was being sent is merged in.
+            batch = [item,]
+            deadline = self._last_send + self.coalesce
+            while True:
+                wait = deadline - time.time()
+                try:
+                    if wait > 0:
+                        item = self.queue.get(timeout=wait)
+                    else:
+                        item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+                
+            self._coalesced.inc(len(batch)-1)
+            self._send(*self._merge(batch))
+            self._last_send = time.time()
+            
+        self._disconnect()
+        
+    def _merge(self, batch):
+        """
+        Combine a list of (time, subject, message) alerts into a single
+        subject and message.
+        """
+        
+        if len(batch) == 1:
+            return batch[0][1], batch[0][2]
+            
+        subject = "%s (+%i more)" % (batch[-1][1], len(batch)-1)
+        message = "\n\n".join([message for t,subj,message in batch])
+        return subject, message
+        
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.debug:
+            server.set_debuglevel(1)
+        if self.starttls:
+            server.starttls()
+        if self.username is not None:
+            server.login(self.username, self.password)
+        self._server = server
+        self._connects.inc()
+        
+    def _disconnect(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, OSError):
+                try:
+                    self._server.close()
+                except OSError:
+                    pass
+            self._server = None
+            
+    def _send(self, subject, message):
+        message = "%s\n\nEmail ID: %s" % (message, str(uuid.uuid4()))
+        
+        msg = MIMEText(message)
+        msg['Subject'] = subject
+        msg['From'] = self.sender
+        msg['To'] = ','.join(self.recipients)
+        msg.add_header('reply-to', self.recipients[0])
+        
+        error = None
+        with self._send_time.time():
+            for attempt in range(self.retries):
+                try:
+                    if self._server is None:
+                        self._connect()
+                    self._server.sendmail(self.sender, self.recipients, msg.as_string())
+                    self._sent.inc()
+                    return True
+                except (smtplib.SMTPException, OSError) as e:
+                    ## The session may have gone stale - start a new one and
+                    ## try again
+                    error = e
+                    self._disconnect()
+                    if attempt < self.retries-1:
+                        time.sleep(min(2**attempt, 10))
+                        
+        print("ERROR: failed to send message - %s" % str(error))
+        self._failed.inc()
+        return False
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+"""
+Lightweight counters and latency histograms for the voltage monitoring
+software that can be served over HTTP in the Prometheus text exposition
+format.  A disabled Registry hands out metrics that do nothing so that the
+instrumentation can be left in place at no real cost.
+
+The metrics are updated without locking.  Each metric is only updated from
+one thread and a scrape that races with an update is off by at most one
+observation.
+"""
+
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+# Default histogram buckets in seconds
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3,
+                   1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+INTERVAL_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.75, 1.0, 2.0, 5.0, 10.0)
+
+
+def _format_labels(labels, extra=None):
+    """
+    Format a dictionary of labels as a Prometheus label set.
+    """
+    
+    items = sorted(labels.items())
+    if extra is not None:
+        items.append(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k,v in items])
+
+
+def _format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Timer(object):
+    """
+    Context manager that records the time spent inside of it in a histogram.
+    """
+    
+    __slots__ = ('histogram', 'start')
+    
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+        
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Counter(object):
+    """
+    Monotonically increasing count.  If `callback` is given it is called to
+    get the value when the metrics are rendered, i.e., to expose a count that
+    is already kept somewhere else.
+    """
+    
+    kind = 'counter'
+    
+    __slots__ = ('name', 'help', 'labels', 'value', 'callback')
+    
+    def __init__(self, name, help, labels=None, callback=None):
+        self.name = name
+        self.help = help
+        self.labels = dict(labels or {})
+        self.value = 0
+        self.callback = callback
+        
+    def inc(self, amount=1):
+        self.value += amount
+        
+    def samples(self):
+        value = self.callback() if self.callback is not None else self.value
+        return [(self.name, _format_labels(self.labels), value),]
+
+
+class Gauge(Counter):
+    """
+    Value that can go up and down.
+    """
+    
+    kind = 'gauge'
+    
+    __slots__ = ()
+    
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(object):
+    """
+    Distribution of observed values, i.e., latencies in seconds, in cumulative
+    buckets with upper bounds `buckets`.
+    """
+    
+    kind = 'histogram'
+    
+    __slots__ = ('name', 'help', 'labels', 'buckets', 'counts', 'sum', 'count')
+    
+    def __init__(self, name, help, labels=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = dict(labels or {})
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0]*(len(self.buckets)+1)
+        self.sum = 0.0
+        self.count = 0
+        
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        
+    def time(self):
+        """
+        Return a context manager that observes the time spent inside of it.
+        """
+        
+        return _Timer(self)
+        
+    def samples(self):
+        samples = []
+        total = 0
+        for bound,count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            samples.append((self.name+'_bucket', _format_labels(self.labels, ('le', _format_value(bound))), total))
+        samples.append((self.name+'_sum', _format_labels(self.labels), self.sum))
+        samples.append((self.name+'_count', _format_labels(self.labels), self.count))
+        return samples
+
+
+class _NullMetric(object):
+    """
+    Metric that ignores everything, for a disabled Registry.
+    """
+    
+    __slots__ = ()
+    
+    def inc(self, amount=1):
+        pass
+        
+    def set(self, value):
+        pass
+        
+    def observe(self, value):
+        pass
+        
+    def time(self):
+        return self
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NULL = _NullMetric()
+
+
+class Registry(object):
+    """
+    Collection of metrics.  Metrics with the same name but different labels
+    are rendered together as one family.  Asking for a metric that already
+    exists returns the existing one.
+    """
+    
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._metrics = {}
+        self._lock = threading.Lock()
+        
+    def _add(self, cls, name, help, labels, **kwds):
+        if not self.enabled:
+            return _NULL
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            try:
+                metric = self._metrics[key]
+            except KeyError:
+                metric = self._metrics[key] = cls(name, help, labels=labels, **kwds)
+        return metric
+        
+    def counter(self, name, help, labels=None, callback=None):
+        return self._add(Counter, name, help, labels, callback=callback)
+        
+    def gauge(self, name, help, labels=None, callback=None):
+        return self._add(Gauge, name, help, labels, callback=callback)
+        
+    def histogram(self, name, help, labels=None, buckets=LATENCY_BUCKETS):
+        return self._add(Histogram, name, help, labels, buckets=buckets)
+        
+    def render(self):
+        """
+        Render all of the metrics in the Prometheus text exposition format.
+        """
+        
+        with self._lock:
+            metrics = list(self._metrics.values())
+            
+        families = {}
+        order = []
+        for metric in metrics:
+            if metric.name not in families:
+                families[metric.name] = []
+                order.append(metric.name)
+            families[metric.name].append(metric)
+            
+        lines = []
+        for name in order:
+            family = families[name]
+            lines.append('# HELP %s %s' % (name, family[0].help))
+            lines.append('# TYPE %s %s' % (name, family[0].kind))
+            for metric in family:
+                for sample,labels,value in metric.samples():
+                    lines.append('%s%s %s' % (sample, labels, _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(object):
+    """
+    HTTP server that serves the metrics in a Registry at /metrics from a
+    background thread.
+    """
+    
+    def __init__(self, registry, port, address='127.0.0.1'):
+        self.registry = registry
+        
+        outer = self
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = outer.registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                
+            def log_message(self, format, *args):
+                pass
+                
+        self.httpd = HTTPServer((address, port), _Handler)
+        self.thread = None
+        
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+        
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='MetricsServer')
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def stop(self):
+        if self.thread is not None:
+            self.httpd.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.httpd.server_close()
@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compact binary multicast packet format for the line voltage monitoring data.
+
+Each datagram starts with a fixed header:
+  * 2-byte magic (b'LV')
+  * 1-byte format version
+  * 1-byte flags (reserved, zero)
+  * 4-byte unsigned sequence number
+  * 8-byte float UNIX timestamp
+  * 1-byte item count
+followed by that many items:
+  * 8-byte NUL-padded ASCII channel name, i.e., b'120V'
+  * 1-byte code (CODE_VAC for a voltage, a voltage statistic code, or an
+    event code)
+  * 4-byte float value (the voltage for CODE_VAC and the statistic codes,
+    otherwise zero)
+All values are big endian.
+
+Raw sample packets carry every sample of a set of channels, batched to fit
+in a single datagram:
+  * 2-byte magic (b'LR')
+  * 1-byte format version
+  * 1-byte channel count
+  * 4-byte unsigned sequence number
+  * 8-byte float UNIX timestamp that the sample times are relative to
+  * 2-byte unsigned sample count
+  * 8-byte NUL-padded ASCII channel name, one per channel
+followed by that many samples:
+  * 4-byte float time offset in seconds from the timestamp
+  * 4-byte float voltage, one per channel
+These are also big endian.
+"""
+
+import re
+import numpy
+import struct
+from datetime import datetime
+
+
+# Packet format
+MAGIC = b'LV'
+VERSION = 1
+HEADER = struct.Struct('>2sBBIdB')
+ITEM = struct.Struct('>8sBf')
+
+# Raw sample packet format
+RAW_MAGIC = b'LR'
+RAW_VERSION = 1
+RAW_HEADER = struct.Struct('>2sBBIdH')
+RAW_NAME = struct.Struct('>8s')
+
+# Largest UDP payload that fits in a standard 1500 byte Ethernet frame
+MAX_DATAGRAM = 1472
+
+# Item codes
+CODE_VAC = 0
+CODE_FLICKER = 1
+CODE_OUTAGE = 2
+CODE_CLEAR = 3
+CODE_VMIN = 4
+CODE_VMAX = 5
+CODE_VRMS = 6
+CODE_VSTD = 7
+
+_CODE_TO_KIND = {CODE_VAC: 'VAC', CODE_FLICKER: 'FLICKER', CODE_OUTAGE: 'OUTAGE', CODE_CLEAR: 'CLEAR',
+                 CODE_VMIN: 'VMIN', CODE_VMAX: 'VMAX', CODE_VRMS: 'VRMS', CODE_VSTD: 'VSTD'}
+_KIND_TO_CODE = dict([(v,k) for k,v in _CODE_TO_KIND.items()])
+
+# Item kinds that carry a voltage and those that are events
+VALUE_KINDS = ('VAC', 'VMIN', 'VMAX', 'VRMS', 'VSTD')
+EVENT_KINDS = ('FLICKER', 'OUTAGE', 'CLEAR')
+
+# Legacy ASCII format
+dataRE = re.compile(r'^\[(?P<date>.*)\] (?P<type>[A-Z0-9]*): (?P<data>.*)$')
+_EPOCH = datetime(1970, 1, 1)
+
+
+class LVMPacketError(Exception):
+    """
+    Base exception class for packet encoding and decoding.
+    """
+
+
+class LVMRecord(object):
+    """
+    A single decoded value or event.  `kind` is 'VAC' for a voltage reading,
+    one of 'VMIN', 'VMAX', 'VRMS', or 'VSTD' for a voltage statistic, or one
+    of 'FLICKER', 'OUTAGE', or 'CLEAR' for an event, `name` is the channel
+    name, i.e., '120V', and `t` is a UNIX timestamp.
+    """
+    
+    __slots__ = ('seq', 't', 'kind', 'name', 'value')
+    
+    def __init__(self, seq, t, kind, name, value=None):
+        self.seq = seq
+        self.t = t
+        self.kind = kind
+        self.name = name
+        self.value = value
+        
+    def __repr__(self):
+        return "<%s %s %s %s at %.6f>" % (type(self).__name__, self.kind, self.name, self.value, self.t)
+
+
+def is_binary(data):
+    """
+    Return True if a datagram is in the binary packet format.
+    """
+    
+    return data[:2] == MAGIC
+
+
+def is_raw(data):
+    """
+    Return True if a datagram is a raw sample packet.
+    """
+    
+    return data[:2] == RAW_MAGIC
+
+
+def raw_capacity(nchan, size=MAX_DATAGRAM):
+    """
+    Return the number of samples of `nchan` channels that fit into a raw
+    sample packet of at most `size` bytes.
+    """
+    
+    return min((size - RAW_HEADER.size - nchan*RAW_NAME.size) // (4*(nchan+1)), 0xFFFF)
+
+
+def encode_raw(seq, names, t, values):
+    """
+    Encode a raw sample packet with sequence number `seq` for channels
+    `names` with sample times `t` (length N) and voltages `values` (N by
+    len(names)).  The first sample time is used as the packet timestamp.
+    """
+    
+    t = numpy.asarray(t, dtype=numpy.float64)
+    n, nchan = t.size, len(names)
+    if n > 0xFFFF or nchan > 255:
+        raise LVMPacketError("Too many samples or channels for a single packet")
+    t0 = float(t[0]) if n else 0.0
+    
+    samples = numpy.empty((n, nchan+1), dtype='>f4')
+    samples[:,0] = t - t0
+    samples[:,1:] = numpy.asarray(values).reshape(n, nchan)
+    
+    parts = [RAW_HEADER.pack(RAW_MAGIC, RAW_VERSION, nchan, seq & 0xFFFFFFFF, t0, n)]
+    parts.extend([RAW_NAME.pack(name.encode('ascii')) for name in names])
+    parts.append(samples.tobytes())
+    return b''.join(parts)
+
+
+def decode_raw(data):
+    """
+    Decode a raw sample packet and return a four-element tuple of the
+    sequence number, the list of channel names, an array of sample times,
+    and an N by number of channels array of voltages.
+    """
+    
+    try:
+        magic, version, nchan, seq, t0, n = RAW_HEADER.unpack_from(data, 0)
+    except struct.error as e:
+        raise LVMPacketError("Truncated packet header: %s" % str(e))
+    if magic != RAW_MAGIC:
+        raise LVMPacketError("Not a raw sample packet")
+    if version != RAW_VERSION:
+        raise LVMPacketError("Unsupported packet version %i" % version)
+    offset = RAW_HEADER.size + nchan*RAW_NAME.size
+    if len(data) < offset + 4*(nchan+1)*n:
+        raise LVMPacketError("Truncated packet: expected %i samples" % n)
+        
+    names = [RAW_NAME.unpack_from(data, RAW_HEADER.size + i*RAW_NAME.size)[0].rstrip(b'\x00').decode('ascii') for i in range(nchan)]
+    samples = numpy.frombuffer(data, dtype='>f4', count=n*(nchan+1), offset=offset).reshape(n, nchan+1)
+    t = t0 + samples[:,0].astype(numpy.float64)
+    values = samples[:,1:].astype(numpy.float64)
+    return seq, names, t, values
+
+
+def encode_packet(seq, t, items):
+    """
+    Encode a packet with sequence number `seq` and timestamp `t`.  `items` is a
+    sequence of (kind, name, value) tuples with `kind` being one of
+    VALUE_KINDS or EVENT_KINDS.
+    """
+    
+    if len(items) > 255:
+        raise LVMPacketError("Too many items for a single packet: %i" % len(items))
+        
+    parts = [HEADER.pack(MAGIC, VERSION, 0, seq & 0xFFFFFFFF, t, len(items))]
+    for kind,name,value in items:
+        try:
+            code = _KIND_TO_CODE[kind]
+        except KeyError:
+            raise LVMPacketError("Unknown item kind '%s'" % kind)
+        parts.append(ITEM.pack(name.encode('ascii'), code, value or 0.0))
+    return b''.join(parts)
+
+
+def decode_packet(data):
+    """
+    Decode a binary packet and return a three-element tuple of the sequence
+    number, the timestamp, and a list of LVMRecord instances.
+    """
+    
+    try:
+        magic, version, flags, seq, t, count = HEADER.unpack_from(data, 0)
+    except struct.error as e:
+        raise LVMPacketError("Truncated packet header: %s" % str(e))
+    if magic != MAGIC:
+        raise LVMPacketError("Not a binary packet")
+    if version != VERSION:
+        raise LVMPacketError("Unsupported packet version %i" % version)
+    if len(data) < HEADER.size + count*ITEM.size:
+        raise LVMPacketError("Truncated packet: expected %i items" % count)
+        
+    records = []
+    for name,code,value in ITEM.iter_unpack(data[HEADER.size:HEADER.size+count*ITEM.size]):
+        try:
+            kind = _CODE_TO_KIND[code]
+        except KeyError:
+            raise LVMPacketError("Unknown item code %i" % code)
+        name = name.rstrip(b'\x00').decode('ascii')
+        if kind not in VALUE_KINDS:
+            value = None
+        records.append(LVMRecord(seq, t, kind, name, value))
+    return seq, t, records
+
+
+class SequenceTracker(object):
+    """
+    Keep track of binary packet sequence numbers to find dropped packets.
+    """
+    
+    __slots__ = ('last', 'received', 'dropped')
+    
+    def __init__(self):
+        self.last = None
+        self.received = 0
+        self.dropped = 0
+        
+    def update(self, seq):
+        """
+        Record a new sequence number and return how many packets were lost
+        since the previous one.  A sequence number that goes backwards is
+        treated as a restart of the sender.
+        """
+        
+        missed = 0
+        if self.last is not None:
+            delta = (seq - self.last) & 0xFFFFFFFF
+            if 0 < delta < 0x80000000:
+                missed = delta - 1
+        self.last = seq
+        self.received += 1
+        self.dropped += missed
+        return missed
+
+
+_day_cache = {}
+
+
+def _day_to_epoch(day):
+    """
+    Convert a b'YYYY-MM-DD' date into the UNIX timestamp of its midnight.  The
+    results are cached since there is normally only one day in play.
+    """
+    
+    try:
+        return _day_cache[day]
+    except KeyError:
+        if len(_day_cache) > 16:
+            _day_cache.clear()
+        value = (datetime(int(day[0:4]), int(day[5:7]), int(day[8:10])) - _EPOCH).total_seconds()
+        _day_cache[day] = value
+        return value
+
+
+def _decode_ascii_slow(data):
+    """
+    Decode a legacy ASCII message of the form '[date] type: data' into a
+    single LVMRecord using a regular expression and strptime.
+    """
+    
+    try:
+        data = data.decode('ascii')
+    except AttributeError:
+        pass
+    except UnicodeDecodeError as e:
+        raise LVMPacketError("Invalid ASCII message: %s" % str(e))
+    mtch = dataRE.match(data)
+    if mtch is None:
+        raise LVMPacketError("Invalid ASCII message")
+    try:
+        t = datetime.strptime(mtch.group('date'), "%Y-%m-%d %H:%M:%S.%f")
+    except ValueError as e:
+        raise LVMPacketError("Invalid ASCII message date: %s" % str(e))
+    t = (t - _EPOCH).total_seconds()
+    
+    return _make_record(t, mtch.group('type'), mtch.group('data'))
+
+
+def _make_record(t, mtype, mdata):
+    """
+    Build an LVMRecord from the type and data fields of an ASCII message.
+    Voltages have a type of the channel name followed by the kind without
+    its leading 'V', i.e., '120VAC' or '120VMIN'.
+    """
+    
+    for kind in VALUE_KINDS:
+        if mtype.endswith(kind) and len(mtype) > len(kind):
+            try:
+                return LVMRecord(None, t, kind, mtype[:-len(kind)+1], float(mdata))
+            except ValueError:
+                raise LVMPacketError("Invalid voltage '%s'" % mdata)
+    return LVMRecord(None, t, mtype, mdata)
+
+
+def _decode_ascii(data):
+    """
+    Decode a legacy ASCII message of the form
+    '[YYYY-MM-DD HH:MM:SS.ffffff] type: data' into a single LVMRecord.  The
+    date is parsed at fixed offsets and messages that do not follow this
+    layout exactly are handed off to _decode_ascii_slow().
+    """
+    
+    if isinstance(data, str):
+        data = data.encode('ascii', errors='replace')
+    try:
+        if data[0] != 0x5B or data[27:29] != b'] ':
+            raise ValueError
+        t = _day_to_epoch(data[1:11]) \
+            + int(data[12:14])*3600 + int(data[15:17])*60 + int(data[18:20]) \
+            + int(data[21:27])*1e-6
+        mtype, mdata = data[29:].split(b': ', 1)
+        mtype, mdata = mtype.decode('ascii'), mdata.decode('ascii')
+    except (IndexError, ValueError, UnicodeDecodeError):
+        return _decode_ascii_slow(data)
+        
+    return _make_record(t, mtype, mdata)
+
+
+def decode_datagram(data):
+    """
+    Decode a datagram in the binary, raw sample, or legacy ASCII format and
+    return a two-element tuple of the sequence number (None for ASCII) and a
+    list of LVMRecord instances.  Raw samples are returned as 'VAC' records.
+    """
+    
+    if is_binary(data):
+        seq, t, records = decode_packet(data)
+        return seq, records
+    if is_raw(data):
+        seq, names, t, values = decode_raw(data)
+        records = []
+        for ti,vi in zip(t.tolist(), values.tolist()):
+            records.extend([LVMRecord(seq, ti, 'VAC', name, v) for name,v in zip(names, vi)])
+        return seq, records
+    return None, [_decode_ascii(data),]
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Multi-resolution rollups of the voltages, i.e., 1 s, 1 min, and 1 h, that are
+maintained by voltageMonitor.py as the data come in.  Each resolution is kept
+in its own fixed-width binary file with a short header followed by one record
+per time bin:
+  * 8-byte float UNIX timestamp of the start of the bin
+  * 4-byte unsigned sample count
+  * 4-byte float minimum, one per channel
+  * 4-byte float maximum, one per channel
+  * 4-byte float mean, one per channel
+All values are little endian.  The finest resolution is built from the
+samples and each of the coarser ones from the completed bins of the one
+below it, so the cost per sample does not depend on the number of
+resolutions.
+"""
+
+import os
+import numpy
+import struct
+import argparse
+from datetime import datetime
+
+from lvmlogs import open_log, _parse_time
+
+
+# Default resolutions in seconds
+RESOLUTIONS = (1, 60, 3600)
+
+# File layout
+_ROLLUP_MAGIC = b'LVMR'
+_ROLLUP_VERSION = 1
+_ROLLUP_HEADER = struct.Struct('<4sBBxxd')
+_ROLLUP_NAME = struct.Struct('<8s')
+
+
+def rollup_dtype(nchan):
+    """
+    Return the NumPy data type of a rollup record for `nchan` channels.
+    """
+    
+    return numpy.dtype([('t', '<f8'), ('count', '<u4'), ('min', '<f4', (nchan,)),
+                        ('max', '<f4', (nchan,)), ('mean', '<f4', (nchan,))])
+
+
+def rollup_filename(directory, resolution, prefix=''):
+    """
+    Return the name of the rollup file for the given resolution in seconds
+    and board channel prefix.
+    """
+    
+    return os.path.join(directory, 'rollup_%s%is.dat' % (prefix, resolution))
+
+
+class RollupTier(object):
+    """
+    Accumulator for a single rollup resolution that appends each completed
+    bin to `filename`.
+    """
+    
+    __slots__ = ('filename', 'names', 'resolution', 'start', 'count', 'sum', 'min', 'max', '_dtype', '_fh', '_pending')
+    
+    def __init__(self, filename, names, resolution):
+        self.filename = filename
+        self.names = tuple(names)
+        self.resolution = float(resolution)
+        
+        nchan = len(self.names)
+        self.start = None
+        self.count = 0
+        self.sum = numpy.zeros(nchan)
+        self.min = numpy.zeros(nchan)
+        self.max = numpy.zeros(nchan)
+        
+        self._dtype = rollup_dtype(nchan)
+        self._fh = open(self.filename, 'ab')
+        self._pending = []
+        
+    def _header(self):
+        """
+        Build the file header.
+        """
+        
+        header = _ROLLUP_HEADER.pack(_ROLLUP_MAGIC, _ROLLUP_VERSION, len(self.names), self.resolution)
+        return header + b''.join([_ROLLUP_NAME.pack(name.encode('ascii')) for name in self.names])
+        
+    def add(self, start, count, total, vmin, vmax):
+        """
+        Add `count` samples from a bin that starts at `start` with per-channel
+        sums `total`, minima `vmin`, and maxima `vmax`.  If this moves the
+        tier into a new bin the completed one is queued for writing and
+        returned as a (start, count, sum, min, max) tuple, otherwise None is
+        returned.
+        """
+        
+        b = (start // self.resolution) * self.resolution
+        done = None
+        if self.start is not None and b != self.start:
+            done = self.complete()
+        if self.start is None:
+            self.start = b
+            self.count = 0
+            self.sum[:] = 0.0
+            self.min[:] = numpy.inf
+            self.max[:] = -numpy.inf
+            
+        self.count += count
+        self.sum += total
+        numpy.fmin(self.min, vmin, out=self.min)
+        numpy.fmax(self.max, vmax, out=self.max)
+        return done
+        
+    def complete(self):
+        """
+        Queue the current bin for writing, even if it is only partially
+        filled, and return it as a (start, count, sum, min, max) tuple.
+        Returns None if there is no current bin.
+        """
+        
+        if self.start is None:
+            return None
+            
+        record = numpy.zeros(1, dtype=self._dtype)
+        record['t'] = self.start
+        record['count'] = self.count
+        record['min'] = self.min
+        record['max'] = self.max
+        record['mean'] = self.sum / self.count
+        self._pending.append(record.tobytes())
+        
+        done = (self.start, self.count, self.sum.copy(), self.min.copy(), self.max.copy())
+        self.start = None
+        return done
+        
+    def flush(self):
+        """
+        Write the completed bins to disk, adding the header if the file is
+        new or has been truncated by logrotate.
+        """
+        
+        if not self._pending:
+            return
+        if os.fstat(self._fh.fileno()).st_size == 0:
+            self._fh.write(self._header())
+        self._fh.write(b''.join(self._pending))
+        self._fh.flush()
+        self._pending = []
+        
+    def close(self):
+        self.flush()
+        self._fh.close()
+
+
+class Rollup(object):
+    """
+    Set of rollup tiers for channels `names` with resolutions `resolutions`
+    in seconds, each a multiple of the one before it, that are stored in
+    `directory`.  `prefix` is the channel prefix of the board, if any.
+    """
+    
+    def __init__(self, directory, names, resolutions=RESOLUTIONS, prefix=''):
+        resolutions = sorted(resolutions)
+        for coarse,fine in zip(resolutions[1:], resolutions[:-1]):
+            if coarse % fine != 0:
+                raise ValueError("Rollup resolution %s s is not a multiple of %s s" % (coarse, fine))
+                
+        self.names = tuple(names)
+        self.tiers = [RollupTier(rollup_filename(directory, resolution, prefix), self.names, resolution) for resolution in resolutions]
+        
+    def _add(self, level, start, count, total, vmin, vmax):
+        """
+        Add a bin to the tier at `level` and pass any bin that it completes on
+        to the next tier.
+        """
+        
+        while level < len(self.tiers):
+            done = self.tiers[level].add(start, count, total, vmin, vmax)
+            if done is None:
+                break
+            start, count, total, vmin, vmax = done
+            level += 1
+            
+    def process(self, t, values):
+        """
+        Add a block of samples with times `t` (length N) and voltages `values`
+        (N by number of channels).
+        """
+        
+        if not self.tiers or len(t) == 0:
+            return
+            
+        ## Split the block into runs that fall in the same finest bin
+        res = self.tiers[0].resolution
+        bins = (t // res) * res
+        starts = numpy.flatnonzero(numpy.r_[True, bins[1:] != bins[:-1]])
+        counts = numpy.diff(numpy.r_[starts, len(t)])
+        sums = numpy.add.reduceat(values, starts, axis=0)
+        mins = numpy.fmin.reduceat(values, starts, axis=0)
+        maxs = numpy.fmax.reduceat(values, starts, axis=0)
+        for i,s in enumerate(starts):
+            self._add(0, bins[s], counts[i], sums[i], mins[i], maxs[i])
+            
+    def flush(self):
+        for tier in self.tiers:
+            tier.flush()
+            
+    def close(self):
+        """
+        Write out all partially filled bins and close the files.  The partial
+        bins are merged with the rest of the bin by load_rollup() if the
+        monitor is restarted.
+        """
+        
+        for level,tier in enumerate(self.tiers):
+            done = tier.complete()
+            if done is not None and level+1 < len(self.tiers):
+                self._add(level+1, *done)
+        for tier in self.tiers:
+            tier.close()
+
+
+def load_rollup(filename, t0=None, t1=None):
+    """
+    Load a rollup file and return a two-element tuple of the channel names
+    and a structured array of the records with t0 <= time < t1.  Records
+    for the same bin, i.e., from before and after a restart, are merged.
+    The file can also be one of the gzipped copies rotated by logrotate.
+    """
+    
+    gzipped = filename.endswith('.gz')
+    with open_log(filename, 'rb') as fh:
+        header = fh.read(_ROLLUP_HEADER.size)
+        try:
+            magic, version, nchan, resolution = _ROLLUP_HEADER.unpack(header)
+        except struct.error:
+            raise RuntimeError("Invalid rollup file '%s'" % filename)
+        if magic != _ROLLUP_MAGIC or version != _ROLLUP_VERSION:
+            raise RuntimeError("Invalid rollup file '%s'" % filename)
+        names = [_ROLLUP_NAME.unpack(fh.read(_ROLLUP_NAME.size))[0].rstrip(b'\x00').decode('ascii') for i in range(nchan)]
+        offset = fh.tell()
+        data = fh.read() if gzipped else None
+        
+    dtype = rollup_dtype(nchan)
+    if gzipped:
+        count = len(data) // dtype.itemsize
+        records = numpy.frombuffer(data, dtype=dtype, count=count)
+    else:
+        count = (os.path.getsize(filename) - offset) // dtype.itemsize
+        records = numpy.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(count,)) if count else numpy.zeros(0, dtype=dtype)
+    
+    ## Select the time range - the records are in time order except across a
+    ## clock step, so use a mask rather than a search
+    valid = numpy.ones(count, dtype=bool)
+    if t0 is not None:
+        valid &= records['t'] >= t0
+    if t1 is not None:
+        valid &= records['t'] < t1
+    records = numpy.array(records[valid])
+    
+    ## Merge repeated bins
+    if records.size > 1 and numpy.any(numpy.diff(records['t']) <= 0):
+        records = records[numpy.argsort(records['t'], kind='stable')]
+        starts = numpy.flatnonzero(numpy.r_[True, records['t'][1:] != records['t'][:-1]])
+        weights = records['count'][:,None] * records['mean'].astype(numpy.float64)
+        merged = numpy.zeros(starts.size, dtype=dtype)
+        merged['t'] = records['t'][starts]
+        merged['count'] = numpy.add.reduceat(records['count'], starts)
+        merged['min'] = numpy.fmin.reduceat(records['min'], starts, axis=0)
+        merged['max'] = numpy.fmax.reduceat(records['max'], starts, axis=0)
+        merged['mean'] = numpy.add.reduceat(weights, starts, axis=0) / merged['count'][:,None]
+        records = merged
+        
+    return names, records
+
+
+def main(args):
+    names, records = load_rollup(rollup_filename(args.log_directory, args.resolution, args.prefix), args.start, args.stop)
+    
+    print("%-19s  %7s  %s" % ('Start (UTC)', 'Samples', '  '.join(["%6s min/mean/max" % name for name in names])))
+    for record in records:
+        values = '  '.join(["%6.1f/%5.1f/%5.1f" % (vmin, vmean, vmax) for vmin,vmean,vmax in zip(record['min'], record['mean'], record['max'])])
+        print("%-19s  %7i  %s" % (datetime.utcfromtimestamp(record['t']).strftime("%Y-%m-%d %H:%M:%S"), record['count'], values))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='print the voltage rollups written by voltageMonitor.py',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+            )
+    parser.add_argument('-l', '--log-directory', type=str, default='/lwa/LineMonitoring/logs/',
+                        help='directory containing the rollup files')
+    parser.add_argument('-r', '--resolution', type=int, default=3600,
+                        help='rollup resolution in seconds')
+    parser.add_argument('-b', '--prefix', type=str, default='',
+                        help='channel prefix of the board for a multi-board monitor')
+    parser.add_argument('start', type=_parse_time, nargs='?',
+                        help='start of the range as a UNIX timestamp or UTC YYYY-MM-DD HH:MM[:SS]')
+    parser.add_argument('stop', type=_parse_time, nargs='?',
+                        help='end of the range as a UNIX timestamp or UTC YYYY-MM-DD HH:MM[:SS]')
+    args = parser.parse_args()
+    
+    main(args)
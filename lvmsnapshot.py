@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Recent history of the voltages and events kept in memory by voltageMonitor.py
+and served on a local TCP port so that a consumer that starts up in the
+middle of an event can find out what is going on right away.
+
+A client connects, sends a single request line of the form
+'SNAPSHOT [seconds]\\n', and gets back a 4-byte big endian length followed by
+a snapshot of that many bytes:
+  * 2-byte magic (b'LS')
+  * 1-byte format version
+  * 1-byte number of channels
+  * 8-byte float UNIX timestamp of the snapshot
+  * 4-byte unsigned number of events
+then, for each channel:
+  * 8-byte NUL-padded ASCII channel name, i.e., b'120V'
+  * 1-byte state (STATE_NORMAL, STATE_FLICKER, or STATE_OUTAGE)
+  * 4-byte unsigned number of samples
+  * 8-byte float UNIX timestamp of each sample
+  * 4-byte float voltage of each sample
+and then, for each event:
+  * 8-byte float UNIX timestamp
+  * 8-byte NUL-padded ASCII channel name
+  * 1-byte lvmpacket item code for 'FLICKER', 'OUTAGE', or 'CLEAR'
+All values other than the length are little endian.
+"""
+
+import time
+import numpy
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+from collections import deque
+from datetime import datetime
+
+from lvmpacket import LVMRecord, CODE_FLICKER, CODE_OUTAGE, CODE_CLEAR
+
+
+# Snapshot format
+_SNAPSHOT_MAGIC = b'LS'
+_SNAPSHOT_VERSION = 1
+_SNAPSHOT_HEADER = struct.Struct('<2sBBdI')
+_SNAPSHOT_CHANNEL = struct.Struct('<8sBI')
+_SNAPSHOT_EVENT = struct.Struct('<d8sB')
+_LENGTH = struct.Struct('>I')
+
+# Channel states
+STATE_NORMAL = 0
+STATE_FLICKER = 1
+STATE_OUTAGE = 2
+STATE_NAMES = {STATE_NORMAL: 'normal', STATE_FLICKER: 'flicker', STATE_OUTAGE: 'outage'}
+
+_EVENT_TO_CODE = {'FLICKER': CODE_FLICKER, 'OUTAGE': CODE_OUTAGE, 'CLEAR': CODE_CLEAR}
+_CODE_TO_EVENT = dict([(v,k) for k,v in _EVENT_TO_CODE.items()])
+
+
+class SnapshotError(Exception):
+    """
+    Base exception class for snapshot encoding, decoding, and retrieval.
+    """
+
+
+class SnapshotStore(object):
+    """
+    The last `duration` seconds of samples and events for a collection of
+    channels along with the current state of each channel.  Samples are kept
+    in the blocks that they were added in so that adding them is cheap and
+    the work of putting them together is only done when a snapshot is taken.
+    """
+    
+    def __init__(self, names, duration=600.0):
+        self.names = tuple(names)
+        self.duration = float(duration)
+        
+        self._blocks = dict([(name, deque()) for name in self.names])
+        self._states = dict([(name, STATE_NORMAL) for name in self.names])
+        self._events = deque()
+        self._lock = threading.Lock()
+        
+    def add_samples(self, names, t, values):
+        """
+        Add a block of samples with times `t` (length N) and voltages `values`
+        (N by len(names)) for the channels `names`.
+        """
+        
+        if len(t) == 0:
+            return
+        t = numpy.array(t, dtype=numpy.float64)
+        values = numpy.asarray(values, dtype=numpy.float32)
+        tExpire = t[-1] - self.duration
+        with self._lock:
+            for i,name in enumerate(names):
+                blocks = self._blocks[name]
+                blocks.append((t, values[:,i].copy()))
+                while blocks and blocks[0][0][-1] < tExpire:
+                    blocks.popleft()
+                    
+    def add_event(self, t, kind, name):
+        """
+        Add a 'FLICKER', 'OUTAGE', or 'CLEAR' event for a channel.
+        """
+        
+        with self._lock:
+            self._events.append((t, kind, name))
+            while self._events[0][0] < t - self.duration:
+                self._events.popleft()
+                
+    def set_state(self, name, state):
+        """
+        Set the current state of a channel to STATE_NORMAL, STATE_FLICKER, or
+        STATE_OUTAGE.
+        """
+        
+        self._states[name] = state
+        
+    def encode(self, duration=None):
+        """
+        Return a snapshot of the last `duration` seconds, or everything that
+        is kept if `duration` is None.
+        """
+        
+        tNow = time.time()
+        tStart = -numpy.inf if duration is None else tNow - duration
+        with self._lock:
+            channels = []
+            for name in self.names:
+                blocks = [block for block in self._blocks[name] if block[0][-1] >= tStart]
+                channels.append((name, self._states[name], blocks))
+            events = [event for event in self._events if event[0] >= tStart]
+            
+        parts = [_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, _SNAPSHOT_VERSION, len(channels), tNow, len(events))]
+        for name,state,blocks in channels:
+            if blocks:
+                t = numpy.concatenate([block[0] for block in blocks])
+                v = numpy.concatenate([block[1] for block in blocks])
+                keep = t >= tStart
+                t, v = t[keep], v[keep]
+            else:
+                t, v = numpy.zeros(0), numpy.zeros(0, dtype=numpy.float32)
+            parts.append(_SNAPSHOT_CHANNEL.pack(name.encode('ascii'), state, t.size))
+            parts.append(t.astype('<f8').tobytes())
+            parts.append(v.astype('<f4').tobytes())
+        for t,kind,name in events:
+            parts.append(_SNAPSHOT_EVENT.pack(t, name.encode('ascii'), _EVENT_TO_CODE[kind]))
+        return b''.join(parts)
+
+
+class Snapshot(object):
+    """
+    A decoded snapshot.  `states` maps each channel name to its state,
+    `samples` maps each channel name to a two-element tuple of arrays of
+    times and voltages, and `events` is a list of LVMRecord instances.
+    """
+    
+    def __init__(self, t, states, samples, events):
+        self.t = t
+        self.states = states
+        self.samples = samples
+        self.events = events
+        
+    @property
+    def names(self):
+        return list(self.states.keys())
+        
+    def latest(self, name):
+        """
+        Return the most recent (time, voltage) sample for a channel or None
+        if there are no samples.
+        """
+        
+        t, v = self.samples[name]
+        if t.size == 0:
+            return None
+        return float(t[-1]), float(v[-1])
+
+
+def decode_snapshot(data):
+    """
+    Decode a snapshot returned by SnapshotStore.encode() into a Snapshot.
+    """
+    
+    try:
+        magic, version, nchan, tSnapshot, nevent = _SNAPSHOT_HEADER.unpack_from(data, 0)
+        if magic != _SNAPSHOT_MAGIC or version != _SNAPSHOT_VERSION:
+            raise SnapshotError("Invalid snapshot")
+        offset = _SNAPSHOT_HEADER.size
+        
+        states, samples = {}, {}
+        for i in range(nchan):
+            name, state, nsamp = _SNAPSHOT_CHANNEL.unpack_from(data, offset)
+            offset += _SNAPSHOT_CHANNEL.size
+            name = name.rstrip(b'\x00').decode('ascii')
+            t = numpy.frombuffer(data, dtype='<f8', count=nsamp, offset=offset)
+            offset += 8*nsamp
+            v = numpy.frombuffer(data, dtype='<f4', count=nsamp, offset=offset)
+            offset += 4*nsamp
+            states[name] = state
+            samples[name] = (t, v)
+            
+        events = []
+        for i in range(nevent):
+            t, name, code = _SNAPSHOT_EVENT.unpack_from(data, offset)
+            offset += _SNAPSHOT_EVENT.size
+            events.append(LVMRecord(None, t, _CODE_TO_EVENT[code], name.rstrip(b'\x00').decode('ascii')))
+    except (struct.error, ValueError, KeyError, UnicodeDecodeError) as e:
+        raise SnapshotError("Invalid snapshot: %s" % str(e))
+        
+    return Snapshot(tSnapshot, states, samples, events)
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class SnapshotServer(object):
+    """
+    TCP server that answers snapshot requests for a SnapshotStore from a
+    background thread.
+    """
+    
+    def __init__(self, store, port, address='127.0.0.1'):
+        self.store = store
+        
+        outer = self
+        class _Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                request = self.rfile.readline(64).split()
+                if not request or request[0] != b'SNAPSHOT':
+                    return
+                duration = None
+                if len(request) > 1:
+                    try:
+                        duration = float(request[1])
+                    except ValueError:
+                        return
+                payload = outer.store.encode(duration)
+                self.wfile.write(_LENGTH.pack(len(payload)) + payload)
+                
+        self.server = _TCPServer((address, port), _Handler)
+        self.thread = None
+        
+    @property
+    def port(self):
+        return self.server.server_address[1]
+        
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='SnapshotServer')
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def stop(self):
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server.server_close()
+
+
+def fetch_snapshot(port=7170, address='127.0.0.1', duration=None, timeout=5.0):
+    """
+    Request a snapshot of the last `duration` seconds, or everything that is
+    kept if `duration` is None, from a SnapshotServer and return it as a
+    Snapshot.
+    """
+    
+    request = b'SNAPSHOT\n' if duration is None else b'SNAPSHOT %f\n' % duration
+    try:
+        sock = socket.create_connection((address, port), timeout=timeout)
+    except (OSError, socket.error) as e:
+        raise SnapshotError("Cannot connect to the snapshot server: %s" % str(e))
+        
+    try:
+        sock.sendall(request)
+        fh = sock.makefile('rb')
+        header = fh.read(_LENGTH.size)
+        if len(header) != _LENGTH.size:
+            raise SnapshotError("No snapshot returned")
+        length, = _LENGTH.unpack(header)
+        data = fh.read(length)
+        if len(data) != length:
+            raise SnapshotError("Truncated snapshot")
+        fh.close()
+    except (OSError, socket.error) as e:
+        raise SnapshotError("Cannot read the snapshot: %s" % str(e))
+    finally:
+        sock.close()
+        
+    return decode_snapshot(data)
+
+
+def main(args):
+    snapshot = fetch_snapshot(port=args.port, address=args.address, duration=args.duration)
+    
+    print("Snapshot at %s UTC" % datetime.utcfromtimestamp(snapshot.t).strftime("%Y-%m-%d %H:%M:%S"))
+    for name in snapshot.names:
+        latest = snapshot.latest(name)
+        if latest is None:
+            print("  %-8s  %-7s  no samples" % (name, STATE_NAMES[snapshot.states[name]]))
+        else:
+            print("  %-8s  %-7s  %5.1f VAC at %s, %i samples" % (name, STATE_NAMES[snapshot.states[name]], latest[1],
+                                                             datetime.utcfromtimestamp(latest[0]).strftime("%H:%M:%S"),
+                                                             snapshot.samples[name][0].size))
+    for rec in snapshot.events:
+        print("  %s  %s - %s" % (datetime.utcfromtimestamp(rec.t).strftime("%Y-%m-%d %H:%M:%S"), rec.kind, rec.name))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='print the current state and recent history kept by voltageMonitor.py',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+            )
+    parser.add_argument('-a', '--address', type=str, default='127.0.0.1',
+                        help='address of the snapshot server')
+    parser.add_argument('-p', '--port', type=int, default=7170,
+                        help='port of the snapshot server')
+    parser.add_argument('-d', '--duration', type=float,
+                        help='number of seconds of history to request; default is everything')
+    args = parser.parse_args()
+    
+    main(args)
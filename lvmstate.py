@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+"""
+Small persistent key/value store for the state that the voltage monitoring
+daemons keep across restarts, i.e., whether or not a line is in an outage.
+Each key is a file in the state directory holding the value as text so
+that the existing state files keep working.  The values are kept in memory
+and a file is only written when a key is added or removed or, for a value
+that changes, at most once every `interval` seconds.  Files are replaced
+atomically so that a crash never leaves a partial state file behind.
+"""
+
+import os
+import time
+
+
+# Suffix used for files that are being written
+_TEMP_SUFFIX = '.tmp'
+
+
+def fsync_directory(path):
+    """
+    Flush a directory entry change, i.e., a rename or unlink, to disk.
+    """
+    
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class StateStore(object):
+    """
+    In-memory view of a state directory with write-behind persistence.
+    """
+    
+    def __init__(self, directory, interval=60.0):
+        self.directory = directory
+        self.interval = interval
+        
+        if not os.path.exists(self.directory):
+            os.mkdir(self.directory)
+        elif not os.path.isdir(self.directory):
+            raise RuntimeError("'%s' is not a directory" % self.directory)
+            
+        self._values = {}
+        self._written = {}
+        self._dirty = set()
+        self.load()
+        
+    def load(self):
+        """
+        (Re)load all of the keys from the state directory.
+        """
+        
+        self._values.clear()
+        self._written.clear()
+        self._dirty.clear()
+        for name in os.listdir(self.directory):
+            filename = os.path.join(self.directory, name)
+            if name.endswith(_TEMP_SUFFIX):
+                ## Left over from a crash during a write
+                try:
+                    os.unlink(filename)
+                except OSError:
+                    pass
+                continue
+            if not os.path.isfile(filename):
+                continue
+            try:
+                with open(filename, 'r') as fh:
+                    self._values[name] = fh.read()
+                self._written[name] = os.path.getmtime(filename)
+            except (OSError, IOError, UnicodeDecodeError):
+                pass
+                
+    def __contains__(self, name):
+        return name in self._values
+        
+    def get(self, name, default=None):
+        """
+        Return the value of a key or `default` if it is not set.
+        """
+        
+        return self._values.get(name, default)
+        
+    def set(self, name, value):
+        """
+        Set a key.  A new key is written out right away while a change to an
+        existing key is written out once `interval` seconds have passed since
+        the last write.
+        """
+        
+        value = str(value)
+        if name not in self._values:
+            self._values[name] = value
+            self._write(name)
+            return
+            
+        if self._values[name] != value:
+            self._values[name] = value
+            self._dirty.add(name)
+        if name in self._dirty and time.time() - self._written.get(name, 0) >= self.interval:
+            self._write(name)
+            
+    def delete(self, name):
+        """
+        Remove a key and its file.
+        """
+        
+        if name not in self._values:
+            return
+        del self._values[name]
+        self._written.pop(name, None)
+        self._dirty.discard(name)
+        try:
+            os.unlink(os.path.join(self.directory, name))
+        except OSError:
+            pass
+        fsync_directory(self.directory)
+        
+    def flush(self):
+        """
+        Write out every key with a change that has not been persisted.
+        """
+        
+        for name in list(self._dirty):
+            self._write(name)
+            
+    def close(self):
+        self.flush()
+        
+    def _write(self, name):
+        filename = os.path.join(self.directory, name)
+        tempname = filename + _TEMP_SUFFIX
+        with open(tempname, 'w') as fh:
+            fh.write(self._values[name])
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tempname, filename)
+        fsync_directory(self.directory)
+        
+        self._written[name] = time.time()
+        self._dirty.discard(name)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Power quality statistics from the voltage_120.log and voltage_240.log archive
+written by voltageMonitor.py.  The logs, including the rotated .gz copies, are
+read in large chunks straight into NumPy arrays with each file handled by a
+separate worker process.  Logs that have been indexed by 'lvmlogs.py index'
+are only read around the requested date range.  The result is a table of
+sample count, minimum, mean, maximum, and time spent out of tolerance for
+every minute, hour, or day in a date range.  The logs of an additional board
+are picked out by their channel prefix, i.e., 'B2-' for voltage_B2-120.log.
+"""
+
+import os
+import json
+import numpy
+import argparse
+import json_minify
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from lvmlogs import _parse_time, logs_in_range, read_log
+
+
+# Table resolutions in seconds
+RESOLUTIONS = {'minute': 60, 'hour': 3600, 'day': 86400}
+
+# Longest gap between samples that still counts towards the out of
+# tolerance time
+MAX_GAP = 2.0
+
+# Table row layout
+STATS_DTYPE = numpy.dtype([('t', '<f8'), ('count', '<i8'), ('sum', '<f8'),
+                           ('min', '<f8'), ('max', '<f8'), ('oot', '<f8')])
+
+
+def _reduce(bins, count, total, vmin, vmax, oot):
+    """
+    Combine entries that fall into the same time bin and return a STATS_DTYPE
+    array sorted by time.
+    """
+    
+    order = numpy.argsort(bins, kind='stable')
+    bins = bins[order]
+    starts = numpy.flatnonzero(numpy.r_[True, bins[1:] != bins[:-1]]) if bins.size else numpy.zeros(0, dtype=numpy.intp)
+    
+    stats = numpy.zeros(starts.size, dtype=STATS_DTYPE)
+    if starts.size:
+        stats['t'] = bins[starts]
+        stats['count'] = numpy.add.reduceat(count[order], starts)
+        stats['sum'] = numpy.add.reduceat(total[order], starts)
+        stats['min'] = numpy.fmin.reduceat(vmin[order], starts)
+        stats['max'] = numpy.fmax.reduceat(vmax[order], starts)
+        stats['oot'] = numpy.add.reduceat(oot[order], starts)
+    return stats
+
+
+def summarize(data, low, high, resolution=60, max_gap=MAX_GAP):
+    """
+    Summarize an N by 2 array of (time, voltage) samples into a STATS_DTYPE
+    array with one entry per `resolution` seconds.  A sample is out of
+    tolerance if it is outside of [`low`, `high`] and it counts for the time
+    until the next sample, up to `max_gap` seconds.
+    """
+    
+    if data.shape[0] == 0:
+        return numpy.zeros(0, dtype=STATS_DTYPE)
+        
+    data = data[numpy.argsort(data[:,0], kind='stable')]
+    t, v = data[:,0], data[:,1]
+    
+    dt = numpy.diff(t)
+    dt = numpy.r_[dt, numpy.median(dt) if dt.size else 0.0]
+    dt = numpy.clip(dt, 0.0, max_gap)
+    bad = ~((v >= low) & (v <= high))
+    
+    bins = numpy.floor(t / resolution) * resolution
+    return _reduce(bins, numpy.ones(t.size, dtype=numpy.int64), v, v, v, numpy.where(bad, dt, 0.0))
+
+
+def combine(tables, resolution=60):
+    """
+    Merge a collection of STATS_DTYPE arrays and roll them up to `resolution`
+    seconds, which needs to be a multiple of the resolution of the inputs.
+    """
+    
+    tables = [table for table in tables if table.size]
+    if not tables:
+        return numpy.zeros(0, dtype=STATS_DTYPE)
+    stats = numpy.concatenate(tables)
+    
+    bins = numpy.floor(stats['t'] / resolution) * resolution
+    return _reduce(bins, stats['count'], stats['sum'], stats['min'], stats['max'], stats['oot'])
+
+
+def _analyze_file(filename, t0, t1, low, high, max_gap):
+    """
+    Worker that reads the samples between `t0` and `t1` from a single log and
+    returns their per-minute statistics.
+    """
+    
+    data = read_log(filename, t0, t1)
+    data = data[data[:,0] < t1]
+    return summarize(data, low, high, resolution=RESOLUTIONS['minute'], max_gap=max_gap)
+
+
+def analyze(log_directory, names, limits, t0, t1, resolution=3600, max_gap=MAX_GAP, processes=None):
+    """
+    Compute the statistics for each of the logs in `names`, i.e.,
+    'voltage_120.log', between times `t0` and `t1`.  `limits` is a list of
+    (low, high) tolerances, one per log.  The files are spread across a pool
+    of `processes` worker processes.  Returns a list of STATS_DTYPE arrays,
+    one per log.
+    """
+    
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = []
+        for name,(low,high) in zip(names, limits):
+            futures.append([pool.submit(_analyze_file, filename, t0, t1, low, high, max_gap)
+                            for filename in logs_in_range(log_directory, name, t0, t1)])
+                            
+        return [combine([future.result() for future in jobs], resolution=resolution) for jobs in futures]
+
+
+def format_table(name, stats, resolution):
+    """
+    Format a STATS_DTYPE array as a text table.
+    """
+    
+    if resolution >= 86400:
+        tFmt = "%Y-%m-%d"
+    else:
+        tFmt = "%Y-%m-%d %H:%M"
+        
+    lines = ["%s:" % name,
+             "%16s  |  %7s  |  %7s  |  %7s  |  %7s  |  %9s" % ('Start (UTC)', 'Samples', 'Min', 'Mean', 'Max', 'OoT [s]'),
+             "-"*(16 + 7*4 + 9 + 5*5)]
+    for entry in stats:
+        lines.append("%16s  |  %7i  |  %7.1f  |  %7.1f  |  %7.1f  |  %9.1f" % (datetime.utcfromtimestamp(entry['t']).strftime(tFmt),
+                                                                              entry['count'], entry['min'],
+                                                                              entry['sum'] / entry['count'],
+                                                                              entry['max'], entry['oot']))
+    return '\n'.join(lines)
+
+
+def main(args):
+    # Parse the configuration file for the tolerances
+    with open(args.config_file, 'r') as ch:
+        config = json.loads(json_minify.json_minify(ch.read()))
+        
+    # A board with a channel prefix uses the limits of the plain channel
+    # unless it has its own
+    channels = ('120', '240') if args.channel is None else (args.channel,)
+    names = ['voltage_%s%s.log' % (args.prefix, channel) for channel in channels]
+    limits = []
+    for channel in channels:
+        limit = config['limits'].get('%s%sV' % (args.prefix, channel), config['limits']['%sV' % channel])
+        limits.append((limit['low'], limit['high']))
+        
+    resolution = RESOLUTIONS[args.resolution]
+    results = analyze(args.log_directory, names, limits, args.start, args.stop, resolution=resolution,
+                      max_gap=args.max_gap, processes=args.processes)
+    for channel,stats in zip(channels, results):
+        print(format_table('%s%s VAC' % (args.prefix, channel), stats, resolution))
+        print('')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='compute per-minute, per-hour, or per-day voltage statistics from the voltage logs',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+            )
+    parser.add_argument('-l', '--log-directory', type=str, default='/lwa/LineMonitoring/logs/',
+                        help='directory containing the voltage logs')
+    parser.add_argument('-c', '--config-file', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'defaults.json'),
+                        help='filename for the configuration file with the voltage limits')
+    parser.add_argument('-v', '--channel', type=str, choices=('120', '240'),
+                        help='only report on this voltage channel')
+    parser.add_argument('-b', '--prefix', type=str, default='',
+                        help='channel prefix of the board for a multi-board monitor')
+    parser.add_argument('-r', '--resolution', type=str, default='day', choices=('minute', 'hour', 'day'),
+                        help='time resolution of the table')
+    parser.add_argument('-g', '--max-gap', type=float, default=MAX_GAP,
+                        help='longest gap in seconds between samples that counts towards the out of tolerance time')
+    parser.add_argument('-j', '--processes', type=int,
+                        help='number of worker processes; default is one per CPU')
+    parser.add_argument('start', type=_parse_time,
+                        help='start of the range as a UNIX timestamp or UTC YYYY-MM-DD HH:MM[:SS]')
+    parser.add_argument('stop', type=_parse_time,
+                        help='end of the range as a UNIX timestamp or UTC YYYY-MM-DD HH:MM[:SS]')
+    args = parser.parse_args()
+    
+    main(args)
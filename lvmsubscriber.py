@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Asyncio based subscriber for the multicast data sent by voltageMonitor.py.
+A Subscriber joins one or more multicast groups, decodes each datagram once,
+and hands the records to any number of Handler instances so that a single
+process can print, plot, record, and send alerts at the same time.  Groups
+that go quiet for too long are re-joined.
+"""
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+
+from lvmpacket import LVMPacketError, SequenceTracker, decode_datagram
+
+
+def open_multicast_socket(mcastAddr, mcastPort):
+    """
+    Return a UDP socket that is bound to `mcastPort` and has joined the
+    multicast group at `mcastAddr`.
+    """
+    
+    #create a UDP socket
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    #allow multiple sockets to use the same PORT number
+    sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+    #Bind to the port that we know will receive multicast data
+    sock.bind(("0.0.0.0", mcastPort))
+    #tell the kernel that we are a multicast socket
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 20)
+    #Tell the kernel that we want to add ourselves to a multicast group
+    #The address for the multicast group is the third param
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                    socket.inet_aton(mcastAddr) + socket.inet_aton("0.0.0.0"))
+    sock.setblocking(0)
+    
+    return sock
+
+
+class Handler(object):
+    """
+    Base class for something that consumes decoded records.  `interval` is
+    the time in seconds between calls to on_tick(), or None to never call it.
+    """
+    
+    interval = None
+    
+    def on_start(self, subscriber):
+        """
+        Called once the groups have been joined.
+        """
+        
+        pass
+        
+    def on_records(self, records, group):
+        """
+        Called with the list of LVMRecords decoded from each datagram and the
+        (address, port) of the group it came in on.
+        """
+        
+        pass
+        
+    def on_dropped(self, missed, group):
+        """
+        Called with the number of binary packets lost on a group.
+        """
+        
+        pass
+        
+    def on_timeout(self, group):
+        """
+        Called when nothing has been received on a group for the subscriber's
+        timeout and it is about to be re-joined.
+        """
+        
+        pass
+        
+    def on_tick(self):
+        """
+        Called every `interval` seconds.
+        """
+        
+        pass
+        
+    def on_stop(self):
+        """
+        Called when the subscriber shuts down.
+        """
+        
+        pass
+
+
+class RecordHandler(Handler):
+    """
+    Handler that appends every record to a text file as
+    'time  kind  name  value'.
+    """
+    
+    interval = 10.0
+    
+    def __init__(self, filename):
+        self.fh = open(filename, 'a')
+        
+    def on_records(self, records, group):
+        for rec in records:
+            value = '%.2f' % rec.value if rec.value is not None else '-'
+            self.fh.write("%.6f  %s  %s  %s\n" % (rec.t, rec.kind, rec.name, value))
+            
+    def on_tick(self):
+        self.fh.flush()
+        
+    def on_stop(self):
+        self.fh.close()
+
+
+class _Protocol(asyncio.DatagramProtocol):
+    def __init__(self, subscriber, group):
+        self.subscriber = subscriber
+        self.group = group
+        
+    def datagram_received(self, data, addr):
+        self.subscriber._received(data, self.group)
+        
+    def error_received(self, exc):
+        pass
+
+
+class Subscriber(object):
+    """
+    Receive, decode, and fan out the multicast data on a collection of
+    (address, port) groups.  A group that has been quiet for `timeout`
+    seconds is re-joined.
+    """
+    
+    def __init__(self, groups, timeout=60.0):
+        self.groups = [(addr, int(port)) for addr,port in groups]
+        self.timeout = timeout
+        self.handlers = []
+        
+        self.trackers = dict([(group, SequenceTracker()) for group in self.groups])
+        self.received = 0
+        self.invalid = 0
+        self.timeouts = 0
+        
+        self._transports = {}
+        self._last = {}
+        
+    def add_handler(self, handler):
+        self.handlers.append(handler)
+        return handler
+        
+    def _call_one(self, handler, method, *args):
+        try:
+            getattr(handler, method)(*args)
+        except Exception as e:
+            print("ERROR: %s.%s failed - %s" % (type(handler).__name__, method, str(e)))
+            
+    def _call(self, method, *args):
+        for handler in self.handlers:
+            self._call_one(handler, method, *args)
+            
+    def _received(self, data, group):
+        self._last[group] = time.monotonic()
+        self.received += 1
+        
+        try:
+            seq, records = decode_datagram(data)
+        except LVMPacketError:
+            self.invalid += 1
+            return
+        if seq is not None:
+            missed = self.trackers[group].update(seq)
+            if missed:
+                self._call('on_dropped', missed, group)
+        if records:
+            self._call('on_records', records, group)
+            
+    async def _join(self, group):
+        loop = asyncio.get_running_loop()
+        try:
+            self._transports[group].close()
+        except KeyError:
+            pass
+        sock = open_multicast_socket(*group)
+        self._transports[group], protocol = await loop.create_datagram_endpoint(lambda: _Protocol(self, group), sock=sock)
+        self._last[group] = time.monotonic()
+        
+    async def _watchdog(self):
+        while True:
+            await asyncio.sleep(min(1.0, self.timeout))
+            tNow = time.monotonic()
+            for group in self.groups:
+                if tNow - self._last[group] > self.timeout:
+                    self.timeouts += 1
+                    self._call('on_timeout', group)
+                    await self._join(group)
+                    
+    async def _ticker(self, handler):
+        while True:
+            await asyncio.sleep(handler.interval)
+            self._call_one(handler, 'on_tick')
+            
+    async def serve(self):
+        """
+        Join the groups and deliver records to the handlers until cancelled.
+        """
+        
+        for group in self.groups:
+            await self._join(group)
+        self._call('on_start', self)
+        
+        tasks = [asyncio.ensure_future(self._watchdog()),]
+        for handler in self.handlers:
+            if handler.interval is not None:
+                tasks.append(asyncio.ensure_future(self._ticker(handler)))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            for transport in self._transports.values():
+                transport.close()
+            self._transports.clear()
+            
+    def run(self):
+        """
+        Run the subscriber until interrupted and then stop the handlers.
+        """
+        
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._call('on_stop')
+
+
+def main(args):
+    subscriber = Subscriber([(args.address, args.port),] + [(args.address, port) for port in args.extra_port])
+    
+    roles = 0
+    if args.print:
+        from voltageMonitorCLI import PrintHandler
+        subscriber.add_handler(PrintHandler())
+        roles += 1
+    if args.plot:
+        from voltageMonitorGUI import PlotHandler
+        subscriber.add_handler(PlotHandler())
+        roles += 1
+    if args.alert:
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts'))
+        from sendPowerEmail import AlertHandler
+        subscriber.add_handler(AlertHandler(snapshotPort=args.snapshot_port))
+        roles += 1
+    if args.record is not None:
+        subscriber.add_handler(RecordHandler(args.record))
+        roles += 1
+    if roles == 0:
+        raise RuntimeError("Nothing to do, select at least one role")
+        
+    subscriber.run()
+    print('')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='read data from a voltageMonitor.py line voltage monitoring server and print, plot, record, and/or send alerts for it from one process',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+            )
+    parser.add_argument('-a', '--address', type=str, default='224.168.2.10',
+                        help='mulitcast address to connect to')
+    parser.add_argument('-p', '--port', type=int, default=7165,
+                        help='multicast port to connect on')
+    parser.add_argument('-x', '--extra-port', type=int, action='append', default=[],
+                        help='additional multicast port to connect on, i.e., the binary port when the format is \'both\'')
+    parser.add_argument('--print', action='store_true',
+                        help='print the voltages like voltageMonitorCLI.py')
+    parser.add_argument('--plot', action='store_true',
+                        help='plot the voltages like voltageMonitorGUI.py')
+    parser.add_argument('--alert', action='store_true',
+                        help='send e-mail alerts like scripts/sendPowerEmail.py')
+    parser.add_argument('--record', type=str,
+                        help='append all of the records to this file')
+    parser.add_argument('-s', '--snapshot-port', type=int, default=7170,
+                        help='local port of the voltageMonitor.py snapshot server that --alert loads the current state from; 0 disables it')
+    args = parser.parse_args()
+    
+    main(args)
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+"""
+Batched uploader for the rotated voltage logs.  A single process uploads any
+number of files through a small pool of worker threads, each of which keeps
+its own HTTP session open between files.  Failed uploads are retried with a
+backoff and every file that makes it is recorded in a manifest keyed by the
+SHA-256 checksum of its uncompressed contents so that a later run, a file
+renamed by logrotate, or a gzipped log that has been recompressed is not
+uploaded again.
+"""
+
+import os
+import json
+import time
+import zlib
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from lvmstate import fsync_directory
+
+
+# Block size used when computing checksums
+_CHECKSUM_BLOCK = 1024*1024
+
+# HTTP status codes worth retrying
+_RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+
+
+def file_checksum(filename):
+    """
+    Return the hex SHA-256 checksum of the contents of a file.  Gzipped files,
+    including ones made up of several gzip members, are checksummed after
+    decompression so that the checksum does not depend on how they were
+    compressed.
+    """
+    
+    gzipped = filename.endswith('.gz')
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as fh:
+        decomp = zlib.decompressobj(31)
+        while True:
+            data = fh.read(_CHECKSUM_BLOCK)
+            if not data:
+                break
+            if gzipped:
+                while data:
+                    digest.update(decomp.decompress(data))
+                    if decomp.eof:
+                        data = decomp.unused_data
+                        decomp = zlib.decompressobj(31)
+                    else:
+                        data = b''
+            else:
+                digest.update(data)
+    return digest.hexdigest()
+
+
+class Manifest(object):
+    """
+    JSON record of the files that have been uploaded keyed by the checksum
+    returned by file_checksum().  The manifest is rewritten atomically after
+    each file is added so that an interrupted run can pick up where it left
+    off.
+    """
+    
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.load()
+        
+    def load(self):
+        """
+        (Re)load the manifest from disk.  A missing or unreadable manifest is
+        treated as empty.
+        """
+        
+        try:
+            with open(self.filename, 'r') as fh:
+                self._entries = json.load(fh)
+        except (OSError, IOError, ValueError):
+            self._entries = {}
+            
+    def __contains__(self, checksum):
+        with self._lock:
+            return checksum in self._entries
+            
+    def __len__(self):
+        return len(self._entries)
+        
+    def add(self, checksum, filename):
+        """
+        Record a file as uploaded and save the manifest.
+        """
+        
+        with self._lock:
+            self._entries[checksum] = {'name': os.path.basename(filename),
+                                       'size': os.path.getsize(filename),
+                                       'uploaded': time.time()}
+            self._write()
+            
+    def _write(self):
+        tempname = self.filename + '.tmp'
+        with open(tempname, 'w') as fh:
+            json.dump(self._entries, fh, indent=1, sort_keys=True)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tempname, self.filename)
+        fsync_directory(os.path.dirname(os.path.abspath(self.filename)))
+
+
+def plain_post(session, url, data, files, timeout):
+    """
+    Unsigned multipart POST through `session`, i.e., for testing against a
+    local stand-in for the archive.
+    """
+    
+    return session.post(url, data=data, files=files, timeout=timeout)
+
+
+class Uploader(object):
+    """
+    Upload files to `url` as multipart POSTs with the form fields in `fields`
+    and the file in 'file'.  `post` is called as post(session, url, data,
+    files, timeout) and returns a requests.Response, which allows the
+    requests to be signed.  At most `concurrency` uploads are in flight at
+    once and each file is tried up to `retries` times.
+    """
+    
+    def __init__(self, url, fields, post=plain_post, manifest=None, concurrency=4, retries=3, timeout=60.0,
+                       backoff=2.0, verify=True):
+        self.url = url
+        self.fields = dict(fields)
+        self.post = post
+        self.manifest = manifest
+        self.concurrency = max(1, int(concurrency))
+        self.retries = max(1, int(retries))
+        self.timeout = timeout
+        self.backoff = backoff
+        self.verify = verify
+        
+        self._local = threading.local()
+        self._sessions = []
+        self._lock = threading.Lock()
+        
+    def _session(self):
+        """
+        Return the HTTP session for the current worker thread.
+        """
+        
+        try:
+            return self._local.session
+        except AttributeError:
+            session = requests.Session()
+            session.verify = self.verify
+            self._local.session = session
+            with self._lock:
+                self._sessions.append(session)
+            return session
+            
+    def _close(self):
+        """
+        Close all of the worker sessions.
+        """
+        
+        with self._lock:
+            for session in self._sessions:
+                session.close()
+            self._sessions = []
+            
+    def _send(self, filename):
+        """
+        Upload a single file, retrying on connection errors and on server
+        errors.  Returns None on success or a description of the last error.
+        """
+        
+        session = self._session()
+        error = None
+        for attempt in range(self.retries):
+            try:
+                with open(filename, 'rb') as fh:
+                    response = self.post(session, self.url, self.fields,
+                                         {'file': (os.path.basename(filename), fh)}, self.timeout)
+                try:
+                    if response.ok:
+                        return None
+                    error = "HTTP %i - %s" % (response.status_code, response.text.strip()[:200])
+                    if response.status_code not in _RETRY_STATUS:
+                        return error
+                finally:
+                    response.close()
+            except requests.RequestException as e:
+                error = str(e)
+            if attempt < self.retries-1:
+                time.sleep(min(self.backoff*2**attempt, 60.0))
+        return error
+        
+    def _upload(self, filename):
+        """
+        Upload a file if it is not already in the manifest and return a
+        (filename, status, error) tuple where status is 'uploaded', 'skipped',
+        or 'failed'.
+        """
+        
+        try:
+            checksum = file_checksum(filename)
+        except (OSError, IOError, zlib.error) as e:
+            return filename, 'failed', str(e)
+        if self.manifest is not None and checksum in self.manifest:
+            return filename, 'skipped', None
+            
+        error = self._send(filename)
+        if error is not None:
+            return filename, 'failed', error
+        if self.manifest is not None:
+            self.manifest.add(checksum, filename)
+        return filename, 'uploaded', None
+        
+    def upload(self, filenames, callback=None):
+        """
+        Upload a collection of files and return a dictionary of the number
+        of files uploaded, skipped, and failed.  If `callback` is given it
+        is called with each (filename, status, error) tuple as the files
+        finish.
+        """
+        
+        counts = {'uploaded': 0, 'skipped': 0, 'failed': 0}
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                for result in pool.map(self._upload, filenames):
+                    counts[result[1]] += 1
+                    if callback is not None:
+                        callback(*result)
+        finally:
+            self._close()
+        return counts
@@ -10,22 +10,23 @@ import re
 import sys
 import pytz
 import time
-import uuid
+import signal
 import socket
 import argparse
-import threading
 import subprocess
 from socket import gethostname
 
-import smtplib
-from email.mime.text import MIMEText
-
 import re
 from datetime import datetime, timedelta
 
 from lwa_auth import STORE as LWA_AUTH_STORE
 
-dataRE = re.compile(r'^\[(?P<date>.*)\] (?P<type>[A-Z0-9]*): (?P<data>.*)$')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lvmsubscriber import Handler, Subscriber
+from lvmmetrics import Registry, MetricsServer
+from lvmmail import MailSender
+from lvmstate import StateStore
+from lvmsnapshot import SnapshotError, fetch_snapshot, STATE_FLICKER, STATE_OUTAGE
 
 # Site
 SITE = gethostname().split('-', 1)[0]
@@ -42,11 +43,14 @@ ESRV = store_entry.url
 
 # State directory
 STATE_DIR = os.path.join(os.path.dirname(__file__), '.shl-state')
-if not os.path.exists(STATE_DIR):
-    os.mkdir(STATE_DIR)
-else:
-    if not os.path.isdir(STATE_DIR):
-        raise RuntimeError("'%s' is not a directory" % STATE_DIR)
+
+
+# Metrics - replaced with an enabled registry by main if there is a metrics port
+METRICS = Registry(enabled=False)
+
+
+# E-mail sender - started by AlertHandler
+SENDER = None
 
 
 # Timezones
@@ -91,31 +95,12 @@ def get_uptime():
     return uptime
 
 
-def sendEmail(subject, message, debug=False):
+def sendEmail(subject, message):
     """
-    Send an e-mail via the LWA1 operator list
+    Queue an e-mail to the LWA1 operator list
     """
     
-    message = "%s\n\nEmail ID: %s" % (message, str(uuid.uuid4()))
-    
-    msg = MIMEText(message)
-    msg['Subject'] = subject
-    msg['From'] = FROM
-    msg['To'] = ','.join(TO)
-    msg.add_header('reply-to', TO[0])
-    
-    try:
-        server = smtplib.SMTP(ESRV, 587)
-        if debug:
-            server.set_debuglevel(1)
-        server.starttls()
-        server.login(FROM, PASS)
-        server.sendmail(FROM, TO, msg.as_string())
-        server.close()
-        return True
-    except Exception as e:
-        print("ERROR: failed to send message - %s" % str(e))
-        return False
+    return SENDER.submit(subject, message)
 
 def sendFlicker(flicker120, flicker240):
     """
@@ -182,139 +167,197 @@ def sendClear():
     return sendEmail(subject, message)
 
 
-def _connect(mcastAddr, mcastPort, sock=None, timeout=60):
-    if sock is not None:
-        sock.close()
-        
-    #create a UDP socket
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    #allow multiple sockets to use the same PORT number
-    sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
-    #Bind to the port that we know will receive multicast data
-    sock.bind(("0.0.0.0", mcastPort))
-    #tell the kernel that we are a multicast socket
-    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 20)
-    #Tell the kernel that we want to add ourselves to a multicast group
-    #The address for the multicast group is the third param
-    status = sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
-                             socket.inet_aton(mcastAddr) + socket.inet_aton("0.0.0.0"))
-    # Set the timeout
-    sock.settimeout(timeout)
-    
-    return sock
-
-
-def DLVM(mcastAddr="224.168.2.10", mcastPort=7165):
+class AlertHandler(Handler):
     """
-    Function responsible for reading the UDP multi-cast packets and printing them
-    to the screen.
+    Subscriber handler that tracks flickers and outages and sends e-mails
+    about them.  If `snapshotPort` is given the current state is loaded from
+    voltageMonitor.py's snapshot server at startup.
     """
     
-    #create a UDP socket
-    sock = _connect(mcastAddr, mcastPort)
-    
-    # Setup the flicker trackers
-    flicker120 = False
-    flicker240 = False
-    lastFlicker = 0.0
-    
-    # Setup the outage trackers
-    outage120 = False
-    outage240 = False
-    
-    # Main reading loop
-    try:
-        while True:
+    def __init__(self, snapshotPort=None):
+        self.snapshotPort = snapshotPort
+        
+        # Setup the flicker trackers
+        self.flicker120 = False
+        self.flicker240 = False
+        self.lastFlicker = 0.0
+        
+        # Setup the outage trackers
+        self.outage120 = False
+        self.outage240 = False
+        
+        # Load in the state
+        self.state = StateStore(STATE_DIR)
+        
+        # Setup the metrics
+        self.handleTime = METRICS.histogram('sendpoweremail_handle_seconds', 'Time spent handling each packet')
+        self.events = dict([(kind, METRICS.counter('sendpoweremail_events_total', 'Events received', labels={'kind': kind}))
+                            for kind in ('FLICKER', 'OUTAGE', 'CLEAR')])
+        
+    def on_start(self, subscriber):
+        global SENDER
+        
+        # Start the e-mail sender
+        SENDER = MailSender(ESRV, TO, FROM, username=FROM, password=PASS, registry=METRICS)
+        SENDER.start()
+        
+        # Expose the counters kept by the subscriber
+        METRICS.counter('sendpoweremail_packets_total', 'Multicast packets received', callback=lambda: subscriber.received)
+        METRICS.counter('sendpoweremail_invalid_packets_total', 'Multicast packets that could not be decoded', callback=lambda: subscriber.invalid)
+        METRICS.counter('sendpoweremail_dropped_packets_total', 'Binary packets lost in transit',
+                        callback=lambda: sum([tracker.dropped for tracker in subscriber.trackers.values()]))
+        METRICS.counter('sendpoweremail_socket_timeouts_total', 'Times that no packets were received for 60 s', callback=lambda: subscriber.timeouts)
+        
+        # Catch up with anything that is already going on
+        if self.snapshotPort:
             try:
-                tNow = datetime.utcnow()
-                try:
-                    data, addr = sock.recvfrom(1024)
-                except socket.timeout:
-                    print('Timeout on socket, re-trying...')
-                    sock = _connect(mcastAddr, mcastPort, sock=sock)
-                    continue
+                self._sync(fetch_snapshot(port=self.snapshotPort, timeout=2.0))
+            except SnapshotError as e:
+                print("WARNING: cannot load the current state - %s" % str(e))
+                
+    def _sync(self, snapshot):
+        """
+        Set the flicker and outage state from a voltageMonitor.py snapshot.
+        """
+        
+        tNow = datetime.utcnow()
+        lastFlicker = {}
+        for rec in snapshot.events:
+            if rec.kind == 'FLICKER':
+                lastFlicker[rec.name] = datetime.utcfromtimestamp(rec.t)
+                
+        for name,status in snapshot.states.items():
+            if status == STATE_OUTAGE:
+                if name.find('120V') != -1:
+                    self.flicker120 = False
+                    self.outage120 = True
+                else:
+                    self.flicker240 = False
+                    self.outage240 = True
+            elif status == STATE_FLICKER:
+                if name.find('120V') != -1:
+                    self.flicker120 = lastFlicker.get(name, tNow)
+                else:
+                    self.flicker240 = lastFlicker.get(name, tNow)
                     
-                # RegEx matching for message date, type, and content
-                try:
-                    data = data.decode('ascii')
-                except AttributeError:
-                    pass
-                mtch = dataRE.match(data)
-                if mtch is None:
-                    continue
-                t = datetime.strptime(mtch.group('date'), "%Y-%m-%d %H:%M:%S.%f")
+        self._check(tNow, tNow)
+        
+    def on_timeout(self, group):
+        print('Timeout on socket, re-trying...')
+        
+    def on_dropped(self, missed, group):
+        print("WARNING: %i packet(s) dropped" % missed)
+        
+    def on_records(self, records, group):
+        tStart = time.perf_counter()
+        tNow = datetime.utcnow()
+        
+        for rec in records:
+            t = datetime.utcfromtimestamp(rec.t)
+            if rec.kind in self.events:
+                self.events[rec.kind].inc()
                 
-                # Look for FLICKER, OUTAGE, and CLEAR messages
-                if mtch.group('type') == 'FLICKER':
-                    if mtch.group('data').find('120V') != -1:
-                        flicker120 = t
-                    else:
-                        flicker240 = t
-                        
-                elif mtch.group('type') == 'OUTAGE':
-                    if mtch.group('data').find('120V') != -1:
-                        flicker120 = False
-                        outage120 = True
-                    else:
-                        flicker240 = False
-                        outage240 = True
-                        
-                elif mtch.group('type') == 'CLEAR':
-                    ## Only for outages now
-                    if mtch.group('data').find('120V') != -1:
-                        outage120 = False
-                    else:
-                        outage240 = False
-                        
-                # Age out old flicker events since they are, by definition, transient
-                if flicker120:
-                    if flicker120 < tNow - timedelta(seconds=10):
-                        flicker120 = False
-                if flicker240:
-                    if flicker240 < tNow - timedelta(seconds=10):
-                        flicker240 = False
-                        
-                # Event handling
-                if flicker120 or flicker240:
-                    if time.time() - lastFlicker >= 60:
-                        ## Rate limit the flicker e-mails to only one per minute
-                        op = threading.Thread(target=sendFlicker, args=(flicker120, flicker240))
-                        op.start()
-                        lastFlicker = time.time()
-                        
-                elif outage120 or outage240:
-                    if not os.path.exists(os.path.join(STATE_DIR, 'inPowerFailure')):
-                        op = threading.Thread(target=sendOutage, args=(outage120, outage240))
-                        op.start()
-                        
-                    ## Touch the file to update the modification time.  This is used to track
-                    ## power outages across reboots.
+            # Look for FLICKER, OUTAGE, and CLEAR messages
+            if rec.kind == 'FLICKER':
+                if rec.name.find('120V') != -1:
+                    self.flicker120 = t
+                else:
+                    self.flicker240 = t
+                    
+            elif rec.kind == 'OUTAGE':
+                if rec.name.find('120V') != -1:
+                    self.flicker120 = False
+                    self.outage120 = True
+                else:
+                    self.flicker240 = False
+                    self.outage240 = True
+                    
+            elif rec.kind == 'CLEAR':
+                ## Only for outages now
+                if rec.name.find('120V') != -1:
+                    self.outage120 = False
+                else:
+                    self.outage240 = False
+                    
+        self._check(tNow, t)
+        
+        self.handleTime.observe(time.perf_counter() - tStart)
+        
+    def _check(self, tNow, t):
+        """
+        Send out any e-mails needed for the current flicker and outage state
+        and update the state file.  `tNow` is the current time and `t` is the
+        time of the latest record, both as datetime instances.
+        """
+        
+        state = self.state
+        
+        # Age out old flicker events since they are, by definition, transient
+        if self.flicker120:
+            if self.flicker120 < tNow - timedelta(seconds=10):
+                self.flicker120 = False
+        if self.flicker240:
+            if self.flicker240 < tNow - timedelta(seconds=10):
+                self.flicker240 = False
+                
+        # Event handling
+        if self.flicker120 or self.flicker240:
+            if time.time() - self.lastFlicker >= 60:
+                ## Rate limit the flicker e-mails to only one per minute
+                sendFlicker(self.flicker120, self.flicker240)
+                self.lastFlicker = time.time()
+                
+        elif self.outage120 or self.outage240:
+            if 'inPowerFailure' not in state:
+                sendOutage(self.outage120, self.outage240)
+                
+            ## Update the state file.  This is used to track power outages across
+            ## reboots and is only written out once a minute while the outage lasts.
+            try:
+                state.set('inPowerFailure', '%s\n' % t)
+            except Exception as e:
+                print("ERROR: cannot write state file - %s" % str(e))
+                
+        else:
+            if 'inPowerFailure' in state:
+                if get_uptime() >= 5:
+                    ## Make sure that the machine has been up at least 5 minutes to
+                    ## give shelter a chance to boot/start SHL-MCS as well.
+                    sendClear()
+                    
                     try:
-                        fh = open(os.path.join(STATE_DIR, 'inPowerFailure'), 'w')
-                        fh.write('%s\n' % t)
-                        fh.close()
+                        state.delete('inPowerFailure')
                     except Exception as e:
-                        print("ERROR: cannot write state file - %s" % str(e))
+                        print("ERROR: cannot remove state file - %s" % str(e))
                         
-                else:
-                    if os.path.exists(os.path.join(STATE_DIR, 'inPowerFailure')):
-                        if get_uptime() >= 5:
-                            ## Make sure that the machine has been up at least 5 minutes to
-                            ## give shelter a chance to boot/start SHL-MCS as well.
-                            op = threading.Thread(target=sendClear)
-                            op.start()
-                            
-                            try:
-                                os.unlink(os.path.join(STATE_DIR, 'inPowerFailure'))
-                            except Exception as e:
-                                print("ERROR: cannot remove state file - %s" % str(e))
-                                
-            except socket.error as e:
-                pass
-                
-    except KeyboardInterrupt:
-        sock.close()
-        print('')
+    def on_stop(self):
+        self.state.close()
+        if SENDER is not None:
+            SENDER.stop(timeout=60)
+
+
+def _terminate(signum, frame):
+    """
+    SIGTERM handler that stops the subscriber the same way as a Ctrl-C so that
+    the state is saved and the queued e-mails go out when systemd stops the
+    service.
+    """
+    
+    raise KeyboardInterrupt
+
+
+def DLVM(mcastAddr="224.168.2.10", mcastPort=7165, snapshotPort=7170):
+    """
+    Function responsible for reading the UDP multi-cast packets and sending
+    e-mails about flickers and outages.
+    """
+    
+    signal.signal(signal.SIGTERM, _terminate)
+    
+    subscriber = Subscriber([(mcastAddr, mcastPort),])
+    subscriber.add_handler(AlertHandler(snapshotPort=snapshotPort))
+    subscriber.run()
+    print('')
 
 
 if __name__ == "__main__":
@@ -328,6 +371,10 @@ if __name__ == "__main__":
                         help='multicast port to connect on')
     parser.add_argument('-i', '--pid-file', type=str,
                         help='file to write the current PID to')
+    parser.add_argument('-s', '--snapshot-port', type=int, default=7170,
+                        help='local port of the voltageMonitor.py snapshot server to load the current state from; 0 disables it')
+    parser.add_argument('-m', '--metrics-port', type=int, default=7169,
+                        help='local port to serve Prometheus metrics on; 0 disables the metrics')
     args = parser.parse_args()
     
     # PID file
@@ -336,4 +383,12 @@ if __name__ == "__main__":
         fh.write("%i\n" % os.getpid())
         fh.close()
         
-    DLVM(mcastAddr=args.address, mcastPort=args.port)
+    # Metrics
+    if args.metrics_port > 0:
+        METRICS = Registry()
+        try:
+            MetricsServer(METRICS, args.metrics_port).start()
+        except (OSError, socket.error) as e:
+            print("WARNING: cannot start the metrics server - %s" % str(e))
+            
+    DLVM(mcastAddr=args.address, mcastPort=args.port, snapshotPort=args.snapshot_port)
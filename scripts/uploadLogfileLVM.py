@@ -1,22 +1,133 @@
 #!/usr/bin/env python3
 
+"""
+Upload the rotated voltage logs to the LWA archive from a single process.
+Files that have already been uploaded, as recorded in a manifest keyed by
+checksum, are skipped.
+"""
+
 import os
 import sys
-import time
+import glob
+import argparse
+import threading
 from socket import gethostname
 
-from lwa_auth import KEYS as LWA_AUTH_KEYS
-from lwa_auth.signed_requests import post as signed_post
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lvmupload import Manifest, Uploader, plain_post
 
 URL = "https://lda10g.alliance.unm.edu/metadata/sorter/upload"
 SITE = gethostname().split('-', 1)[0]
 TYPE = "SSLOG"
 
-# Send the update to lwalab
-r = os.path.realpath(sys.argv[1])
-f = signed_post(LWA_AUTH_KEYS.get('shl', kind='private'), URL,
-                data={'site': SITE, 'type': TYPE, 'subsystem': 'LVM'},
-                files={'file': open(r, 'rb')},
-                verify=False) # We don't have a certiticate for lda10g.unm.edu
-print(f.text)
-f.close()
+# Manifest of the files that have already been uploaded
+MANIFEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.upload-manifest.json')
+
+
+class _SessionRequests(object):
+    """
+    Stand-in for the requests module used by lwa_auth.signed_requests that
+    sends the signed requests through the HTTP session of the upload worker
+    making them, so that the connection to the archive is reused between
+    files.  Everything other than the request functions comes from requests.
+    """
+    
+    def __init__(self, module):
+        self._module = module
+        self._local = threading.local()
+        
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+        
+    def request(self, method, url, **kwds):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            return self._module.request(method, url, **kwds)
+        return session.request(method, url, **kwds)
+        
+    def get(self, url, params=None, **kwds):
+        return self.request('GET', url, params=params, **kwds)
+        
+    def post(self, url, data=None, json=None, **kwds):
+        return self.request('POST', url, data=data, json=json, **kwds)
+        
+    def send(self, session, func, *args, **kwds):
+        """
+        Call `func` with any requests that it makes going through `session`.
+        """
+        
+        self._local.session = session
+        try:
+            return func(*args, **kwds)
+        finally:
+            self._local.session = None
+
+
+def get_signed_post():
+    """
+    Return a post function for lvmupload.Uploader that signs the requests
+    with the station key.  lwa_auth does the signing and the request itself
+    is sent through the worker's session.
+    """
+    
+    from lwa_auth import KEYS as LWA_AUTH_KEYS
+    from lwa_auth import signed_requests
+    
+    key = LWA_AUTH_KEYS.get('shl', kind='private')
+    if not isinstance(signed_requests.requests, _SessionRequests):
+        signed_requests.requests = _SessionRequests(signed_requests.requests)
+    pool = signed_requests.requests
+    
+    def post(session, url, data, files, timeout):
+        return pool.send(session, signed_requests.post, key, url, data=data, files=files, timeout=timeout,
+                         verify=False) # We don't have a certiticate for lda10g.unm.edu
+    return post
+
+
+def main(args):
+    filenames = []
+    for pattern in args.filename:
+        filenames.extend(sorted(glob.glob(pattern)) or [pattern,])
+    filenames = [os.path.realpath(filename) for filename in filenames]
+    
+    post = plain_post if args.unsigned else get_signed_post()
+    manifest = Manifest(args.manifest)
+    uploader = Uploader(args.url, {'site': SITE, 'type': TYPE, 'subsystem': 'LVM'}, post=post,
+                        manifest=manifest, concurrency=args.jobs, retries=args.retries,
+                        timeout=args.timeout, verify=False)
+                        
+    def report(filename, status, error):
+        if status == 'failed':
+            print("ERROR: failed to upload '%s' - %s" % (filename, error))
+        elif status == 'uploaded' or args.verbose:
+            print("%s '%s'" % (status.capitalize(), filename))
+            
+    counts = uploader.upload(filenames, callback=report)
+    print("Uploaded %i, skipped %i, failed %i" % (counts['uploaded'], counts['skipped'], counts['failed']))
+    sys.exit(1 if counts['failed'] else 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='upload the rotated voltage logs to the LWA archive',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+            )
+    parser.add_argument('filename', type=str, nargs='*', default=['/lwa/LineMonitoring/logs/voltage_*.log*.gz',],
+                        help='files or glob patterns to upload')
+    parser.add_argument('-u', '--url', type=str, default=URL,
+                        help='upload URL')
+    parser.add_argument('-m', '--manifest', type=str, default=MANIFEST,
+                        help='manifest of files already uploaded')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='maximum number of uploads in flight at once')
+    parser.add_argument('-r', '--retries', type=int, default=3,
+                        help='number of attempts for each file')
+    parser.add_argument('-t', '--timeout', type=float, default=120.0,
+                        help='HTTP timeout in seconds')
+    parser.add_argument('-n', '--unsigned', action='store_true',
+                        help='do not sign the requests, i.e., for testing against a local server')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='also report files that are skipped')
+    args = parser.parse_args()
+    
+    main(args)
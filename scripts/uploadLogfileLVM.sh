@@ -1,4 +1,3 @@
 #!/bin/bash
 
-ls /lwa/LineMonitoring/logs/*.gz | xargs -n1 /lwa/LineMonitoring/scripts/uploadLogfileLVM.py
-
+exec /lwa/LineMonitoring/scripts/uploadLogfileLVM.py '/lwa/LineMonitoring/logs/voltage_*.log*.gz'
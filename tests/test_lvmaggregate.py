@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the windowed statistics in lvmaggregate.
+"""
+
+import os
+import sys
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lvmaggregate import WindowAggregator
+
+
+def _brute(t, values, tNow, window, units):
+    if units == 'samples':
+        stop = numpy.searchsorted(t, tNow, side='right')
+        block = values[max(stop-window, 0):stop]
+    else:
+        block = values[(t > tNow - window) & (t <= tNow)]
+    return {'mean': block.mean(axis=0), 'min': block.min(axis=0), 'max': block.max(axis=0),
+            'rms': numpy.sqrt((block**2).mean(axis=0)), 'std': block.std(axis=0)}
+
+
+def test_matches_brute_force():
+    rng = numpy.random.default_rng(3)
+    t = numpy.cumsum(rng.uniform(0.05, 0.5, 5000))
+    values = numpy.column_stack([240.0 + rng.normal(0, 0.3, t.size), 120.0 + rng.normal(0, 0.2, t.size)])
+    values[1000:1010,0] = 0.0
+    
+    ## The time-based window starts out too small and has to grow
+    for window, units, every in ((4, 'samples', None), (50, 'samples', 7), (30.0, 'seconds', 5.0)):
+        aggregator = WindowAggregator(2, window=window, units=units, every=every,
+                                      statistics=('mean', 'min', 'max', 'rms', 'std'),
+                                      capacity=16 if units == 'seconds' else None)
+        published = []
+        for i in range(0, t.size, 97):
+            published.extend(aggregator.process(t[i:i+97], values[i:i+97]))
+        assert len(published) > 10
+        for tPub,results in published:
+            expected = _brute(t, values, tPub, window, units)
+            for stat in expected:
+                assert numpy.allclose(results[stat], expected[stat], rtol=1e-9, atol=1e-5), (window, stat)
+
+
+def test_std_precision():
+    ## Sub-millivolt noise on top of 240 V
+    rng = numpy.random.default_rng(5)
+    t = numpy.arange(200000) * 0.01
+    values = (240.0 + rng.normal(0, 1e-4, t.size)).reshape(-1, 1)
+    
+    aggregator = WindowAggregator(1, window=1000, statistics=('std', 'mean'), every=200000)
+    tPub, results = aggregator.process(t, values)[-1]
+    assert numpy.isclose(results['std'][0], values[-1000:].std(), rtol=1e-4)
+    assert numpy.isclose(results['mean'][0], values[-1000:].mean(), rtol=1e-12)
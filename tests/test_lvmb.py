@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for reading from the board and for the waveform mode frame decoder
+in lvmb.
+"""
+
+import os
+import sys
+import time
+import numpy
+import pytest
+import serial
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lvmb import LVMB, LVMBReadError, HANGUP_BACKOFF, FrameDecoder, encode_frame, wait_any
+
+
+def _counts(n, start=0):
+    counts = numpy.empty((n, 3), dtype=numpy.uint16)
+    counts[:,0] = 500 + numpy.arange(start, start+n)
+    counts[:,1] = 300 + numpy.arange(start, start+n)
+    counts[:,2] = 1000
+    return counts
+
+
+def test_clean_stream():
+    decoder = FrameDecoder()
+    data = b''.join(encode_frame(i, 1000*10*i, _counts(10, 10*i)) for i in range(5))
+    samples, nBad = decoder.feed(data, tArrive=100.0)
+    
+    assert samples.shape == (50, 3)
+    assert nBad == 0
+    assert decoder.frames == 5
+    assert decoder.bad_frames == 0
+    assert decoder.dropped_frames == 0
+    assert decoder.skipped_bytes == 0
+    assert numpy.allclose(numpy.diff(samples[:,0]), 1e-3)
+    assert samples[-1,0] <= 100.0
+
+
+def test_split_feeds():
+    decoder = FrameDecoder()
+    data = b''.join(encode_frame(i, 1000*10*i, _counts(10, 10*i)) for i in range(5))
+    
+    whole = FrameDecoder().feed(data, tArrive=100.0)[0]
+    parts = [decoder.feed(data[i:i+7], tArrive=100.0)[0] for i in range(0, len(data), 7)]
+    parts = numpy.concatenate(parts)
+    assert parts.shape == whole.shape
+    assert numpy.allclose(parts[:,1:], whole[:,1:])
+    assert decoder.frames == 5
+
+
+def test_resync_after_garbage():
+    decoder = FrameDecoder()
+    garbage = b'\x00\x01\xa5\xff\x13\x37' + b'\xa5'
+    data = garbage + encode_frame(0, 0, _counts(10)) + b'\xde\xad' + encode_frame(1, 10000, _counts(10, 10))
+    samples, nBad = decoder.feed(data, tArrive=100.0)
+    
+    assert samples.shape == (20, 3)
+    assert decoder.frames == 2
+    assert decoder.skipped_bytes == len(garbage) + 2
+    assert decoder.dropped_frames == 0
+
+
+def test_bad_checksum():
+    decoder = FrameDecoder()
+    bad = bytearray(encode_frame(1, 10000, _counts(10, 10)))
+    bad[-1] ^= 0xFF
+    data = encode_frame(0, 0, _counts(10)) + bytes(bad) + encode_frame(2, 20000, _counts(10, 20))
+    samples, nBad = decoder.feed(data, tArrive=100.0)
+    
+    assert decoder.bad_frames == 1
+    assert decoder.frames == 2
+    assert samples.shape == (20, 3)
+    ## The corrupted frame is also seen as a gap in the sequence
+    assert decoder.dropped_frames == 1
+
+
+def test_dropped_sequence():
+    decoder = FrameDecoder()
+    data = encode_frame(254, 0, _counts(10)) + encode_frame(255, 10000, _counts(10, 10)) \
+           + encode_frame(2, 40000, _counts(10, 40))
+    samples, nBad = decoder.feed(data, tArrive=100.0)
+    
+    assert decoder.frames == 3
+    assert decoder.dropped_frames == 2
+    assert decoder.bad_frames == 0
+    ## Samples after the gap keep their place on the board's clock
+    assert numpy.isclose(samples[20,0] - samples[19,0], 0.021)
+
+
+def test_micros_wraparound():
+    decoder = FrameDecoder()
+    start = 2**32 - 15000
+    data = b''.join(encode_frame(i, start + 10000*i, _counts(10, 10*i)) for i in range(4))
+    samples, nBad = decoder.feed(data, tArrive=100.0)
+    
+    assert samples.shape == (40, 3)
+    assert decoder.dropped_frames == 0
+    assert numpy.allclose(numpy.diff(samples[:,0]), 1e-3)
+    
+    ## And again across separate feeds
+    decoder = FrameDecoder()
+    times = [decoder.feed(encode_frame(i, start + 10000*i, _counts(10, 10*i)), tArrive=100.0 + 0.01*i)[0]
+             for i in range(4)]
+    times = numpy.concatenate(times)[:,0]
+    assert numpy.all(numpy.diff(times) > 0)
+    assert numpy.allclose(numpy.diff(times)[[9, 19, 29]], 1e-3, atol=1e-4)
+
+
+def test_decimation():
+    decoder = FrameDecoder(decimate=4)
+    samples, nBad = decoder.feed(encode_frame(0, 0, _counts(10)), tArrive=100.0)
+    assert samples.shape == (2, 3)
+    samples, nBad = decoder.feed(encode_frame(1, 10000, _counts(10, 10)), tArrive=100.01)
+    assert samples.shape == (3, 3)
+
+
+class _Port(object):
+    """
+    Serial port stand-in that returns one block of bytes and then stops the
+    reader that it belongs to.
+    """
+    
+    timeout = 1.0
+    
+    def __init__(self, board, data):
+        self.board = board
+        self.data = data
+        
+    @property
+    def in_waiting(self):
+        return len(self.data)
+        
+    def read(self, size):
+        data, self.data = self.data, b''
+        if not data:
+            self.board._running = False
+        return data
+
+
+def test_frame_reader_overrun():
+    board = LVMB.__new__(LVMB)
+    board.read_errors = board.parse_errors = board.overruns = 0
+    board._decoder = FrameDecoder()
+    board._ring = numpy.zeros((16, 3), dtype=numpy.float64)
+    board._written = board._drained = 0
+    board._cond = threading.Condition()
+    board._epoch = 0.0
+    board._running = True
+    board.port = _Port(board, encode_frame(0, 0, _counts(40)))
+    board._frame_reader()
+    
+    samples = board.drain()
+    assert samples.shape == (16, 3)
+    assert board.overruns == 24
+
+
+def _pty_meter():
+    master, slave = os.openpty()
+    return master, slave, LVMB(os.ttyname(slave))
+
+
+def test_read_block_and_wait_any():
+    master1, slave1, meter1 = _pty_meter()
+    master2, slave2, meter2 = _pty_meter()
+    try:
+        assert wait_any([meter1, meter2], 0.1) == []
+        assert meter1.read_block().shape == (0, 3)
+        
+        ## Complete lines are returned and a partial one is held back
+        os.write(master2, b'240.1  120.1\n240.2  120.2\n240.3  ')
+        assert wait_any([meter1, meter2], 1.0) == [meter2,]
+        time.sleep(0.05)
+        block = meter2.read_block()
+        assert block.shape == (2, 3)
+        assert numpy.allclose(block[:,1:], [[240.1, 120.1], [240.2, 120.2]])
+        assert numpy.all(block[:,0] <= time.time())
+        
+        os.write(master2, b'120.3\n')
+        assert meter2.wait(1.0)
+        time.sleep(0.05)
+        block = meter2.read_block()
+        assert numpy.allclose(block[:,1:], [[240.3, 120.3],])
+    finally:
+        for meter, master, slave in ((meter1, master1, slave1), (meter2, master2, slave2)):
+            meter.close()
+            os.close(master)
+            os.close(slave)
+
+
+class _BrokenPort(object):
+    """
+    Serial port stand-in for a board that has been unplugged.
+    """
+    
+    timeout = 1.0
+    
+    @property
+    def in_waiting(self):
+        raise OSError(5, 'Input/output error')
+        
+    def fileno(self):
+        raise serial.SerialException('Port not open')
+        
+    def read(self, size):
+        raise serial.SerialException('device reports readiness to read but returned no data')
+
+
+def test_unplugged():
+    board = LVMB.__new__(LVMB)
+    board.threaded = False
+    board.waveform = False
+    board.read_errors = 0
+    board.port = _BrokenPort()
+    
+    for call in (board.ready, lambda: board.wait(0.1), lambda: wait_any([board,], 0.1), board.read_block):
+        with pytest.raises(LVMBReadError):
+            call()
+    assert board.read_errors == 4
+
+
+class _HungUpPort(object):
+    """
+    Serial port stand-in that is always readable but never has anything to
+    read, like a board at the other end of a closed connection.
+    """
+    
+    timeout = 1.0
+    in_waiting = 0
+    
+    def __init__(self):
+        self.fd, write = os.pipe()
+        os.close(write)
+        
+    def fileno(self):
+        return self.fd
+
+
+def test_hangup_backoff():
+    board = LVMB.__new__(LVMB)
+    board.threaded = False
+    board.port = _HungUpPort()
+    try:
+        t0 = time.time()
+        assert wait_any([board,], 5.0) == []
+        assert 0.9*HANGUP_BACKOFF <= time.time() - t0 < 5.0
+    finally:
+        os.close(board.port.fd)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the flicker/outage/clear event engine in lvmevents.
+"""
+
+import os
+import sys
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lvmevents import *
+
+
+def _engine(**kwds):
+    options = {'flicker': 0.0, 'outage': 0.5, 'clear': 5.0, 'range_events': False}
+    options.update(kwds)
+    return EventEngine(('120V', '240V'), (110.0, 230.0), (130.0, 250.0), **options)
+
+
+def _samples(rate=100.0, duration=20.0):
+    t = 1000.0 + numpy.arange(int(rate*duration)) / rate
+    values = numpy.empty((t.size, 2))
+    values[:,0] = 120.0
+    values[:,1] = 240.0
+    ## A 0.1 s flicker on 120V and a 2 s outage on 240V
+    values[(t >= 1002.0) & (t < 1002.1), 0] = 0.0
+    values[(t >= 1005.0) & (t < 1007.0), 1] = 0.0
+    return t, values
+
+
+def _summary(events):
+    return [(round(float(e.t), 6), e.name, e.kind) for e in events]
+
+
+def test_flicker_outage_clear():
+    engine = _engine()
+    t, values = _samples()
+    events = engine.process(t, values)
+    
+    assert _summary(events) == [(1002.0, '120V', EVENT_FLICKER),
+                                (1002.5, '120V', EVENT_FLICKER_CLEAR),
+                                (1005.0, '240V', EVENT_FLICKER),
+                                (1005.5, '240V', EVENT_OUTAGE),
+                                (1007.0, '240V', EVENT_FLICKER_CLEAR),
+                                (1010.0, '240V', EVENT_CLEAR)]
+    assert numpy.isclose(events[3].age, 0.5)
+    assert engine.is_idle()
+
+
+def test_block_size_invariance():
+    t, values = _samples()
+    whole = _summary(_engine(range_events=True).process(t, values))
+    
+    for size in (1, 7, 64, 1000):
+        engine = _engine(range_events=True)
+        events = []
+        for i in range(0, t.size, size):
+            events.extend(engine.process(t[i:i+size], values[i:i+size]))
+        assert _summary(events) == whole
+        
+    ## Single samples passed as scalars
+    engine = _engine(range_events=True)
+    events = []
+    for ti,vi in zip(t[:500], values[:500]):
+        events.extend(engine.process(ti, vi))
+    assert _summary(events) == [e for e in whole if e[0] < t[500]]
+
+
+def test_range_events():
+    t, values = _samples()
+    events = _engine(range_events=True).process(t, values)
+    ranges = [e for e in events if e.kind == EVENT_RANGE]
+    
+    assert len(ranges) == 10 + 200
+    assert all(e.value == 0.0 for e in ranges)
+
+
+def test_debounce():
+    t = numpy.arange(20) * 0.1
+    values = numpy.array([[120.0, 240.0]]*20)
+    values[5:7,0] = 0.0
+    values[12:15,0] = 0.0
+    
+    events = _engine(debounce=3, outage=100.0).process(t, values)
+    assert _summary(events) == [(1.4, '120V', EVENT_FLICKER)]
+    assert numpy.isclose(events[0].age, 0.2)
+
+
+def test_hysteresis():
+    ## Hovering just inside the low limit does not end the excursion
+    t = numpy.arange(40) * 0.1
+    values = numpy.array([[120.0, 240.0]]*40)
+    values[5:10,0] = 109.0
+    values[10:30,0] = 111.0
+    values[30:,0] = 120.0
+    
+    engine = _engine(hysteresis=2.0, outage=1.0, clear=1.0)
+    events = engine.process(t, values)
+    assert _summary(events) == [(0.5, '120V', EVENT_FLICKER),
+                                (1.5, '120V', EVENT_OUTAGE),
+                                (3.0, '120V', EVENT_FLICKER_CLEAR),
+                                (3.0, '120V', EVENT_CLEAR)]
+                                
+    engine = _engine(hysteresis=0.0, outage=1.0, clear=1.0)
+    events = engine.process(t, values)
+    assert _summary(events) == [(0.5, '120V', EVENT_FLICKER),
+                                (1.5, '120V', EVENT_FLICKER_CLEAR)]
+
+
+def test_restore():
+    engine = _engine()
+    engine.restore(engine.index('240V'), 990.0, 1000.0)
+    assert engine.in_outage(1)
+    assert not engine.in_outage(0)
+    
+    t = 1000.0 + numpy.arange(1000) * 0.01
+    values = numpy.array([[120.0, 240.0]]*t.size)
+    events = engine.process(t, values)
+    assert _summary(events) == [(1000.5, '240V', EVENT_FLICKER_CLEAR),
+                                (1005.0, '240V', EVENT_CLEAR)]
+
+
+def test_from_config():
+    config = {'limits': {'120V': {'low': 110.0, 'high': 130.0, 'hysteresis': 1.0},
+                         '240V': {'low': 230.0, 'high': 250.0}},
+              'events': {'flicker': 0.0, 'outage': 0.5, 'clear': 300.0, 'hysteresis': 2.0}}
+    engine = EventEngine.from_config(config, ('120V', 'B2-240V'))
+    
+    assert engine.names == ('120V', 'B2-240V')
+    assert numpy.allclose(engine.low, (110.0, 230.0))
+    assert numpy.allclose(engine.hysteresis, (1.0, 2.0))
+    assert engine.debounce == 1
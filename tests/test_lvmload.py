@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the bulk log parser and its cache in lvmload.
+"""
+
+import os
+import sys
+import gzip
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lvmload import *
+
+
+def _lines(t0, n):
+    rng = numpy.random.default_rng(int(t0))
+    t = t0 + numpy.cumsum(rng.uniform(0.05, 2.0, n))
+    v = rng.uniform(0.0, 260.0, n)
+    return ''.join(['%.2f  %.1f\n' % (ti, vi) for ti,vi in zip(t, v)]).encode()
+
+
+def _expected(data):
+    values = [tuple(float(f) for f in line.split()) for line in data.split(b'\n') if line.strip()]
+    return numpy.array(values, dtype=LOG_DTYPE)
+
+
+def test_parse_exact():
+    data = _lines(1700000000.0, 5000) + b'9.5  0.0\n12  3\n1700000000.123  120.25\n'
+    out = numpy.empty(10000, dtype=LOG_DTYPE)
+    n, nBad = parse_block(data, out)
+    
+    assert (n, nBad) == (5003, 0)
+    expected = _expected(data)
+    ## Exactly the same as float()
+    assert numpy.array_equal(out[:n]['t'], expected['t'])
+    assert numpy.array_equal(out[:n]['v'], expected['v'])
+
+
+def test_parse_malformed():
+    data = b'1700000000.00  120.0\n' \
+           b'\n' \
+           b'1700000001.00  12O.0\n' \
+           b'1700000002.00\n' \
+           b'1700000003.00  121.0  extra\n' \
+           b'   1700000004.00\t122.0  \n' \
+           b'1.7e9  123.0\n' \
+           b'1700000005.00  124.0'
+    out = numpy.empty(8, dtype=LOG_DTYPE)
+    errors = []
+    n, nBad = parse_block(data, out, errors=errors, lineno=10)
+    
+    assert (n, nBad) == (4, 3)
+    assert out[:n].tolist() == [(1700000000.0, 120.0), (1700000004.0, 122.0), (1.7e9, 123.0),
+                                (1700000005.0, 124.0)]
+    assert [lineno for lineno,line in errors] == [12, 13, 14]
+    assert errors[0][1] == '1700000001.00  12O.0'
+    
+    assert parse_block(b'', out) == (0, 0)
+
+
+def test_parse_log(tmp_path):
+    data = _lines(1700000000.0, 20000)
+    plain = str(tmp_path / 'voltage_120.log')
+    with open(plain, 'wb') as fh:
+        fh.write(data + b'1700099999.00  1')
+    with open(str(tmp_path / 'voltage_120.log.1.gz'), 'wb') as fh:
+        fh.write(gzip.compress(data[:len(data)//2]) + gzip.compress(data[len(data)//2:]))
+        
+    samples, consumed, nline = parse_log(str(tmp_path / 'voltage_120.log.1.gz'))
+    assert (consumed, nline) == (len(data), 20000)
+    assert numpy.array_equal(samples, _expected(data))
+    
+    samples, consumed, nline = parse_log(plain)
+    assert nline == 20001 and samples[-1].tolist() == (1700099999.0, 1.0)
+    samples, consumed, nline = parse_log(plain, partial_line=False)
+    assert (consumed, nline) == (len(data), 20000)
+
+
+def test_cache(tmp_path):
+    rotated = str(tmp_path / 'voltage_240.log.1.gz')
+    current = str(tmp_path / 'voltage_240.log')
+    old, new = _lines(1700000000.0, 3000), _lines(1700100000.0, 3000)
+    with open(rotated, 'wb') as fh:
+        fh.write(gzip.compress(old))
+    with open(current, 'wb') as fh:
+        fh.write(new[:-7])
+        
+    errors = []
+    first = load_logs(str(tmp_path), 'voltage_240.log', errors=errors)
+    assert errors == []
+    assert first.size == 6000 - 1
+    assert numpy.array_equal(first, load_logs(str(tmp_path), 'voltage_240.log', cache=False))
+    assert sorted(os.listdir(str(tmp_path / INDEX_DIR))) \
+           == sorted([os.path.basename(cache_filename(f)) for f in (rotated, current)])
+           
+    ## A second load comes from the cache
+    cached = load_log(rotated)
+    assert isinstance(cached, numpy.memmap)
+    assert numpy.array_equal(cached, _expected(old))
+    
+    ## The current log grows, including a bad line, and only the new part is
+    ## parsed
+    with open(current, 'ab') as fh:
+        fh.write(new[-7:] + b'garbage\n' + b'1700200000.00  120.0\n')
+    errors = []
+    grown = load_logs(str(tmp_path), 'voltage_240.log', errors=errors)
+    assert grown.size == 6000 + 1
+    assert numpy.array_equal(grown[:6000], _expected(old + new))
+    assert errors == [(current, 3001, 'garbage')]
+    
+    ## After a rotation the stale cache is removed
+    os.unlink(rotated)
+    assert load_logs(str(tmp_path), 'voltage_240.log').size == 3001
+    assert os.listdir(str(tmp_path / INDEX_DIR)) == [os.path.basename(cache_filename(current))]
+    
+    ## A log replaced by something else is reparsed
+    with open(current, 'wb') as fh:
+        fh.write(new[:-7])
+    assert load_log(current).size == 2999
+    
+    ## Empty logs
+    open(current, 'wb').close()
+    assert load_log(current).size == 0
+
+
+def test_shared_sidecars(tmp_path):
+    import lvmlogs
+    
+    data = _lines(1700000000.0, 20000) + b'1700099999.00  12O.0\n'
+    rotated = str(tmp_path / 'voltage_120.log.1.gz')
+    with open(rotated, 'wb') as fh:
+        fh.write(gzip.compress(data))
+        
+    ## The index and the cache live side by side and build_all() keeps both
+    lvmlogs.build_all(str(tmp_path))
+    samples = load_log(rotated)
+    lvmlogs.build_all(str(tmp_path))
+    names = os.listdir(str(tmp_path / INDEX_DIR))
+    assert os.path.basename(cache_filename(rotated)) in names
+    assert os.path.basename(lvmlogs.index_filename(rotated)) in names
+    
+    ## Windowed reads through the index use the same parser
+    t0, t1 = samples['t'][5000], samples['t'][15000]
+    window = lvmlogs.read_log(rotated, t0, t1)
+    assert numpy.array_equal(window[:,0], samples['t'][5000:15001])
+    assert numpy.array_equal(window[:,1], samples['v'][5000:15001])
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the queued e-mail sender in lvmmail.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lvmmail import *
+
+
+def test_coalesce():
+    sender = MailSender('127.0.0.1', ['ops@localhost',], 'monitor@localhost', coalesce=0.5)
+    sent = []
+    sender._send = lambda subject, message: sent.append((time.time(), subject, message))
+    sender.start()
+    try:
+        ## An isolated alert goes out right away
+        t0 = time.time()
+        sender.submit('Power Outage', 'Alert 0')
+        while not sent and time.time() - t0 < 2.0:
+            time.sleep(0.01)
+        assert len(sent) == 1 and sent[0][0] - t0 < 0.2
+        
+        ## Alerts right after it are held until the window closes and merged
+        sender.submit('Power Flicker', 'Alert 1')
+        sender.submit('Power Flicker', 'Alert 2')
+        time.sleep(1.0)
+        assert len(sent) == 2
+        assert sent[1][0] - sent[0][0] >= 0.45
+        assert sent[1][1] == 'Power Flicker (+1 more)'
+        assert sent[1][2] == 'Alert 1\n\nAlert 2'
+        
+        ## Once the window has passed the next alert is also sent right away
+        t0 = time.time()
+        sender.submit('Power Restored', 'Alert 3')
+        sender.stop(timeout=2.0)
+        assert len(sent) == 3 and sent[2][0] - t0 < 0.2
+    finally:
+        sender.stop(timeout=2.0)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the binary, raw sample, and legacy ASCII datagram formats in
+lvmpacket.
+"""
+
+import os
+import sys
+import numpy
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lvmpacket import *
+
+
+def test_packet_round_trip():
+    items = [('VAC', '120V', 121.5), ('VMIN', '120V', 119.25), ('VMAX', 'B2-240V', 243.0),
+             ('FLICKER', '240V', None), ('OUTAGE', '120V', None), ('CLEAR', 'B2-120V', None)]
+    data = encode_packet(42, 1700000000.125, items)
+    assert is_binary(data) and not is_raw(data)
+    assert len(data) == HEADER.size + len(items)*ITEM.size
+    
+    seq, t, records = decode_packet(data)
+    assert seq == 42
+    assert t == 1700000000.125
+    assert [(r.kind, r.name, r.value) for r in records] == items
+    assert all(r.seq == 42 and r.t == t for r in records)
+    
+    seq, records = decode_datagram(data)
+    assert seq == 42 and len(records) == len(items)
+
+
+def test_packet_edge_cases():
+    ## Empty packets and sequence numbers that wrap
+    seq, t, records = decode_packet(encode_packet(2**32 + 5, 1.0, []))
+    assert seq == 5 and records == []
+    
+    with pytest.raises(LVMPacketError):
+        encode_packet(0, 1.0, [('VAC', '120V', 1.0)]*256)
+    with pytest.raises(LVMPacketError):
+        encode_packet(0, 1.0, [('BOGUS', '120V', 1.0)])
+        
+    data = encode_packet(1, 1.0, [('VAC', '120V', 120.0), ('VAC', '240V', 240.0)])
+    with pytest.raises(LVMPacketError):
+        decode_packet(data[:-1])
+    with pytest.raises(LVMPacketError):
+        decode_packet(data[:HEADER.size-1])
+    with pytest.raises(LVMPacketError):
+        decode_packet(b'XX' + data[2:])
+    with pytest.raises(LVMPacketError):
+        decode_packet(data[:2] + bytes([VERSION+1,]) + data[3:])
+        
+    bad = bytearray(data)
+    bad[HEADER.size + 8] = 0xFF
+    with pytest.raises(LVMPacketError):
+        decode_packet(bytes(bad))
+
+
+def test_raw_round_trip():
+    names = ['120V', '240V', 'B2-120V']
+    t = 1700000000.0 + numpy.arange(50) * 0.001
+    values = numpy.random.default_rng(1).uniform(0, 250, (50, 3))
+    data = encode_raw(7, names, t, values)
+    assert is_raw(data) and not is_binary(data)
+    
+    seq, dNames, dT, dValues = decode_raw(data)
+    assert seq == 7
+    assert dNames == names
+    assert numpy.allclose(dT, t, atol=1e-6)
+    assert numpy.allclose(dValues, values.astype(numpy.float32))
+    
+    seq, records = decode_datagram(data)
+    assert len(records) == 50*3
+    assert all(r.kind == 'VAC' for r in records)
+    assert [r.name for r in records[:3]] == names
+
+
+def test_raw_edge_cases():
+    ## A full packet fits into a single datagram
+    n = raw_capacity(2)
+    data = encode_raw(0, ['120V', '240V'], numpy.arange(n) * 0.001, numpy.zeros((n, 2)))
+    assert len(data) <= MAX_DATAGRAM
+    assert len(encode_raw(0, ['120V', '240V'], numpy.arange(n+1) * 0.001, numpy.zeros((n+1, 2)))) > MAX_DATAGRAM
+    
+    seq, names, t, values = decode_raw(encode_raw(0, ['120V',], [], numpy.zeros((0, 1))))
+    assert names == ['120V',] and t.size == 0 and values.shape == (0, 1)
+    
+    data = encode_raw(3, ['120V',], [1.0, 2.0], [[120.0], [121.0]])
+    with pytest.raises(LVMPacketError):
+        decode_raw(data[:-1])
+    with pytest.raises(LVMPacketError):
+        decode_raw(data[:RAW_HEADER.size-1])
+    with pytest.raises(LVMPacketError):
+        decode_raw(MAGIC + data[2:])
+    with pytest.raises(LVMPacketError):
+        encode_raw(0, ['%i' % i for i in range(256)], [1.0], numpy.zeros((1, 256)))
+
+
+def test_ascii():
+    seq, records = decode_datagram(b'[2024-03-01 12:34:56.250000] 120VAC: 121.50')
+    assert seq is None
+    record, = records
+    assert (record.kind, record.name, record.value) == ('VAC', '120V', 121.5)
+    assert record.t == 1709296496.25
+    
+    seq, records = decode_datagram('[2024-03-01 12:34:56.250000] OUTAGE: 240V')
+    assert (records[0].kind, records[0].name, records[0].value) == ('OUTAGE', '240V', None)
+    
+    ## Off the fast path
+    seq, records = decode_datagram(b'[2024-03-01 12:34:56.25] 240VMAX: 242.0')
+    assert (records[0].kind, records[0].name, records[0].value) == ('VMAX', '240V', 242.0)
+    assert records[0].t == 1709296496.25
+    
+    for bad in (b'garbage', b'[2024-03-01 12:34:56.250000] 120VAC: high', b'[2024-13-01 12:34:56.25] CLEAR: 120V'):
+        with pytest.raises(LVMPacketError):
+            decode_datagram(bad)
+
+
+def test_sequence_tracker():
+    tracker = SequenceTracker()
+    assert [tracker.update(seq) for seq in (10, 11, 14, 15, 3, 4)] == [0, 0, 2, 0, 0, 0]
+    assert tracker.received == 6 and tracker.dropped == 2
+    
+    tracker = SequenceTracker()
+    assert [tracker.update(seq) for seq in (0xFFFFFFFE, 0xFFFFFFFF, 1)] == [0, 0, 1]
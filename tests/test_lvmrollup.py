@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the voltage rollups in lvmrollup.
+"""
+
+import os
+import sys
+import gzip
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lvmrollup import *
+
+
+def test_rollup(tmp_path):
+    t = 1700000000.0 + numpy.arange(3000)*0.16
+    values = numpy.c_[120.0 + numpy.sin(t), 240.0 + numpy.cos(t)]
+    rollup = Rollup(str(tmp_path), ('120V', '240V'))
+    rollup.process(t, values)
+    rollup.close()
+    
+    names, records = load_rollup(rollup_filename(str(tmp_path), 60))
+    assert names == ['120V', '240V']
+    assert records['count'].sum() == t.size
+    assert numpy.all(numpy.diff(records['t']) == 60.0)
+    assert numpy.allclose(records['min'].min(axis=0), values.min(axis=0), atol=1e-4)
+    assert numpy.allclose(records['max'].max(axis=0), values.max(axis=0), atol=1e-4)
+    
+    names, records = load_rollup(rollup_filename(str(tmp_path), 1), t0=t[100], t1=t[200])
+    assert records['t'][0] >= t[100] and records['t'][-1] < t[200]
+
+
+def test_rotated(tmp_path):
+    t = 1700000000.0 + numpy.arange(1000)*0.16
+    rollup = Rollup(str(tmp_path), ('120V',), resolutions=(1, 60))
+    rollup.process(t, numpy.full((t.size, 1), 120.0))
+    rollup.close()
+    
+    ## A copy compressed by logrotate loads the same as the original
+    for resolution in (1, 60):
+        filename = rollup_filename(str(tmp_path), resolution)
+        with open(filename, 'rb') as fh:
+            with gzip.open(filename+'.1.gz', 'wb') as gh:
+                gh.write(fh.read())
+        names, records = load_rollup(filename)
+        gzNames, gzRecords = load_rollup(filename+'.1.gz')
+        assert gzNames == names == ['120V']
+        assert numpy.array_equal(gzRecords, records)
+        
+        names, records = load_rollup(filename, t0=t[300])
+        assert numpy.array_equal(load_rollup(filename+'.1.gz', t0=t[300])[1], records)
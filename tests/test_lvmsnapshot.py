@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the in-memory history and its snapshot format in lvmsnapshot.
+"""
+
+import os
+import sys
+import time
+import numpy
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lvmsnapshot import *
+
+
+def test_round_trip():
+    tNow = time.time()
+    store = SnapshotStore(('120V', '240V', 'B2-120V'), duration=60.0)
+    for i in range(10):
+        t = tNow - 10 + i + numpy.arange(10) * 0.1
+        values = numpy.column_stack([120.0 + t % 1, 240.0 - t % 1])
+        store.add_samples(('120V', '240V'), t, values)
+    store.add_event(tNow - 5, 'FLICKER', '120V')
+    store.add_event(tNow - 4, 'OUTAGE', '240V')
+    store.set_state('240V', STATE_OUTAGE)
+    
+    snapshot = decode_snapshot(store.encode())
+    assert snapshot.names == ['120V', '240V', 'B2-120V']
+    assert snapshot.states == {'120V': STATE_NORMAL, '240V': STATE_OUTAGE, 'B2-120V': STATE_NORMAL}
+    assert abs(snapshot.t - time.time()) < 5
+    
+    t, v = snapshot.samples['120V']
+    assert t.size == 100
+    assert numpy.all(numpy.diff(t) > 0)
+    assert numpy.allclose(v, 120.0 + t % 1, atol=1e-4)
+    assert snapshot.latest('240V')[0] == t[-1]
+    assert snapshot.latest('B2-120V') is None
+    
+    assert [(e.kind, e.name) for e in snapshot.events] == [('FLICKER', '120V'), ('OUTAGE', '240V')]
+    assert snapshot.events[0].t == tNow - 5
+
+
+def test_duration():
+    tNow = time.time()
+    store = SnapshotStore(('120V',), duration=5.0)
+    for i in range(10):
+        store.add_samples(('120V',), tNow - 10 + i + numpy.arange(10) * 0.1, numpy.full((10, 1), 120.0))
+    store.add_samples(('120V',), [], numpy.zeros((0, 1)))
+    store.add_event(tNow - 20, 'CLEAR', '120V')
+    store.add_event(tNow - 1, 'FLICKER', '120V')
+    
+    ## Old blocks and events are expired
+    t, v = decode_snapshot(store.encode()).samples['120V']
+    assert t[0] >= tNow - 6 and t[-1] == tNow - 1 + 0.9
+    assert [e.kind for e in decode_snapshot(store.encode()).events] == ['FLICKER',]
+    
+    ## and only what is asked for is returned
+    snapshot = decode_snapshot(store.encode(duration=2.5))
+    t, v = snapshot.samples['120V']
+    assert t.size > 0 and t[0] >= tNow - 2.5
+    assert len(snapshot.events) == 1
+
+
+def test_invalid():
+    data = SnapshotStore(('120V',)).encode()
+    for bad in (b'', b'XX' + data[2:], data[:2] + b'\x09' + data[3:], data[:-1]):
+        with pytest.raises(SnapshotError):
+            decode_snapshot(bad)
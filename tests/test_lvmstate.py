@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the persistent key/value store in lvmstate.
+"""
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lvmstate import StateStore
+
+
+def _read(directory, name):
+    with open(os.path.join(str(directory), name), 'r') as fh:
+        return fh.read()
+
+
+def test_round_trip(tmp_path):
+    store = StateStore(str(tmp_path / 'state'), interval=3600.0)
+    assert 'outage120' not in store
+    assert store.get('outage120', 'none') == 'none'
+    
+    store.set('outage120', 1700000000.5)
+    assert store.get('outage120') == '1700000000.5'
+    assert _read(tmp_path / 'state', 'outage120') == '1700000000.5'
+    
+    reloaded = StateStore(str(tmp_path / 'state'))
+    assert 'outage120' in reloaded
+    assert reloaded.get('outage120') == '1700000000.5'
+    
+    store.delete('outage120')
+    store.delete('outage120')
+    assert 'outage120' not in store
+    assert os.listdir(str(tmp_path / 'state')) == []
+
+
+def test_write_behind(tmp_path):
+    store = StateStore(str(tmp_path), interval=3600.0)
+    store.set('count', 1)
+    store.set('count', 2)
+    store.set('count', 3)
+    assert store.get('count') == '3'
+    assert _read(tmp_path, 'count') == '1'
+    
+    store.flush()
+    assert _read(tmp_path, 'count') == '3'
+    
+    store.interval = 0.0
+    store.set('count', 4)
+    assert _read(tmp_path, 'count') == '4'
+    
+    store.set('count', 5)
+    store.interval = 3600.0
+    store.close()
+    assert StateStore(str(tmp_path)).get('count') == '5'
+
+
+def test_temp_cleanup(tmp_path):
+    (tmp_path / 'outage240').write_text('123.0')
+    (tmp_path / 'outage240.tmp').write_text('12')
+    (tmp_path / 'subdir').mkdir()
+    
+    store = StateStore(str(tmp_path))
+    assert store.get('outage240') == '123.0'
+    assert 'outage240.tmp' not in store
+    assert 'subdir' not in store
+    assert sorted(os.listdir(str(tmp_path))) == ['outage240', 'subdir']
+
+
+def test_not_a_directory(tmp_path):
+    (tmp_path / 'state').write_text('')
+    with pytest.raises(RuntimeError):
+        StateStore(str(tmp_path / 'state'))
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the upload manifest and the checksums that it is keyed by in
+lvmupload.
+"""
+
+import os
+import sys
+import gzip
+import json
+import hashlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lvmupload import Manifest, Uploader, file_checksum
+from lvmlogs import build_index, chunked_filename
+
+
+class _Response(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.text = ''
+        
+    def close(self):
+        pass
+
+
+class _Archive(object):
+    """
+    Stand-in for the archive that records the names of the files it is sent
+    and fails the first `failures` requests with a 503.
+    """
+    
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.received = []
+        
+    def __call__(self, session, url, data, files, timeout):
+        if self.failures:
+            self.failures -= 1
+            return _Response(503)
+        self.received.append(files['file'][0])
+        return _Response(200)
+
+
+def _write_log(filename, t0, n, members=1):
+    lines = ['%.2f  %.1f\n' % (t0 + 0.1*i, 120.0 + i % 7) for i in range(n)]
+    step = (n + members - 1) // members
+    with open(filename, 'wb') as fh:
+        for i in range(0, n, step):
+            fh.write(gzip.compress(''.join(lines[i:i+step]).encode()))
+    return ''.join(lines).encode()
+
+
+def test_checksum(tmp_path):
+    plain = str(tmp_path / 'voltage_120.log')
+    with open(plain, 'wb') as fh:
+        fh.write(b'1700000000.00  120.0\n')
+    assert file_checksum(plain) == hashlib.sha256(b'1700000000.00  120.0\n').hexdigest()
+    
+    ## Gzipped logs are checksummed by their contents, however they are
+    ## split into members
+    data = _write_log(str(tmp_path / 'a.gz'), 1700000000.0, 5000)
+    _write_log(str(tmp_path / 'b.gz'), 1700000000.0, 5000, members=7)
+    assert file_checksum(str(tmp_path / 'a.gz')) == hashlib.sha256(data).hexdigest()
+    assert file_checksum(str(tmp_path / 'b.gz')) == file_checksum(str(tmp_path / 'a.gz'))
+
+
+def test_checksum_rechunked(tmp_path):
+    filename = str(tmp_path / 'voltage_120.log.2.gz')
+    _write_log(filename, 1700000000.0, 20000)
+    with open(filename, 'rb') as fh:
+        original = fh.read()
+        
+    build_index(filename, step=4096)
+    chunkname = chunked_filename(filename)
+    with open(filename, 'rb') as fh:
+        assert fh.read() == original
+    assert os.path.getsize(chunkname) != len(original)
+    assert file_checksum(chunkname) == file_checksum(filename)
+
+
+def test_manifest(tmp_path):
+    filename = str(tmp_path / 'voltage_120.log.1.gz')
+    _write_log(filename, 1700000000.0, 100)
+    checksum = file_checksum(filename)
+    
+    manifest = Manifest(str(tmp_path / 'manifest.json'))
+    assert len(manifest) == 0 and checksum not in manifest
+    manifest.add(checksum, filename)
+    assert checksum in manifest
+    assert not os.path.exists(str(tmp_path / 'manifest.json.tmp'))
+    
+    reloaded = Manifest(str(tmp_path / 'manifest.json'))
+    assert checksum in reloaded and len(reloaded) == 1
+    with open(str(tmp_path / 'manifest.json'), 'r') as fh:
+        assert json.load(fh)[checksum]['name'] == 'voltage_120.log.1.gz'
+        
+    ## A damaged manifest is treated as empty
+    with open(str(tmp_path / 'manifest.json'), 'w') as fh:
+        fh.write('{"trunc')
+    assert len(Manifest(str(tmp_path / 'manifest.json'))) == 0
+
+
+def test_upload_resume(tmp_path):
+    filenames = []
+    for i in range(5):
+        filenames.append(str(tmp_path / ('voltage_120.log.%i.gz' % (i+1))))
+        _write_log(filenames[-1], 1700000000.0 + 1000*i, 100)
+    manifest = Manifest(str(tmp_path / 'manifest.json'))
+    
+    archive = _Archive(failures=2)
+    uploader = Uploader('http://archive', {'site': 'test'}, post=archive, manifest=manifest,
+                        concurrency=2, retries=3, backoff=0.0)
+    assert uploader.upload(filenames[:3]) == {'uploaded': 3, 'skipped': 0, 'failed': 0}
+    assert sorted(archive.received) == sorted([os.path.basename(f) for f in filenames[:3]])
+    
+    ## Files renamed by logrotate are not sent again
+    renamed = str(tmp_path / 'voltage_120.log.9.gz')
+    os.rename(filenames[0], renamed)
+    filenames[0] = renamed
+    archive = _Archive()
+    uploader = Uploader('http://archive', {'site': 'test'}, post=archive, manifest=Manifest(manifest.filename),
+                        retries=1, backoff=0.0)
+    assert uploader.upload(filenames) == {'uploaded': 2, 'skipped': 3, 'failed': 0}
+    assert sorted(archive.received) == sorted([os.path.basename(f) for f in filenames[3:]])
+    
+    ## Failures are reported and not recorded
+    archive = _Archive(failures=10)
+    extra = str(tmp_path / 'voltage_240.log.1.gz')
+    _write_log(extra, 1800000000.0, 100)
+    uploader = Uploader('http://archive', {'site': 'test'}, post=archive, manifest=manifest,
+                        retries=2, backoff=0.0)
+    results = []
+    counts = uploader.upload([extra, str(tmp_path / 'missing.gz')], callback=lambda *args: results.append(args))
+    assert counts == {'uploaded': 0, 'skipped': 0, 'failed': 2}
+    assert results[0][2].startswith('HTTP 503')
+    assert file_checksum(extra) not in Manifest(manifest.filename)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for running voltageMonitor.py against a simulated board and for its
+multicast data server.
+"""
+
+import os
+import sys
+import json
+import time
+import numpy
+import signal
+import socket
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lvmbsim import LVMBSimulator, Injection, synthetic_samples
+from lvmpacket import decode_raw
+
+_RUNNER = """
+import sys, json
+sys.path.insert(0, sys.argv[3])
+import voltageMonitor
+voltageMonitor.STATE_DIR = sys.argv[2]
+class Args(object):
+    pid_file = None
+    log_file = None
+    debug = False
+    config_file = json.load(open(sys.argv[1]))
+    config_filename = sys.argv[1]
+voltageMonitor.main(Args)
+"""
+
+
+def test_sigterm_persists_state(tmp_path):
+    logs, state = tmp_path / 'logs', tmp_path / 'state'
+    logs.mkdir()
+    
+    ## An outage on 120V that is still going on when the monitor is stopped
+    board = LVMBSimulator(synthetic_samples(), injections=[Injection(0.5, 600.0, channels=('120V',)),])
+    board.start()
+    try:
+        config = {'boards': [{'serial_port': board.port},],
+                  'multicast': {'ip': '224.168.2.10', 'port': 27165},
+                  'log_directory': str(logs), 'metrics': {'enabled': False}, 'snapshot': {'enabled': False},
+                  'limits': {'120V': {'low': 108.0, 'high': 132.0}, '240V': {'low': 216.0, 'high': 264.0}},
+                  'events': {'flicker': 0.0, 'outage': 0.5, 'clear': 300.0}}
+        with open(str(tmp_path / 'config.json'), 'w') as fh:
+            json.dump(config, fh)
+            
+        root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+        monitor = subprocess.Popen([sys.executable, '-c', _RUNNER, str(tmp_path / 'config.json'), str(state), root],
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        tEnd = time.time() + 20
+        while time.time() < tEnd and not os.path.exists(str(state / 'inPowerFailure120')):
+            time.sleep(0.1)
+        monitor.send_signal(signal.SIGTERM)
+        output = monitor.communicate(timeout=20)[0].decode()
+    finally:
+        board.close()
+        
+    assert monitor.returncode == 0, output
+    assert 'Finished' in output
+    
+    ## The outage is saved and the samples buffered since the last flush made
+    ## it to the logs
+    with open(str(state / 'inPowerFailure120'), 'r') as fh:
+        assert abs(float(fh.read()) - time.time()) < 60
+    assert os.path.getsize(str(logs / 'voltage_120.log')) > 0
+    assert os.path.getsize(str(logs / 'voltage_240.log')) > 0
+
+
+def test_raw_flush_without_new_data():
+    from voltageMonitor import dataServer
+    
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.settimeout(0.5)
+    server = dataServer(mcastAddr='127.0.0.1', sendPort=0, raw=True, rawPort=listener.getsockname()[1],
+                        rawDelay=1.0)
+    server.start()
+    try:
+        ## A few samples that do not fill a datagram are held...
+        t = 1700000000.0 + numpy.arange(3)*0.16
+        server.send_raw(('120V', '240V'), t, numpy.array([[120.0, 240.0],]*3))
+        server.flush_raw(t[-1] + 0.5)
+        assert server.packets == 0
+        
+        ## ...until they are older than rawDelay, even if no more arrive
+        server.flush_raw(t[0] + 1.0)
+        seq, names, tRaw, values = decode_raw(listener.recv(65536))
+        assert names == ['120V', '240V']
+        assert numpy.allclose(tRaw, t, atol=1e-3)
+        assert server.packets == 1 and server._pending == {}
+    finally:
+        server.stop()
+        listener.close()
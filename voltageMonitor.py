@@ -13,6 +13,7 @@ import json
 import time
 import numpy
 import serial
+import signal
 import socket
 import argparse
 import threading
@@ -26,7 +27,16 @@ try:
 except ImportError:
     from logging import FileHandler as WatchedFileHandler
 
-from lvmb import LVMB, LVMBError
+from lvmb import LVMB, LVMBError, LVMBReadError, HANGUP_BACKOFF, wait_any
+from lvmcal import load_calibration
+from lvmpacket import encode_packet, encode_raw, raw_capacity
+from lvmevents import EventEngine, EVENT_RANGE, EVENT_FLICKER, EVENT_FLICKER_CLEAR, EVENT_OUTAGE, EVENT_CLEAR
+from lvmlogs import LogIndexWriter
+from lvmrollup import Rollup, RESOLUTIONS as ROLLUP_RESOLUTIONS
+from lvmaggregate import WindowAggregator, STATISTICS
+from lvmmetrics import Registry, MetricsServer, INTERVAL_BUCKETS
+from lvmstate import StateStore
+from lvmsnapshot import SnapshotStore, SnapshotServer, STATE_NORMAL, STATE_FLICKER, STATE_OUTAGE
 
 
 __version__ = '0.2'
@@ -36,13 +46,17 @@ __version__ = '0.2'
 dateFmt = "%Y-%m-%d %H:%M:%S.%f"
 
 
+# Monitored channels on each board, in the order they are processed
+CHANNELS = ('120V', '240V')
+
+
+# Longest channel name, including any board prefix, that fits in a binary
+# packet
+_MAX_NAME_LENGTH = 8
+
+
 # State directory
 STATE_DIR = os.path.join(os.path.dirname(__file__), '.lm-state')
-if not os.path.exists(STATE_DIR):
-    os.mkdir(STATE_DIR)
-else:
-    if not os.path.isdir(STATE_DIR):
-        raise RuntimeError("'%s' is not a directory" % STATE_DIR)
 
 
 class DuplicateFilter(logging.Filter):
@@ -55,11 +69,21 @@ class DuplicateFilter(logging.Filter):
             del kwds['callback']
         except KeyError:
             self.callback = None
+        try:
+            self.histogram = kwds['histogram']
+            del kwds['histogram']
+        except KeyError:
+            self.histogram = None
             
         super(DuplicateFilter, self).__init__(*args, **kwds)
         
-    
     def filter(self, record):
+        if self.histogram is None:
+            return self._filter(record)
+        with self.histogram.time():
+            return self._filter(record)
+            
+    def _filter(self, record):
         # add other fields if you need more granular comparison, depends on your app
         current_log = (record.module, record.levelno, record.msg)
         if record.msg[:4] == '--- ':
@@ -90,11 +114,35 @@ class DuplicateFilter(logging.Filter):
 
 
 class dataServer(object):
-    def __init__(self, mcastAddr="224.168.2.9", mcastPort=7163, sendPort=7164):
+    def __init__(self, mcastAddr="224.168.2.9", mcastPort=7163, sendPort=7164, packetFormat='ascii', binaryPort=None,
+                       raw=False, rawPort=None, rawDelay=1.0):
         self.sendPort  = sendPort
         self.mcastAddr = mcastAddr
         self.mcastPort = mcastPort
         
+        # Packet format - 'ascii', 'binary', or 'both'.  With 'both' the binary
+        # packets go to binaryPort so that legacy ASCII listeners never see them.
+        if packetFormat not in ('ascii', 'binary', 'both'):
+            raise ValueError("Unknown packet format '%s'" % packetFormat)
+        self.packetFormat = packetFormat
+        if binaryPort is None:
+            binaryPort = self.mcastPort if packetFormat == 'binary' else self.mcastPort + 2
+        self.binaryPort = binaryPort
+        self.seq = 0
+        self.packets = 0
+        self.bytes_sent = 0
+        
+        # Raw sample stream - every sample batched into as few datagrams as
+        # possible and sent to rawPort.  No sample is held for more than
+        # rawDelay seconds.
+        self.raw = raw
+        if rawPort is None:
+            rawPort = self.mcastPort + 3
+        self.rawPort = rawPort
+        self.rawDelay = rawDelay
+        self.rawSeq = 0
+        self._pending = {}
+        
         self.sock = None
         
     def start(self):
@@ -106,10 +154,12 @@ class dataServer(object):
         self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 20)
         
     def stop(self):
+        for names in list(self._pending.keys()):
+            self._send_raw(names, flush=True)
         if self.sock is not None:
             self.sock.close()
             self.sock = None
-        
+            
     def send(self, data):
         try:
             data = bytes(data, 'ascii')
@@ -117,7 +167,309 @@ class dataServer(object):
             pass
         if self.sock is not None:
             self.sock.sendto(data, (self.mcastAddr, self.mcastPort) )
+            self.packets += 1
+            self.bytes_sent += len(data)
+            
+    def send_binary(self, t, items):
+        """
+        Send a binary packet with a list of (kind, name, value) items.
+        """
+        
+        data = encode_packet(self.seq, t, items)
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        if self.sock is not None:
+            self.sock.sendto(data, (self.mcastAddr, self.binaryPort) )
+            self.packets += 1
+            self.bytes_sent += len(data)
+            
+    def send_raw(self, names, t, values):
+        """
+        Queue a block of samples with times `t` (length N) and voltages
+        `values` (N by len(names)) for the raw sample stream.  The samples
+        are sent once there are enough of them to fill a datagram or once the
+        oldest one has waited rawDelay seconds, as checked here and by
+        flush_raw().
+        """
+        
+        if not self.raw or len(t) == 0:
+            return
+        names = tuple(names)
+        try:
+            pending = self._pending[names]
+        except KeyError:
+            pending = self._pending[names] = [[], 0, t[0]]
+        pending[0].append((t, values))
+        pending[1] += len(t)
+        if pending[1] >= raw_capacity(len(names)) or t[-1] - pending[2] >= self.rawDelay:
+            self._send_raw(names, flush=(t[-1] - pending[2] >= self.rawDelay))
+            
+    def flush_raw(self, tNow=None):
+        """
+        Send the raw samples for any set of channels whose oldest queued
+        sample is more than rawDelay seconds older than `tNow` (default now).
+        This needs to be called regularly so that samples from a board that
+        has stopped sending are not held indefinitely.
+        """
+        
+        if tNow is None:
+            tNow = time.time()
+        for names,pending in list(self._pending.items()):
+            if tNow - pending[2] >= self.rawDelay:
+                self._send_raw(names, flush=True)
+                
+    def _send_raw(self, names, flush=False):
+        """
+        Send the full datagrams worth of raw samples for a set of channels
+        and, if `flush` is True, whatever is left over as well.
+        """
+        
+        blocks, count, t0 = self._pending.pop(names)
+        t = numpy.concatenate([block[0] for block in blocks])
+        values = numpy.concatenate([block[1] for block in blocks])
+        
+        size = raw_capacity(len(names))
+        end = t.size if flush else (t.size // size) * size
+        for i in range(0, end, size):
+            data = encode_raw(self.rawSeq, names, t[i:i+size], values[i:i+size])
+            self.rawSeq = (self.rawSeq + 1) & 0xFFFFFFFF
+            if self.sock is not None:
+                self.sock.sendto(data, (self.mcastAddr, self.rawPort) )
+                self.packets += 1
+                self.bytes_sent += len(data)
+                
+        if end < t.size:
+            self._pending[names] = [[(t[end:], values[end:]),], t.size - end, t[end]]
+            
+    def send_values(self, t, names, values, kind='VAC'):
+        """
+        Send the voltages, or a voltage statistic of kind `kind`, for a
+        collection of channels at UNIX time `t`.
+        """
+        
+        self.send_statistics(t, names, [(kind, values),])
+        
+    def send_statistics(self, t, names, statistics):
+        """
+        Send a collection of voltage statistics for a collection of channels
+        at UNIX time `t`.  `statistics` is a sequence of (kind, values) tuples
+        with `kind` being 'VAC' for the voltage or one of 'VMIN', 'VMAX',
+        'VRMS', or 'VSTD', and `values` having one entry per channel.
+        """
+        
+        if self.packetFormat != 'binary':
+            tUTC = datetime.utcfromtimestamp(t).strftime(dateFmt)
+            for kind,values in statistics:
+                for name,v in zip(names, values):
+                    self.send("[%s] %s%s: %.2f" % (tUTC, name, kind[1:], v))
+        if self.packetFormat != 'ascii':
+            items = []
+            for kind,values in statistics:
+                items.extend([(kind, name, v) for name,v in zip(names, values)])
+            self.send_binary(t, items)
+            
+    def send_event(self, t, kind, name):
+        """
+        Send a FLICKER, OUTAGE, or CLEAR event for a channel at UNIX time `t`.
+        """
+        
+        if self.packetFormat != 'binary':
+            tUTC = datetime.utcfromtimestamp(t).strftime(dateFmt)
+            self.send("[%s] %s: %s" % (tUTC, kind, name))
+        if self.packetFormat != 'ascii':
+            self.send_binary(t, [(kind, name, None),])
+            
+
+def _channel_label(name):
+    """
+    Return the short label used in filenames for a channel, i.e., '120' for
+    the '120V' channel.
+    """
+    
+    if name.endswith('V'):
+        name = name[:-1]
+    return name
+
+
+def _log_filename(name):
+    """
+    Return the voltage log filename for a channel.
+    """
+    
+    return 'voltage_%s.log' % _channel_label(name)
+
+
+def _state_filename(name):
+    """
+    Return the name of the file in STATE_DIR that tracks an outage on a
+    channel.
+    """
+    
+    return 'inPowerFailure%s' % _channel_label(name)
+
+
+def _board_configs(config):
+    """
+    Return a list of board configurations, each a dictionary with a
+    'serial_port', a channel 'prefix', and the 'waveform' and 'decimate'
+    settings, from the 'boards' section of a configuration dictionary or, if
+    there is no such section, a single board on 'serial_port' with no channel
+    prefix.
+    """
+    
+    boards = config.get('boards', None)
+    if boards is None:
+        boards = [{'serial_port': config['serial_port']},]
+        
+    configs = []
+    for board in boards:
+        prefix = board.get('prefix', '')
+        if len(prefix) + max([len(name) for name in CHANNELS]) > _MAX_NAME_LENGTH:
+            raise ValueError("Channel prefix '%s' is too long" % prefix)
+        configs.append({'serial_port': board['serial_port'], 'prefix': prefix,
+                        'waveform': board.get('waveform', config.get('waveform', False)),
+                        'decimate': int(board.get('decimate', config.get('decimate', 10)))})
+        
+    prefixes = [board['prefix'] for board in configs]
+    if len(set(prefixes)) != len(prefixes):
+        raise ValueError("Each board needs a different channel prefix")
+    return configs
+
+
+class _Board(object):
+    """
+    A voltage monitoring board along with the logs, event detection, rollups,
+    and published statistics for its channels.  The channels are named after
+    CHANNELS with the board's channel prefix in front, i.e., 'B2-120V'.
+    """
+    
+    def __init__(self, meter, port, prefix, config):
+        self.meter = meter
+        self.port = port
+        self.prefix = prefix
+        self.names = tuple([prefix+name for name in CHANNELS])
+        
+        self.logFHs = [open(os.path.join(config['log_directory'], _log_filename(name)), 'a') for name in self.names]
+        self.logIndexers = [LogIndexWriter(fh.name) for fh in self.logFHs]
+        
+        # Setup the event detection engine
+        self.engine = EventEngine.from_config(config, self.names)
+        
+        # Setup the rollups
+        self.rollup = Rollup(config['log_directory'], self.names,
+                             resolutions=config.get('rollups', ROLLUP_RESOLUTIONS), prefix=prefix)
+                             
+        # Setup the aggregator for the published voltages
+        self.aggregator = WindowAggregator.from_config(config, self.engine.nchan)
+        
+        self.t0 = 0.0
+        self.tLastData = time.time()
+        self.tNoData = meter.retries*meter.port.timeout
+        
+    def close(self):
+        self.meter.close()
+        
+        for fh in self.logFHs:
+            try:
+                fh.close()
+            except:
+                pass
+        for indexer in self.logIndexers:
+            indexer.close()
+        self.rollup.close()
+
+
+def _channel_state(engine, channel):
+    """
+    Return the snapshot state of a channel in an event engine.
+    """
+    
+    if engine.in_outage(channel):
+        return STATE_OUTAGE
+    if not numpy.isnan(engine.flicker[channel]):
+        return STATE_FLICKER
+    return STATE_NORMAL
+
+
+def _report_events(events, logger, server, state, snapshot):
+    """
+    Log, persist to the StateStore `state`, multicast, and add to the
+    SnapshotStore `snapshot` a list of events generated by the event engine.
+    """
+    
+    for event in events:
+        name = event.name
+        if event.kind == EVENT_RANGE:
+            logger.warning('%s is out of range at %.1f VAC', name, event.value)
+            
+        elif event.kind == EVENT_FLICKER_CLEAR:
+            logger.info('%s Flicker cleared', name)
+            
+        elif event.kind == EVENT_CLEAR:
+            logger.info('%s Outage cleared', name)
+            
+            state.delete(_state_filename(name))
+                
+            server.send_event(event.t, 'CLEAR', name)
+            snapshot.add_event(event.t, 'CLEAR', name)
+            
+        elif event.kind == EVENT_FLICKER:
+            logger.warning('%s has been out of tolerances for %.1f s (flicker)', name, event.age)
+            server.send_event(event.t, 'FLICKER', name)
+            snapshot.add_event(event.t, 'FLICKER', name)
+            
+        elif event.kind == EVENT_OUTAGE:
+            logger.error('%s has been out of tolerances for %.1f s (outage)', name, event.age)
+            
+            try:
+                state.set(_state_filename(name), "%.6f" % event.t)
+            except (OSError, IOError) as e:
+                logging.error("Could not write %s state file: %s", name, str(e))
+                
+            server.send_event(event.t, 'OUTAGE', name)
+            snapshot.add_event(event.t, 'OUTAGE', name)
+
+
+def _read_config(filename):
+    """
+    Read in a JSON configuration file that may contain comments.
+    """
+    
+    with open(filename, 'r') as ch:
+        return json.loads(json_minify.json_minify(ch.read()))
+
+
+def _reload_calibrations(filename, boards, logger):
+    """
+    Re-read the calibration profiles from the configuration file and apply
+    them to the boards that are in waveform mode.
+    """
+    
+    try:
+        config = _read_config(filename)
+    except (OSError, IOError, ValueError) as e:
+        logger.error('Cannot re-read the configuration file: %s', str(e))
+        return
         
+    for board in boards:
+        if not board.meter.waveform:
+            continue
+        try:
+            calibration = load_calibration(config, board.port)
+        except (ValueError, TypeError) as e:
+            logger.error('Invalid calibration for %s, keeping the old one: %s', board.port, str(e))
+            continue
+        board.meter.set_calibration(calibration)
+        logger.info("Using the '%s' calibration for %s", calibration.name, board.port)
+
+
+def _terminate(signum, frame):
+    """
+    SIGTERM handler that shuts down the same way as a Ctrl-C so that the logs,
+    rollups, and state are flushed when systemd stops the service.
+    """
+    
+    raise KeyboardInterrupt
+
 
 def main(args):
     # PID file
@@ -126,6 +478,19 @@ def main(args):
         fh.write("%i\n" % os.getpid())
         fh.close()
         
+    # Setup the metrics
+    metricsConfig = args.config_file.get('metrics', {})
+    metrics = Registry(enabled=metricsConfig.get('enabled', True))
+    stageTimes = dict([(stage, metrics.histogram('voltagemonitor_stage_seconds', 'Time spent in each stage of the main loop',
+                                                  labels={'stage': stage}))
+                       for stage in ('read', 'log_write', 'rollup', 'events', 'report', 'flush', 'publish')])
+    loopInterval = metrics.histogram('voltagemonitor_loop_interval_seconds', 'Time between main loop passes that received data',
+                                     buckets=INTERVAL_BUCKETS)
+    filterTime = metrics.histogram('voltagemonitor_log_filter_seconds', 'Time spent in the runtime log duplicate filter')
+    samplesRead = metrics.counter('voltagemonitor_samples_total', 'Samples read from the voltage meter')
+    logBytes = metrics.counter('voltagemonitor_log_bytes_total', 'Bytes written to the voltage logs')
+    eventCount = metrics.counter('voltagemonitor_events_total', 'Flicker, outage, and clear events detected')
+    
     # Setup logging
     logger = logging.getLogger(__name__)
     logFormat = logging.Formatter('%(asctime)s [%(levelname)-8s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
@@ -140,7 +505,7 @@ def main(args):
         logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
-    logger.addFilter(DuplicateFilter(callback=logger))
+    logger.addFilter(DuplicateFilter(callback=logger, histogram=filterTime))
     
     # Git information
     try:
@@ -161,228 +526,221 @@ def main(args):
     logger.info('Revision: %s.%s%s', branch, shortsha, dirty)
     logger.info('All dates and times are in UTC except where noted')
     
-    # Connect to the meter
-    meter, r120FH, r240FH = None, sys.stdout, sys.stdout
-    try:
-        meter = LVMB(args.config_file['serial_port'])
-        logger.info('Connected to 240V and 120V meters on %s', args.config_file['serial_port'])
-    except (LVMBError, serial.serialutil.SerialException) as e:
-        meter = None
-        logger.warning('Cannot connect to 240V and 120V meters: %s', str(e))
-        
-    r120FH = open(os.path.join(args.config_file['log_directory'], 'voltage_120.log'), 'a')
-    r240FH = open(os.path.join(args.config_file['log_directory'], 'voltage_240.log'), 'a')
+    # Figure out how we should wait for new data
+    acqMode = args.config_file.get('acquisition', 'sleep')
+    if acqMode not in ('select', 'sleep', 'thread'):
+        logger.warning("Unknown acquisition mode '%s', defaulting to 'sleep'", acqMode)
+        acqMode = 'sleep'
+    logger.info("Using '%s' acquisition mode", acqMode)
     
+    # Connect to the meters.  In 'thread' mode they share a condition so that
+    # the main loop wakes up as soon as any of them has samples.
+    condition = threading.Condition() if acqMode == 'thread' else None
+    boards = []
+    for config in _board_configs(args.config_file):
+        try:
+            calibration = None
+            if config['waveform']:
+                calibration = load_calibration(args.config_file, config['serial_port'])
+                logger.info("Using the '%s' calibration for %s", calibration.name, config['serial_port'])
+            meter = LVMB(config['serial_port'], threaded=(acqMode == 'thread'), condition=condition,
+                         waveform=config['waveform'], decimate=config['decimate'], calibration=calibration)
+            boards.append(_Board(meter, config['serial_port'], config['prefix'], args.config_file))
+            logger.info('Connected to %s and %s meters on %s', boards[-1].names[1], boards[-1].names[0], config['serial_port'])
+        except (LVMBError, serial.serialutil.SerialException) as e:
+            logger.warning('Cannot connect to %s240V and %s120V meters on %s: %s', config['prefix'], config['prefix'], config['serial_port'], str(e))
+            
     # Is there anything to do?
-    if meter is None:
+    if not boards:
         logger.fatal('No voltage meters found, aborting')
         logging.shutdown()
         sys.exit(1)
         
     # Start the data server
     server = dataServer(mcastAddr=args.config_file['multicast']['ip'], mcastPort=int(args.config_file['multicast']['port']), 
-                        sendPort=int(args.config_file['multicast']['port'])+1)
+                        sendPort=int(args.config_file['multicast']['port'])+1,
+                        packetFormat=args.config_file['multicast'].get('format', 'ascii'),
+                        binaryPort=args.config_file['multicast'].get('binary_port', None),
+                        raw=args.config_file['multicast'].get('raw', False),
+                        rawPort=args.config_file['multicast'].get('raw_port', None),
+                        rawDelay=args.config_file['multicast'].get('raw_delay', 1.0))
     server.start()
     
-    # Set the voltage moving average variables
-    voltage120 = []
-    voltage240 = []
-    
-    # Setup the event detection variables
-    start120, flicker120, outage120 = None, False, False
-    start240, flicker240, outage240 = None, False, False
+    # Expose the counters kept by the meters and the data server
+    for board in boards:
+        board.readFailures = metrics.counter('voltagemonitor_read_failures_total', 'Times that no voltages were received from a board within its timeout',
+                                             labels={'board': board.port})
+        for name,attr,help in (('voltagemonitor_serial_read_errors_total', 'read_errors', 'Serial port errors while reading from a board'),
+                               ('voltagemonitor_parse_errors_total', 'parse_errors', 'Lines from the voltage meter that could not be parsed'),
+                               ('voltagemonitor_overruns_total', 'overruns', 'Samples lost because the reader thread buffer overflowed')):
+            metrics.counter(name, help, labels={'board': board.port}, callback=lambda meter=board.meter, attr=attr: getattr(meter, attr))
+        metrics.counter('voltagemonitor_window_truncated_total', 'Samples dropped from a full statistics window',
+                        labels={'board': board.port}, callback=lambda aggregator=board.aggregator: aggregator.truncated)
+        if board.meter.waveform:
+            for name,attr,help in (('voltagemonitor_bad_frames_total', 'bad_frames', 'Waveform frames that failed their checksum'),
+                                   ('voltagemonitor_dropped_frames_total', 'dropped_frames', 'Waveform frames missing from the sequence')):
+                metrics.counter(name, help, labels={'board': board.port}, callback=lambda decoder=board.meter._decoder, attr=attr: getattr(decoder, attr))
+    metrics.counter('voltagemonitor_packets_sent_total', 'Multicast packets sent', callback=lambda: server.packets)
+    metrics.counter('voltagemonitor_bytes_sent_total', 'Multicast bytes sent', callback=lambda: server.bytes_sent)
     
+    # Start the metrics server
+    metricsServer = None
+    if metrics.enabled:
+        try:
+            metricsServer = MetricsServer(metrics, int(metricsConfig.get('port', 7168)),
+                                          address=metricsConfig.get('address', '127.0.0.1'))
+            metricsServer.start()
+            logger.info('Serving metrics on port %i', metricsServer.port)
+        except (OSError, socket.error) as e:
+            metricsServer = None
+            logger.warning('Cannot start the metrics server: %s', str(e))
+            
+    # Setup the recent history for late joiners
+    snapshotConfig = args.config_file.get('snapshot', {})
+    snapshot = SnapshotStore([name for board in boards for name in board.names],
+                             duration=snapshotConfig.get('duration', 600.0))
+                             
     # Load in the state
-    ## 120 VAC
-    try:
-        fh = open(os.path.join(STATE_DIR, 'inPowerFailure120'), 'r')
-        t = float(fh.read())
-        tRestart = time.time()
-        fh.close()
-        
-        start120, flicker120, outage120 = t*1.0, tRestart*1.0, tRestart*1.0
-        logging.info('Restored a saved 120V power outage from disk')
-        
-        #os.unlink(os.path.join(STATE_DIR, 'inPowerFailure120'))
-    except Exception as e:
-        pass
-    ## 240 VAC
-    try:
-        fh = open(os.path.join(STATE_DIR, 'inPowerFailure240'), 'r')
-        t = float(fh.read())
-        tRestart = time.time()
-        fh.close()
-        
-        start240, flicker240, outage240 = t*1.0, tRestart*1.0, tRestart*1.0
-        logging.info('Restored a saved 240V power outage from disk')
-        
-        #os.unlink(os.path.join(STATE_DIR, 'inPowerFailure240'))
-    except Exception as e:
-        pass
-        
+    state = StateStore(STATE_DIR)
+    for board in boards:
+        engine = board.engine
+        for name in engine.names:
+            try:
+                t = float(state.get(_state_filename(name)))
+                tRestart = time.time()
+                
+                engine.restore(engine.index(name), t*1.0, tRestart*1.0)
+                snapshot.set_state(name, STATE_OUTAGE)
+                logging.info('Restored a saved %s power outage from disk', name)
+            except Exception as e:
+                pass
+                
+    # Start the snapshot server
+    snapshotServer = None
+    if snapshotConfig.get('enabled', True):
+        try:
+            snapshotServer = SnapshotServer(snapshot, int(snapshotConfig.get('port', 7170)),
+                                            address=snapshotConfig.get('address', '127.0.0.1'))
+            snapshotServer.start()
+            logger.info('Serving snapshots on port %i', snapshotServer.port)
+        except (OSError, socket.error) as e:
+            snapshotServer = None
+            logger.warning('Cannot start the snapshot server: %s', str(e))
+            
+    # Reload the calibration profiles on SIGHUP
+    reloadRequested = threading.Event()
+    signal.signal(signal.SIGHUP, lambda signum, frame: reloadRequested.set())
+    
+    # Shut down cleanly on SIGTERM
+    signal.signal(signal.SIGTERM, _terminate)
+    
     # Read from the ports forever
     try:
-        t0_120 = 0.0
-        t0_240 = 0.0
+        tLastPass = None
+        tNoData = min([board.tNoData for board in boards])
+        meters = [board.meter for board in boards]
         
         while True:
-            ## Set the (date)time
-            tUTC = datetime.utcnow()
-            
-            ## Read the data
-            if meter is not None:
+            if reloadRequested.is_set():
+                reloadRequested.clear()
+                logger.info('Reloading the calibration profiles')
+                _reload_calibrations(args.config_filename, boards, logger)
+                
+            ## Wait for the next line from any of the Arduinos
+            if acqMode == 'sleep':
+                time.sleep(0.2)
+            else:
                 try:
-                    ### Both voltages come in at the same time
-                    data240, data120 = meter.read()
-                    t = time.time()
-                    
-                    ### Deal with 120V first
-                    v = data120
-                    r120FH.write("%.2f  %.1f\n" % (t, v))
+                    wait_any(meters, tNoData)
+                except LVMBError as e:
+                    ### Back off so that a missing board does not swamp the log.
+                    ### The reads below still pick up the other boards.
+                    logger.warning('Error waiting for voltage meters: %s', str(e))
+                    time.sleep(HANGUP_BACKOFF)
+                
+            ## Read the data.  Reads never block so a stalled board does not
+            ## hold up the others.
+            for board in boards:
+                meter, engine = board.meter, board.engine
+                try:
+                    ### Both voltages come in at the same time.  Grab everything
+                    ### that is waiting so that we never fall behind.
+                    with stageTimes['read'].time():
+                        if acqMode == 'thread':
+                            block = meter.drain()
+                        else:
+                            block = meter.read_block()
+                    if block.shape[0] == 0:
+                        if time.time() - board.tLastData > board.tNoData:
+                            board.tLastData = time.time()
+                            board.readFailures.inc()
+                            raise LVMBReadError("No voltages received from %s in %.1f s" % (board.port, board.tNoData))
+                        continue
+                    board.tLastData = time.time()
+                    if tLastPass is not None:
+                        loopInterval.observe(board.tLastData - tLastPass)
+                    tLastPass = board.tLastData
+                    samplesRead.inc(block.shape[0])
+                    t, values = block[:,0], block[:,[2,1]]
                     
-                    if v < args.config_file['limits']['120V']['low'] or v > args.config_file['limits']['120V']['high']:
-                        logger.warning('120V is out of range at %.1f VAC', v)
-                        if start120 is None:
-                            start120 = t
-                    else:
-                        if flicker120 and (t - flicker120) >= args.config_file['events']['outage']:
-                            logger.info('120V Flicker cleared')
-                            flicker120 = False
-                            
-                        if outage120 and (t - outage120) >= args.config_file['events']['clear']:
-                            logger.info('120V Outage cleared')
-                            outage120 = False
+                    with stageTimes['log_write'].time():
+                        for fh,indexer,v in zip(board.logFHs, board.logIndexers, values.T):
+                            data = ''.join(["%.2f  %.1f\n" % (ti, vi) for ti,vi in zip(t, v)])
+                            indexer.record(t[0], data)
+                            fh.write(data)
+                            logBytes.inc(len(data))
                             
-                            try:
-                                os.unlink(os.path.join(STATE_DIR, 'inPowerFailure120'))
-                            except (OSError, IOError) as e:
-                                pass
-                                
-                            server.send("[%s] CLEAR: 120V" % tUTC.strftime(dateFmt))
-                            
-                        if not flicker120 and not outage120:
-                            start120 = None
-                            
-                    if start120 is not None and not flicker120:
-                        age = t - start120
-                        if age >= args.config_file['events']['flicker'] and age < args.config_file['events']['outage']:
-                            logger.warning('120V has been out of tolerances for %.1f s (flicker)', age)
-                            flicker120 = start120*1.0
-                            
-                            server.send("[%s] FLICKER: 120V" % tUTC.strftime(dateFmt))
-                            
-                    if start120 is not None and not outage120:
-                        age = t - start120
-                        if age >= args.config_file['events']['outage']:
-                            logger.error('120V has been out of tolerances for %.1f s (outage)', age)
-                            outage120 = start120*1.0
-                            
-                            try:
-                                fh = open(os.path.join(STATE_DIR, 'inPowerFailure120'), 'w')
-                                fh.write("%.6f" % t)
-                                fh.close()
-                            except (OSError, IOError) as e:
-                                logging.error("Could not write 120V state file: %s", str(e))
-                                
-                            server.send("[%s] OUTAGE: 120V" % tUTC.strftime(dateFmt))
-                            
-                    if t-t0_120 > 10.0:
-                        logger.debug('120V meter is currently reading %.1f VAC', v)
-                        r120FH.flush()
-                        t0_120 = t*1.0
+                    with stageTimes['rollup'].time():
+                        board.rollup.process(t, values)
+                        snapshot.add_samples(engine.names, t, values)
                         
-                    voltage120.append( v )
-                    if len(voltage120) == 4:
-                        voltage120 = sum(voltage120) / len(voltage120)
-                        server.send("[%s] 120VAC: %.2f" % (tUTC.strftime(dateFmt), voltage120))
-                        voltage120 = []
-                        
-                    ### Now deal with the 240V
-                    v = data240
-                    r240FH.write("%.2f  %.1f\n" % (t, v))
-                    
-                    if v < args.config_file['limits']['240V']['low'] or v > args.config_file['limits']['240V']['high']:
-                        logger.warning('240V is out of range at %.1f VAC', v)
-                        if start240 is None:
-                            start240 = t
-                    else:
-                        if flicker240 and (t - flicker240) >= args.config_file['events']['outage']:
-                            logger.info('240V Flicker cleared')
-                            flicker240 = False
-                            
-                        if outage240 and (t - outage240) >= args.config_file['events']['clear']:
-                            logger.info('240V Outage cleared')
-                            outage240 = False
-                            
-                            try:
-                                os.unlink(os.path.join(STATE_DIR, 'inPowerFailure240'))
-                            except (OSError, IOError) as e:
-                                pass
-                                
-                            server.send("[%s] CLEAR: 240V" % tUTC.strftime(dateFmt))
-                            
-                        if not flicker240 and not outage240:
-                            start240 = None
-                            
-                    if start240 is not None and not flicker240:
-                        age = t - start240
-                        if age >= args.config_file['events']['flicker'] and age < args.config_file['events']['outage']:
-                            logger.warning('240V has been out of tolerances for %.1f s (flicker)', age)
-                            flicker240 = start240*1.0
-                            
-                            server.send("[%s] FLICKER: 240V" % tUTC.strftime(dateFmt))
-                            
-                    if start240 is not None and not outage240:
-                        age = t - start240
-                        if age >= args.config_file['events']['outage']:
-                            logger.error('240V has been out of tolerances for %.1f s (outage)', age)
-                            outage240 = start240*1.0
-                            
-                            try:
-                                fh = open(os.path.join(STATE_DIR, 'inPowerFailure240'), 'w')
-                                fh.write("%.6f" % t)
-                                fh.close()
-                            except (OSError, IOError) as e:
-                                logging.error("Could not write 240V state file: %s", str(e))
-                                
-                            server.send("[%s] OUTAGE: 240V" % tUTC.strftime(dateFmt))
+                    ### Event detection
+                    with stageTimes['events'].time():
+                        events = engine.process(t, values)
+                    if events:
+                        eventCount.inc(len(events))
+                        with stageTimes['report'].time():
+                            _report_events(events, logger, server, state, snapshot)
+                            for c,name in enumerate(engine.names):
+                                snapshot.set_state(name, _channel_state(engine, c))
                             
-                    if t-t0_240 > 10.0:
-                        logger.debug('240V meter is currently reading %.1f VAC', v)
-                        r240FH.flush()
-                        t0_240 = t*1.0
-                        
-                    voltage240.append( v )
-                    if len(voltage240) == 4:
-                        voltage240 = sum(voltage240) / len(voltage240)
-                        server.send("[%s] 240VAC: %.2f" % (tUTC.strftime(dateFmt), voltage240))
-                        voltage240 = []
+                    if t[-1]-board.t0 > 10.0:
+                        with stageTimes['flush'].time():
+                            for name,fh,indexer,v in zip(engine.names, board.logFHs, board.logIndexers, values[-1]):
+                                logger.debug('%s meter is currently reading %.1f VAC', name, v)
+                                fh.flush()
+                                indexer.check()
+                            board.rollup.flush()
+                        board.t0 = t[-1]*1.0
                         
+                    ### Windowed statistics and the raw sample stream
+                    with stageTimes['publish'].time():
+                        server.send_raw(engine.names, t, values)
+                        for ti,results in board.aggregator.process(t, values):
+                            server.send_statistics(ti, engine.names, [(STATISTICS[stat], results[stat]) for stat in board.aggregator.statistics])
+                            
                 except (TypeError, RuntimeError) as e:
                     logger.warning('Error parsing voltage data: %s', str(e), exc_info=True)
                     
                 except LVMBError as e:
                     logger.warning('Error reading from voltage meter: %s', str(e))
                     
-            ## Sleep a bit
-            time.sleep(0.2)
+            ## Send any raw samples that have waited too long, even if nothing
+            ## new came in on this pass
+            server.flush_raw()
             
     except KeyboardInterrupt:
         logger.info("Interrupt received, shutting down")
         
         server.stop()
-        
-        if meter is not None:
-            meter.close()
+        if metricsServer is not None:
+            metricsServer.stop()
+        if snapshotServer is not None:
+            snapshotServer.stop()
             
-        try:
-            r120FH.close()
-        except:
-            pass
-        try:
-            r240FH.close()
-        except:
-            pass
+        for board in boards:
+            board.close()
+        state.close()
         
     # Exit
     logger.info('Finished')
@@ -406,7 +764,7 @@ if __name__ == "__main__":
     args = parser.parse_args()
     
     # Parse the configuration file
-    with open(args.config_file, 'r') as ch:
-        args.config_file = json.loads(json_minify.json_minify(ch.read()))
+    args.config_filename = args.config_file
+    args.config_file = _read_config(args.config_filename)
         
     main(args)
@@ -7,93 +7,80 @@ import os
 import sys
 import pytz
 import time
-import socket
 import argparse
 
 from collections import deque
 
-import re
 from datetime import datetime, timedelta
 
-dataRE = re.compile(r'^\[(?P<date>.*)\] (?P<type>[A-Z0-9]*): (?P<data>.*)$')
+from lvmpacket import EVENT_KINDS
+from lvmsubscriber import Handler, Subscriber
 
 
-def DLVM(mcastAddr="224.168.2.10", mcastPort=7165):
+class PrintHandler(Handler):
     """
-    Function responsible for reading the UDP multi-cast packets and printing them
-    to the screen.
+    Subscriber handler that prints the latest voltages as they arrive along
+    with any events.  `prefix` selects the board to follow by its channel
+    prefix, i.e., 'B2-', when the monitor serves several boards.
     """
     
-    #create a UDP socket
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    #allow multiple sockets to use the same PORT number
-    sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
-    #Bind to the port that we know will receive multicast data
-    sock.bind(("0.0.0.0", mcastPort))
-    #tell the kernel that we are a multicast socket
-    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 20)
-    #Tell the kernel that we want to add ourselves to a multicast group
-    #The address for the multicast group is the third param
-    status = sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
-                            socket.inet_aton(mcastAddr) + socket.inet_aton("0.0.0.0"))
-    sock.setblocking(1)
-    
-    # Setup the state variable
-    state = {'t120':None, 'v120':None, 't240':None, 'v240':None}
-    
-    # Main reading loop
-    try:
+    def __init__(self, prefix=''):
+        # Setup the state variable
+        self.prefix = prefix
+        self.state = {'t120':None, 'v120':None, 't240':None, 'v240':None}
+        
+    def on_start(self, subscriber):
         print("%19s  |  %9s  |  %19s  |  %9s" % ('Time 120', 'Volts 120', 'Time 240', 'Volts 240'))
         print("-"*(19*2 + 5*2 + 4*2 + 3 + 2*6))
-        while True:
-            try:
-                tNow = datetime.utcnow()
-                data, addr = sock.recvfrom(1024)
+        
+    def on_dropped(self, missed, group):
+        print('NOTICE: %i packet(s) dropped' % missed)
+        
+    def on_records(self, records, group):
+        state = self.state
+        tNow = datetime.utcnow()
+        
+        # Deal with the data
+        updated = False
+        for rec in records:
+            if rec.kind == 'VAC' and rec.name in (self.prefix+'120V', self.prefix+'240V'):
+                state['t'+rec.name[-4:-1]] = datetime.utcfromtimestamp(rec.t)
+                state['v'+rec.name[-4:-1]] = rec.value
+                updated = True
                 
-                # RegEx matching for message date, type, and content
-                try:
-                    data = data.decode('ascii')
-                except AttributeError:
-                    pass
-                mtch = dataRE.match(data)
-                t = datetime.strptime(mtch.group('date'), "%Y-%m-%d %H:%M:%S.%f")
-                
-                # Deal with the data
-                if mtch.group('type') == '120VAC':
-                    state['t120'] = t
-                    state['v120'] = float(mtch.group('data'))
-                    
-                elif mtch.group('type') == '240VAC':
-                    state['t240'] = t
-                    state['v240'] = float(mtch.group('data'))
+            elif rec.kind in EVENT_KINDS:
+                print('NOTICE: %s - %s' % (rec.kind, rec.name))
+        if not updated:
+            return
+            
+        # Flush out stale values
+        if state['t120'] is not None:
+            if tNow-state['t120'] > timedelta(seconds=10):
+                    state['t120'] = None
+                    state['v120'] = None
+        if state['t240'] is not None:
+            if tNow-state['t240'] > timedelta(seconds=10):
+                    state['t240'] = None
+                    state['v240'] = None
                     
-                else:
-                    print('NOTICE: %s - %s' % (mtch.group('type'), mtch.group('data')))
-                    continue
-                    
-                # Flush out stale values
-                if state['t120'] is not None:
-                    if tNow-state['t120'] > timedelta(seconds=10):
-                            state['t120'] = None
-                            state['v120'] = None
-                if state['t240'] is not None:
-                    if tNow-state['t240'] > timedelta(seconds=10):
-                            state['t240'] = None
-                            state['v240'] = None
-                            
-                # Print out valid values
-                t120 = state['t120'].strftime('%Y/%m/%d %H:%M:%S') if state['t120'] is not None else '---'
-                v120 = '%5.1f' % state['v120'] if state['t120'] is not None else '---'
-                t240 = state['t240'].strftime('%Y/%m/%d %H:%M:%S') if state['t240'] is not None else '---'
-                v240 = '%5.1f' % state['v240'] if state['t240'] is not None else '---'
-                print("%19s  |  %5s VAC  |  %19s  |  %5s VAC" % (t120, v120, t240, v240))
-                
-            except socket.error as e:
-                pass
-                
-    except KeyboardInterrupt:
-        sock.close()
-        print('')
+        # Print out valid values
+        t120 = state['t120'].strftime('%Y/%m/%d %H:%M:%S') if state['t120'] is not None else '---'
+        v120 = '%5.1f' % state['v120'] if state['t120'] is not None else '---'
+        t240 = state['t240'].strftime('%Y/%m/%d %H:%M:%S') if state['t240'] is not None else '---'
+        v240 = '%5.1f' % state['v240'] if state['t240'] is not None else '---'
+        print("%19s  |  %5s VAC  |  %19s  |  %5s VAC" % (t120, v120, t240, v240))
+
+
+def DLVM(mcastAddr="224.168.2.10", mcastPort=7165, prefix=''):
+    """
+    Function responsible for reading the UDP multi-cast packets and printing them
+    to the screen.
+    """
+    
+    subscriber = Subscriber([(mcastAddr, mcastPort),])
+    subscriber.add_handler(PrintHandler(prefix=prefix))
+    subscriber.run()
+    print('')
 
 
 if __name__ == "__main__":
@@ -105,7 +92,9 @@ if __name__ == "__main__":
                         help='mulitcast address to connect to')
     parser.add_argument('-p', '--port', type=int, default=7165,
                         help='multicast port to connect on')
+    parser.add_argument('-b', '--board', type=str, default='',
+                        help='channel prefix of the board to show, i.e., B2-, for additional boards')
     args = parser.parse_args()
     
-    DLVM(mcastAddr=args.address, mcastPort=args.port)
+    DLVM(mcastAddr=args.address, mcastPort=args.port, prefix=args.board)
     
\ No newline at end of file
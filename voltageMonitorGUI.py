@@ -7,92 +7,160 @@ import os
 import sys
 import pytz
 import time
-import socket
 import argparse
 
+import numpy
 import pylab
+import matplotlib.dates
 
-from collections import deque
-
-import re
 from datetime import datetime, timedelta
 
-dataRE = re.compile(r'^\[(?P<date>.*)\] (?P<type>[A-Z0-9]*): (?P<data>.*)$')
+from lvmsubscriber import Handler, Subscriber
+
+
+# Offset between UNIX time in days and matplotlib's date numbers
+_MPL_EPOCH = matplotlib.dates.date2num(datetime(1970, 1, 1))
 
 
-def DLVM(mcastAddr="224.168.2.10", mcastPort=7165):
+class _Ring(object):
     """
-    Function responsible for reading the UDP multi-cast packets and printing them
-    to the screen.
+    Fixed size ring buffer of (time, value) pairs.
     """
     
-    #create a UDP socket
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    #allow multiple sockets to use the same PORT number
-    sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
-    #Bind to the port that we know will receive multicast data
-    sock.bind(("0.0.0.0", mcastPort))
-    #tell the kernel that we are a multicast socket
-    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 20)
-    #Tell the kernel that we want to add ourselves to a multicast group
-    #The address for the multicast group is the third param
-    status = sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
-                            socket.inet_aton(mcastAddr) + socket.inet_aton("0.0.0.0"))
-    sock.setblocking(1)
+    __slots__ = ('t', 'v', 'count')
     
-    # Setup the storage array
-    times120 = deque([], 300)
-    volts120 = deque([], 300)
-    times240 = deque([], 300)
-    volts240 = deque([], 300)
-    
-    pylab.ion()
+    def __init__(self, size):
+        self.t = numpy.zeros(size, dtype=numpy.float64)
+        self.v = numpy.zeros(size, dtype=numpy.float64)
+        self.count = 0
+        
+    def append(self, t, v):
+        i = self.count % self.t.size
+        self.t[i] = t
+        self.v[i] = v
+        self.count += 1
+        
+    def values(self):
+        """
+        Return the times and values in the buffer ordered oldest to newest.
+        """
+        
+        if self.count <= self.t.size:
+            return self.t[:self.count], self.v[:self.count]
+        i = self.count % self.t.size
+        return numpy.roll(self.t, -i), numpy.roll(self.v, -i)
+
+
+class PlotHandler(Handler):
+    """
+    Subscriber handler that plots the voltages.  The plot is redrawn at most
+    `max_fps` times per second regardless of how quickly packets arrive.
+    """
     
-    # Main reading loop
-    try:
-        while True:
-            try:
-                data, addr = sock.recvfrom(1024)
-                
-                # RegEx matching for message date, type, and content
-                try:
-                    data = data.decode('ascii')
-                except AttributeError:
-                    pass
-                mtch = dataRE.match(data)
-                t = datetime.strptime(mtch.group('date'), "%Y-%m-%d %H:%M:%S.%f")
+    def __init__(self, max_fps=5.0):
+        self.interval = 1.0/max_fps
+        
+        # Setup the storage array
+        self.history = {'120V': _Ring(300), '240V': _Ring(300)}
+        self.dirty = False
+        
+        # Setup the plot.  Everything is created once and then updated in place.
+        pylab.ion()
+        self.fig = pylab.figure()
+        self.canvas = self.fig.canvas
+        self.blit = getattr(self.canvas, 'supports_blit', False)
+        self.background = None
+        self.scaled = False
+        self.canvas.mpl_connect('resize_event', self._on_resize)
+        
+        self.ax = ax = self.fig.gca()
+        self.lines = {}
+        self.lines['120V'], = ax.plot([], [], linestyle='', marker='x', color='blue', animated=self.blit)
+        self.lines['240V'], = ax.plot([], [], linestyle='', marker='+', color='green', animated=self.blit)
+        ax.set_xlabel('Time [UTC]')
+        ax.set_ylabel('Volts AC')
+        ax.axhline(120*1.0, linestyle=':', color='black')
+        ax.axhline(120*0.9, linestyle='--', color='orange')
+        ax.axhline(120*1.1, linestyle='--', color='orange')
+        ax.axhline(240*1.0, linestyle=':', color='black')
+        ax.axhline(240*0.9, linestyle='-.', color='red')
+        ax.axhline(240*1.1, linestyle='-.', color='red')
+        ax.xaxis_date()
+        ax.set_ylim(-5, 280)
+        pylab.show(block=False)
+        
+    def _on_resize(self, event):
+        """
+        The cached background no longer matches the canvas after a resize so
+        have the next tick recapture it.
+        """
+        
+        self.background = None
+        self.dirty = True
+        
+    def on_records(self, records, group):
+        for rec in records:
+            if rec.kind == 'VAC' and rec.name in self.history:
+                self.history[rec.name].append(rec.t, rec.value)
+                self.dirty = True
                 
-                # Deal with the data
-                if mtch.group('type') == '120VAC':
-                    times120.append( t )
-                    volts120.append( float(mtch.group('data')) )
-                    
-                elif mtch.group('type') == '240VAC':
-                    times240.append( t )
-                    volts240.append( float(mtch.group('data')) )
-                    
-                pylab.clf()
-                pylab.plot( times120, volts120, linestyle='', marker='x', color='blue')
-                pylab.plot( times240, volts240, linestyle='', marker='+', color='green')
-                pylab.xlabel('Time [UTC]')
-                pylab.ylabel('Volts AC')
-                r = pylab.xlim()
-                pylab.hlines(120*1.0, *r, linestyle=':', color='black')
-                pylab.hlines(120*0.9, *r, linestyle='--', color='orange')
-                pylab.hlines(120*1.1, *r, linestyle='--', color='orange')
-                pylab.hlines(240*1.0, *r, linestyle=':', color='black')
-                pylab.hlines(240*0.9, *r, linestyle='-.', color='red')
-                pylab.hlines(240*1.1, *r, linestyle='-.', color='red')
-                pylab.draw()
+    def on_tick(self):
+        ax, canvas = self.ax, self.canvas
+        if self.dirty:
+            self.dirty = False
+            
+            ## Update the data and see if the axes still contain it
+            tMin, tMax = 1e99, -1e99
+            vMin, vMax = 1e99, -1e99
+            for name,line in self.lines.items():
+                t, v = self.history[name].values()
+                if t.size == 0:
+                    continue
+                t = t/86400.0 + _MPL_EPOCH
+                line.set_data(t, v)
+                tMin, tMax = min(tMin, t[0]), max(tMax, t[-1])
+                vMin, vMax = min(vMin, v.min()), max(vMax, v.max())
+            x0, x1 = ax.get_xlim()
+            y0, y1 = ax.get_ylim()
+            
+            rescale = not self.scaled or tMin < x0 or tMax > x1 or vMin < y0 or vMax > y1
+            if rescale and tMin <= tMax:
+                ### New limits, leaving 10% of room to grow
+                span = max(tMax - tMin, 10.0/86400)
+                ax.set_xlim(tMin, tMax + 0.1*span)
+                ax.set_ylim(min(y0, vMin - 5), max(y1, vMax + 5))
+                self.scaled = True
                 
-            except socket.error as e:
-                pass
+            if self.blit:
+                ### Blit just the data over the cached background, which
+                ### only needs a full redraw when the limits or the size of
+                ### the canvas change
+                if rescale or self.background is None:
+                    canvas.draw()
+                    self.background = canvas.copy_from_bbox(ax.bbox)
+                canvas.restore_region(self.background)
+                for line in self.lines.values():
+                    ax.draw_artist(line)
+                canvas.blit(ax.bbox)
+            else:
+                canvas.draw_idle()
                 
-    except KeyboardInterrupt:
-        sock.close()
-        print('')
+        canvas.flush_events()
         
-    pylab.ioff()
+    def on_stop(self):
+        pylab.ioff()
+
+
+def DLVM(mcastAddr="224.168.2.10", mcastPort=7165, max_fps=5.0):
+    """
+    Function responsible for reading the UDP multi-cast packets and plotting
+    them.
+    """
+    
+    subscriber = Subscriber([(mcastAddr, mcastPort),])
+    subscriber.add_handler(PlotHandler(max_fps=max_fps))
+    subscriber.run()
+    print('')
 
 
 if __name__ == "__main__":
@@ -104,7 +172,9 @@ if __name__ == "__main__":
                         help='mulitcast address to connect to')
     parser.add_argument('-p', '--port', type=int, default=7165,
                         help='multicast port to connect on')
+    parser.add_argument('-f', '--max-fps', type=float, default=5.0,
+                        help='maximum number of plot updates per second')
     args = parser.parse_args()
     
-    DLVM(mcastAddr=args.address, mcastPort=args.port)
-    
\ No newline at end of file
+    DLVM(mcastAddr=args.address, mcastPort=args.port, max_fps=args.max_fps)
+    